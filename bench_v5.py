@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+"""Benchmarks de server_v5.py.
+
+Subcomandos:
+ - idle: abre N conexiones ociosas contra server_v5 (motor de hilos o event
+   loop) y mide CPU y RSS del proceso servidor mientras nadie habla.
+ - contention: ejecuta los handlers de server_v5 en proceso, desde muchos
+   hilos repartidos en R salas, y mide operaciones por segundo según R.
+ - throughput: levanta server_v5 con ``--workers N``, reparte C clientes en R
+   salas, les hace enviar mensajes a la tasa pedida y mide cuántas entregas
+   por segundo llegan a los clientes.
+ - syscalls: cuenta las llamadas send/sendall/sendmsg del servidor para la
+   misma carga (ráfagas de mensajes y /join) con y sin ``--no-coalesce``.
+ - wire: bytes por mensaje y costo de codificar/parsear cada protocolo
+   (texto, JSON, bin1), con y sin compresión zlib, para un tráfico de sala
+   sintético o reproducido desde un log de ``--log-dir``.
+
+Ejemplos:
+    python bench_v5.py idle --engine threads loop --connections 1000 5000 10000
+    python bench_v5.py contention --threads 64 --rooms 1 4 16 64
+    python bench_v5.py throughput --workers 1 2 4 8 --clients 400 --rooms 20
+    python bench_v5.py syscalls --engine threads loop
+    python bench_v5.py wire --messages 100000
+    python bench_v5.py wire --replay /var/log/chat
+
+Los resultados se imprimen como tabla y, con ``--json``, como una línea JSON
+por medición para poder comparar corridas.
+"""
+
+import argparse
+import json
+import os
+import random
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(HERE, 'server_v5.py')
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# Arranca server_v5 contando las llamadas de envío de todos sus sockets; con
+# SIGUSR1 escribe los contadores acumulados en el archivo indicado.
+SEND_COUNTER_BOOTSTRAP = """
+import json, signal, socket, sys
+sys.path.insert(0, {here!r})
+counts = {{'send': 0, 'sendall': 0, 'sendmsg': 0}}
+for name in counts:
+    def wrapper(self, *args, _original=getattr(socket.socket, name), _name=name):
+        counts[_name] += 1
+        return _original(self, *args)
+    setattr(socket.socket, name, wrapper)
+def dump(signum, frame):
+    with open({out!r}, 'w') as f:
+        json.dump(counts, f)
+signal.signal(signal.SIGUSR1, dump)
+import server_v5
+server_v5.main(sys.argv[1:])
+"""
+
+
+def start_server(port, extra_args, launcher=None):
+    cmd = list(launcher or [sys.executable, SERVER_SCRIPT])
+    cmd += ['--host', '127.0.0.1', '--port', str(port)]
+    cmd.extend(extra_args)
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError('El servidor no empezó a escuchar a tiempo.')
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat', 'r') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime y stime son los campos 14 y 15 (contando desde 1)
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+
+def proc_status(pid):
+    status = {}
+    with open(f'/proc/{pid}/status', 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            status[key] = value.strip()
+    return status
+
+
+def open_idle_clients(port, count, prefix):
+    """Conecta ``count`` clientes CLIENT_V5 y los deja ociosos en salas propias.
+
+    Cada cliente cambia a una sala privada justo después de registrarse para
+    que los avisos de ingreso a 'global' no se conviertan en N² envíos.
+    """
+    socks = []
+    for i in range(count):
+        s = socket.create_connection(('127.0.0.1', port))
+        name = f'{prefix}{i}'
+        s.sendall(f'CLIENT_V5 username={name}\n/join sala_{name}\n'.encode('utf-8'))
+        socks.append(s)
+    return socks
+
+
+def run_idle(engine, connections, settle, window):
+    port = free_port()
+    proc = start_server(port, ['--engine', engine])
+    socks = []
+    try:
+        base_rss = int(proc_status(proc.pid)['VmRSS'].split()[0])
+        started = time.monotonic()
+        socks = open_idle_clients(port, connections, 'idle')
+        connect_secs = time.monotonic() - started
+        time.sleep(settle)
+        cpu_before = cpu_seconds(proc.pid)
+        time.sleep(window)
+        cpu_after = cpu_seconds(proc.pid)
+        status = proc_status(proc.pid)
+        return {
+            'bench': 'idle',
+            'engine': engine,
+            'connections': connections,
+            'connect_secs': round(connect_secs, 3),
+            'idle_cpu_pct': round(100.0 * (cpu_after - cpu_before) / window, 2),
+            'rss_mb': round(int(status['VmRSS'].split()[0]) / 1024, 1),
+            'rss_base_mb': round(base_rss / 1024, 1),
+            'threads': int(status['Threads']),
+        }
+    finally:
+        for s in socks:
+            try:
+                s.close()
+            except OSError:
+                pass
+        stop_server(proc)
+
+
+class NullConnection:
+    """Conexión falsa para los benchmarks en proceso: cuenta lo enviado."""
+
+    def __init__(self):
+        self.frames = 0
+        self.session = None
+
+    def sendall(self, data):
+        self.frames += 1
+
+    def close(self):
+        pass
+
+
+def run_contention(threads, rooms, duration):
+    """Cada hilo es un usuario que alterna entre dos salas de su grupo y
+    envía mensajes; los grupos no comparten salas entre sí."""
+    import logging
+    import server_v5
+
+    logging.getLogger('server_v5').setLevel(logging.WARNING)
+    stop = threading.Event()
+    start_barrier = threading.Barrier(threads + 1)
+    ops = [0] * threads
+    conns = []
+
+    def worker(index, username, conn, room_a, room_b):
+        start_barrier.wait()
+        count = 0
+        rooms_cycle = (room_a, room_b)
+        while not stop.is_set():
+            for _ in range(8):
+                server_v5.handle_message(username, 'hola')
+            server_v5.handle_join_command(username, conn, rooms_cycle[count % 2], None)
+            count += 1
+        ops[index] = count * 9
+
+    workers = []
+    for i in range(threads):
+        username = f'c{rooms}_{i}'
+        conn = NullConnection()
+        conns.append((username, conn))
+        server_v5.register_client(username, conn, ('bench', i), 'text')
+        server_v5.initialize_memberships(username)
+        group = i % rooms
+        room_a, room_b = f'b{rooms}_{group}_a', f'b{rooms}_{group}_b'
+        server_v5.handle_join_command(username, conn, room_a, None)
+        thread = threading.Thread(target=worker, args=(i, username, conn, room_a, room_b), daemon=True)
+        thread.start()
+        workers.append(thread)
+
+    start_barrier.wait()
+    started = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    for username, _ in conns:
+        server_v5.cleanup_user(username)
+    return {
+        'bench': 'contention',
+        'threads': threads,
+        'rooms': rooms,
+        'ops_per_sec': round(sum(ops) / elapsed),
+        'frames_per_sec': round(sum(conn.frames for _, conn in conns) / elapsed),
+    }
+
+
+def run_throughput(engine, workers, clients, rooms, rate, duration):
+    """Todos los clientes hablan; la carga se mide en entregas recibidas."""
+    port = free_port()
+    proc = start_server(port, ['--engine', engine, '--workers', str(workers)])
+    sel = selectors.DefaultSelector()
+    socks = []
+    try:
+        for i in range(clients):
+            s = socket.create_connection(('127.0.0.1', port))
+            name = f'tp{i}'
+            s.sendall(f'CLIENT_V5 username={name}\n/join tp_{i % rooms}\n'.encode('utf-8'))
+            s.setblocking(False)
+            sel.register(s, selectors.EVENT_READ)
+            socks.append(s)
+
+        def drain(timeout):
+            received = 0
+            for key, _ in sel.select(timeout):
+                try:
+                    data = key.fileobj.recv(1 << 16)
+                except (BlockingIOError, InterruptedError):
+                    continue
+                received += data.count(b'\n')
+            return received
+
+        settle_until = time.monotonic() + 2.0
+        while time.monotonic() < settle_until:
+            drain(0.1)
+
+        sent = delivered = 0
+        payload = b'carga de prueba\n'
+        started = time.monotonic()
+        deadline = started + duration
+        next_sender = 0
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            due = int((now - started) * rate) - sent
+            for _ in range(due):
+                try:
+                    socks[next_sender].send(payload)
+                    sent += 1
+                except (BlockingIOError, InterruptedError):
+                    pass
+                next_sender = (next_sender + 1) % clients
+            delivered += drain(0.005)
+        elapsed = time.monotonic() - started
+        tail_until = time.monotonic() + 1.0
+        while time.monotonic() < tail_until:
+            delivered += drain(0.05)
+        return {
+            'bench': 'throughput',
+            'engine': engine,
+            'workers': workers,
+            'clients': clients,
+            'rooms': rooms,
+            'sent_per_sec': round(sent / elapsed),
+            'delivered_per_sec': round(delivered / elapsed),
+            'expected_per_sec': round(sent * (clients / rooms - 1) / elapsed),
+        }
+    finally:
+        for s in socks:
+            try:
+                s.close()
+            except OSError:
+                pass
+        sel.close()
+        stop_server(proc)
+
+
+def read_send_counts(proc, path):
+    if os.path.exists(path):
+        os.unlink(path)
+    proc.send_signal(signal.SIGUSR1)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            time.sleep(0.02)
+    raise RuntimeError('El servidor no informó sus contadores.')
+
+
+def run_syscalls(engine, coalesce, clients, rooms, rounds, burst):
+    """Cada cliente manda ``rounds`` ráfagas de ``burst`` líneas (una escritura
+    por ráfaga) y vuelve a hacer /join de su sala en cada ronda."""
+    port = free_port()
+    counts_path = os.path.join('/tmp', f'bench_v5_sends_{os.getpid()}.json')
+    launcher = [sys.executable, '-c', SEND_COUNTER_BOOTSTRAP.format(here=HERE, out=counts_path)]
+    extra = ['--engine', engine] + ([] if coalesce else ['--no-coalesce'])
+    proc = start_server(port, extra, launcher)
+    sel = selectors.DefaultSelector()
+    socks = []
+    try:
+        for i in range(clients):
+            s = socket.create_connection(('127.0.0.1', port))
+            s.sendall(f'CLIENT_V5 username=sc{i}\n/join sc_{i % rooms}\n'.encode('utf-8'))
+            sel.register(s, selectors.EVENT_READ)
+            socks.append(s)
+
+        def drain(quiet):
+            received = 0
+            while True:
+                events = sel.select(quiet)
+                if not events:
+                    return received
+                for key, _ in events:
+                    received += key.fileobj.recv(1 << 16).count(b'\n')
+
+        drain(1.5)
+        before = read_send_counts(proc, counts_path)
+        delivered = 0
+        for r in range(rounds):
+            for i, s in enumerate(socks):
+                lines = [f'/join sc_{i % rooms}'] + [f'r{r} m{k}' for k in range(burst)]
+                s.sendall(('\n'.join(lines) + '\n').encode('utf-8'))
+            delivered += drain(0.05)
+        delivered += drain(1.0)
+        after = read_send_counts(proc, counts_path)
+        calls = {name: after[name] - before[name] for name in after}
+        total = sum(calls.values())
+        return {
+            'bench': 'syscalls',
+            'engine': engine,
+            'coalesce': coalesce,
+            'clients': clients,
+            'rooms': rooms,
+            'lines_delivered': delivered,
+            'send_calls': total,
+            'sendmsg_calls': calls['sendmsg'],
+            'lines_per_call': round(delivered / total, 2) if total else None,
+        }
+    finally:
+        for s in socks:
+            s.close()
+        sel.close()
+        stop_server(proc)
+
+
+def synthetic_messages(count, users, rooms, seed=1):
+    rng = random.Random(seed)
+    words = ['hola', 'sala', 'mensaje', 'prueba', 'chat', 'servidor', 'bien', 'todos', 'ok', 'jaja']
+    out = []
+    for _ in range(count):
+        user = f'usuario{rng.randrange(users)}'
+        room = f'sala_{rng.randrange(rooms)}'
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(2, 12)))
+        out.append((room, user, text))
+    return out
+
+
+def replayed_messages(log_dir, limit):
+    from message_log import MessageLog
+
+    log = MessageLog(log_dir)
+    try:
+        out = []
+        for record in log.read_from(1):
+            if record.get('type') == 'msg':
+                out.append((record['room'], record.get('user', '??'), record.get('text', '')))
+                if len(out) >= limit:
+                    break
+        return out
+    finally:
+        log.close()
+
+
+def run_wire(messages, users, rooms, replay=None):
+    """Codifica el mismo tráfico en cada protocolo como lo haría server_v5 y
+    lo parsea como lo haría un cliente, en trozos de 4 KiB. Las columnas zlib
+    comprimen cada mensaje con Z_SYNC_FLUSH en un único stream, como una
+    conexión con compress=zlib."""
+    import logging
+    import zlib
+    import binwire
+    import compression
+    import server_v5
+    from framing import LineFramer
+
+    logging.getLogger('server_v5').setLevel(logging.WARNING)
+    if replay:
+        traffic = replayed_messages(replay, messages)
+        if not traffic:
+            raise SystemExit(f'No hay mensajes para reproducir en {replay}')
+    else:
+        traffic = synthetic_messages(messages, users, rooms)
+    messages = len(traffic)
+    rows = []
+    for protocol in ('text', 'json', binwire.FEATURE):
+        started = time.perf_counter()
+        parts = []
+        known = set()
+        for room, user, text in traffic:
+            frame = server_v5.FanoutFrame(
+                f'{user}: {text}',
+                {'type': 'msg', 'user': user, 'text': text, 'time': server_v5.now_ts()},
+                room,
+            )
+            data = frame.wire(protocol)
+            for intern_id, value in frame.interns:
+                if intern_id not in known:
+                    known.add(intern_id)
+                    parts.append(binwire.encode_intern(intern_id, value))
+            parts.append(data)
+        stream = b''.join(parts)
+        encode_secs = time.perf_counter() - started
+
+        started = time.perf_counter()
+        deflater = compression.Deflater()
+        zlib_bytes = sum(len(deflater.pack(part)) for part in parts)
+        zlib_secs = time.perf_counter() - started
+        plain = zlib.compressobj(compression.LEVEL, zlib.DEFLATED, compression.WBITS)
+        nodict_bytes = sum(len(plain.compress(part) + plain.flush(zlib.Z_SYNC_FLUSH)) for part in parts)
+
+        started = time.perf_counter()
+        parsed = 0
+        if protocol == binwire.FEATURE:
+            reader = binwire.FrameReader()
+            for i in range(0, len(stream), 4096):
+                for ftype, body in reader.feed_frames(stream[i:i + 4096]):
+                    if ftype == binwire.T_MSG:
+                        binwire.decode_msg(body)
+                        parsed += 1
+        else:
+            framer = LineFramer()
+            for i in range(0, len(stream), 4096):
+                for line in framer.feed(stream[i:i + 4096]):
+                    if protocol == 'json':
+                        json.loads(line)
+                    parsed += 1
+        parse_secs = time.perf_counter() - started
+        rows.append({
+            'bench': 'wire',
+            'protocol': protocol,
+            'messages': parsed,
+            'bytes_per_msg': round(len(stream) / messages, 1),
+            'encode_us': round(encode_secs / messages * 1e6, 2),
+            'parse_us': round(parse_secs / messages * 1e6, 2),
+            'zlib_bytes_per_msg': round(zlib_bytes / messages, 1),
+            'zlib_nodict_bytes_per_msg': round(nodict_bytes / messages, 1),
+            'zlib_us': round(zlib_secs / messages * 1e6, 2),
+        })
+    return rows
+
+
+def print_table(rows, columns):
+    widths = [max(len(col), *(len(str(row[col])) for row in rows)) for col in columns]
+    print('  '.join(col.ljust(w) for col, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[col]).ljust(w) for col, w in zip(columns, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks de server_v5.')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    idle = sub.add_parser('idle', help='CPU y RSS con conexiones ociosas.')
+    idle.add_argument('--engine', nargs='+', default=['threads', 'loop'], choices=('threads', 'loop'))
+    idle.add_argument('--connections', nargs='+', type=int, default=[1000, 5000, 10000])
+    idle.add_argument('--settle', type=float, default=2.0, help='Segundos de espera antes de medir.')
+    idle.add_argument('--window', type=float, default=10.0, help='Segundos de medición de CPU.')
+
+    contention = sub.add_parser('contention', help='Escalado de los handlers según la cantidad de salas.')
+    contention.add_argument('--threads', type=int, default=64)
+    contention.add_argument('--rooms', nargs='+', type=int, default=[1, 4, 16, 64])
+    contention.add_argument('--duration', type=float, default=5.0)
+
+    throughput = sub.add_parser('throughput', help='Entregas por segundo según la cantidad de workers.')
+    throughput.add_argument('--engine', choices=('threads', 'loop'), default='loop')
+    throughput.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8])
+    throughput.add_argument('--clients', type=int, default=400)
+    throughput.add_argument('--rooms', type=int, default=20)
+    throughput.add_argument('--rate', type=float, default=2000.0, help='Mensajes enviados por segundo en total.')
+    throughput.add_argument('--duration', type=float, default=10.0)
+
+    syscalls = sub.add_parser('syscalls', help='Llamadas de envío con y sin coalescencia de escrituras.')
+    syscalls.add_argument('--engine', nargs='+', choices=('threads', 'loop'), default=['threads', 'loop'])
+    syscalls.add_argument('--clients', type=int, default=200)
+    syscalls.add_argument('--rooms', type=int, default=10)
+    syscalls.add_argument('--rounds', type=int, default=20)
+    syscalls.add_argument('--burst', type=int, default=5, help='Líneas por escritura de cada cliente.')
+
+    wire = sub.add_parser('wire', help='Bytes y costo de parseo por mensaje según el protocolo.')
+    wire.add_argument('--messages', type=int, default=100000)
+    wire.add_argument('--users', type=int, default=500)
+    wire.add_argument('--rooms', type=int, default=50)
+    wire.add_argument('--replay', metavar='LOG_DIR', help='Reproducir los mensajes de un log de --log-dir.')
+
+    parser.add_argument('--json', action='store_true', help='Emitir resultados como JSON por línea.')
+
+    args = parser.parse_args(argv)
+    rows = []
+    if args.bench == 'idle':
+        for count in args.connections:
+            for engine in args.engine:
+                row = run_idle(engine, count, args.settle, args.window)
+                rows.append(row)
+                if args.json:
+                    print(json.dumps(row), flush=True)
+        if not args.json:
+            print_table(rows, ['engine', 'connections', 'connect_secs', 'idle_cpu_pct', 'rss_mb', 'rss_base_mb', 'threads'])
+    elif args.bench == 'contention':
+        for count in args.rooms:
+            row = run_contention(args.threads, count, args.duration)
+            rows.append(row)
+            if args.json:
+                print(json.dumps(row), flush=True)
+        if not args.json:
+            print_table(rows, ['threads', 'rooms', 'ops_per_sec', 'frames_per_sec'])
+    elif args.bench == 'throughput':
+        for count in args.workers:
+            row = run_throughput(args.engine, count, args.clients, args.rooms, args.rate, args.duration)
+            rows.append(row)
+            if args.json:
+                print(json.dumps(row), flush=True)
+        if not args.json:
+            print_table(
+                rows,
+                ['engine', 'workers', 'clients', 'rooms', 'sent_per_sec', 'delivered_per_sec', 'expected_per_sec'],
+            )
+    elif args.bench == 'syscalls':
+        for engine in args.engine:
+            for coalesce in (False, True):
+                row = run_syscalls(engine, coalesce, args.clients, args.rooms, args.rounds, args.burst)
+                rows.append(row)
+                if args.json:
+                    print(json.dumps(row), flush=True)
+        if not args.json:
+            print_table(rows, ['engine', 'coalesce', 'lines_delivered', 'send_calls', 'sendmsg_calls', 'lines_per_call'])
+    elif args.bench == 'wire':
+        rows = run_wire(args.messages, args.users, args.rooms, args.replay)
+        for row in rows:
+            if args.json:
+                print(json.dumps(row), flush=True)
+        if not args.json:
+            print_table(
+                rows,
+                ['protocol', 'messages', 'bytes_per_msg', 'zlib_bytes_per_msg', 'zlib_nodict_bytes_per_msg',
+                 'encode_us', 'parse_us', 'zlib_us'],
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Protocolo binario ``bin1`` negociado entre server_v5 y client_v5.
+
+Negociación: el servidor anuncia ``bin1`` en ``features=`` del banner
+HELLO_V5; el cliente agrega ``wire=bin1`` a su línea CLIENT_V5 y espera la
+línea de texto ``WIRE bin1``. Desde ese punto todo lo que viaja en ambos
+sentidos son frames binarios (el cliente no envía nada binario antes del
+acuse, así nunca se mezclan líneas y frames en un mismo buffer).
+
+Frame: ``struct('>IB')`` (largo del cuerpo, tipo) seguido del cuerpo.
+
+Servidor -> cliente:
+ - T_TEXT: una línea del protocolo de texto (confirmaciones, avisos...).
+ - T_MSG: ``struct('>IIQ')`` (id de sala, id de usuario, epoch en ms) y el
+   texto del mensaje.
+ - T_INTERN: ``struct('>I')`` id y la cadena que representa. Los ids son
+   globales del servidor; cada conexión recibe la definición una sola vez,
+   antes del primer frame que la usa.
+
+Cliente -> servidor:
+ - T_LINE: una línea tal como se enviaría en texto (mensaje o comando).
+"""
+
+import itertools
+import struct
+import threading
+
+from framing import LineTooLong
+
+FEATURE = 'bin1'
+ACK_LINE = 'WIRE bin1'
+
+HEADER = struct.Struct('>IB')
+MSG_FIELDS = struct.Struct('>IIQ')
+INTERN_ID = struct.Struct('>I')
+
+T_TEXT = 1
+T_MSG = 2
+T_INTERN = 3
+T_LINE = 16
+
+DEFAULT_MAX_FRAME = 64 * 1024
+
+
+class FrameTooLong(LineTooLong):
+    """Se lanza cuando un frame anuncia un cuerpo mayor al máximo."""
+
+
+def encode_frame(ftype, body):
+    return HEADER.pack(len(body), ftype) + body
+
+
+def encode_text(text):
+    return encode_frame(T_TEXT, text.encode('utf-8'))
+
+
+def encode_line(text):
+    return encode_frame(T_LINE, text.encode('utf-8'))
+
+
+def encode_msg(room_id, user_id, time_ms, text):
+    return encode_frame(T_MSG, MSG_FIELDS.pack(room_id, user_id, time_ms) + text.encode('utf-8'))
+
+
+def decode_msg(body):
+    """Cuerpo de T_MSG -> (id de sala, id de usuario, epoch ms, texto)."""
+    room_id, user_id, time_ms = MSG_FIELDS.unpack_from(body)
+    return room_id, user_id, time_ms, body[MSG_FIELDS.size:].decode('utf-8', 'replace')
+
+
+def encode_intern(intern_id, value):
+    return encode_frame(T_INTERN, INTERN_ID.pack(intern_id) + value.encode('utf-8'))
+
+
+class InternTable:
+    """Cadena -> id estable, compartida por todas las conexiones."""
+
+    def __init__(self):
+        self.ids = {}
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def id_for(self, value):
+        intern_id = self.ids.get(value)
+        if intern_id is None:
+            with self.lock:
+                intern_id = self.ids.get(value)
+                if intern_id is None:
+                    intern_id = self.ids[value] = next(self.counter)
+        return intern_id
+
+
+class FrameReader:
+    """Equivalente binario de framing.LineFramer: acumula bytes y entrega
+    ``(tipo, cuerpo)`` por cada frame completo."""
+
+    __slots__ = ('max_frame', '_buf')
+
+    def __init__(self, max_frame=DEFAULT_MAX_FRAME, initial=b''):
+        self.max_frame = max_frame
+        self._buf = bytearray(initial)
+
+    def __len__(self):
+        return len(self._buf)
+
+    def pending(self):
+        """Devuelve (sin consumir) los bytes que aún no forman un frame."""
+        return bytes(self._buf)
+
+    def feed_frames(self, data):
+        buf = self._buf
+        buf += data
+        frames = []
+        pos = 0
+        header_size = HEADER.size
+        while len(buf) - pos >= header_size:
+            length, ftype = HEADER.unpack_from(buf, pos)
+            if length > self.max_frame:
+                raise FrameTooLong(f'Frame de {length} bytes')
+            end = pos + header_size + length
+            if end > len(buf):
+                break
+            frames.append((ftype, bytes(buf[pos + header_size:end])))
+            pos = end
+        if pos:
+            del buf[:pos]
+        return frames
+
+
+class LineFrameReader(FrameReader):
+    """Lado servidor: entrega el texto de cada T_LINE, igual que
+    LineFramer.feed, para que la sesión despache sin cambios."""
+
+    __slots__ = ()
+
+    def feed(self, data):
+        return [body.decode('utf-8', 'replace') for ftype, body in self.feed_frames(data) if ftype == T_LINE]
+
+
+class TextFrameDecoder(FrameReader):
+    """Lado cliente: convierte los frames del servidor en las mismas líneas
+    que enviaría el protocolo de texto ("usuario: mensaje", avisos...)."""
+
+    __slots__ = ('names',)
+
+    def __init__(self, max_frame=DEFAULT_MAX_FRAME, initial=b''):
+        super().__init__(max_frame, initial)
+        self.names = {}
+
+    def feed(self, data):
+        lines = []
+        for ftype, body in self.feed_frames(data):
+            if ftype == T_TEXT:
+                lines.append(body.decode('utf-8', 'replace'))
+            elif ftype == T_MSG:
+                _, user_id, _, text = decode_msg(body)
+                lines.append(f"{self.names.get(user_id, '??')}: {text}")
+            elif ftype == T_INTERN:
+                (intern_id,) = INTERN_ID.unpack_from(body)
+                self.names[intern_id] = body[INTERN_ID.size:].decode('utf-8', 'replace')
+        return lines
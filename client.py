@@ -10,15 +10,15 @@ Comandos:
 import socket
 import threading
 import json
-import time
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, simpledialog
 
+from clock import now_ts
+from framing import LineFramer
+
 SERVER_HOST = '127.0.0.1'  # cambiar aquí o pedir en UI
 SERVER_PORT = 50000
-
-def now_ts():
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+MAX_LINE_LENGTH = 256 * 1024  # Bytes máximos por línea recibida del servidor
 
 class ChatClient:
     def __init__(self, master):
@@ -112,15 +112,14 @@ class ChatClient:
                 self.sock = None
 
     def listen_loop(self):
-        buf = ''
+        framer = LineFramer(MAX_LINE_LENGTH)
         while self.running and self.sock:
             try:
                 data = self.sock.recv(4096)
                 if not data:
                     raise ConnectionResetError()
-                buf += data.decode('utf-8')
-                while '\n' in buf:
-                    line, buf = buf.split('\n', 1)
+                # LineTooLong corta la conexión
+                for line in framer.feed(data):
                     if not line.strip():
                         continue
                     try:
@@ -12,17 +12,17 @@ Mejoras:
 import socket
 import threading
 import json
-import time
 import os
 import tkinter as tk
 from tkinter import ttk, simpledialog, messagebox, scrolledtext
 
+from clock import now_ts
+from framing import LineFramer
+
 SERVER_FILE = 'servers.json'
 DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 50000
-
-def now_ts():
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+MAX_LINE_LENGTH = 256 * 1024  # Bytes máximos por línea recibida del servidor
 
 def load_servers():
     if not os.path.exists(SERVER_FILE):
@@ -266,15 +266,14 @@ class ChatClient:
                 self.sock = None
 
     def listen_loop(self):
-        buf = ''
+        framer = LineFramer(MAX_LINE_LENGTH)
         while self.running and self.sock:
             try:
                 data = self.sock.recv(4096)
                 if not data:
                     raise ConnectionResetError()
-                buf += data.decode('utf-8')
-                while '\n' in buf:
-                    line, buf = buf.split('\n', 1)
+                # LineTooLong corta la conexión
+                for line in framer.feed(data):
                     if not line.strip():
                         continue
                     try:
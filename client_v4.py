@@ -16,12 +16,14 @@ Compatible con el server.py de esta conversación (protocolo de texto simple).
 import os
 import socket
 import threading
-import time
 import json
 import shlex
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
 
+from clock import now_ts
+from framing import LineFramer
+
 # -------------------------
 # Config
 # -------------------------
@@ -30,13 +32,11 @@ DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 55555          # Debe coincidir con server.py
 HISTORY_DIR = 'chat_history'
 LOAD_CHUNK = 100              # Líneas por “paginado” al hacer scroll arriba
+MAX_LINE_LENGTH = 256 * 1024  # Bytes máximos por línea recibida del servidor
 
 # -------------------------
 # Utilidades
 # -------------------------
-def now_ts():
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-
 def ensure_history_dir(path=None):
     target = HISTORY_DIR if path is None else path
     if not os.path.exists(target):
@@ -403,17 +403,15 @@ class ChatClient:
             self.running = False
 
     def listen_loop(self):
-        buffer = ""
+        framer = LineFramer(MAX_LINE_LENGTH)
         try:
             while self.running and self.sock:
                 try:
                     data = self.sock.recv(4096)
                     if not data:
                         raise ConnectionResetError()
-                    buffer += data.decode('utf-8', errors='replace')
-                    # Procesar por líneas
-                    while '\n' in buffer:
-                        line, buffer = buffer.split('\n', 1)
+                    # Procesar por líneas (LineTooLong corta la conexión)
+                    for line in framer.feed(data):
                         line = line.strip('\r')
                         if line:
                             self.master.after(0, self.process_server_line, line)
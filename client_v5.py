@@ -12,6 +12,8 @@ Cliente Tkinter con:
 
 Comparado con client_v4.py, este cliente incluye:
  - Handshake ligero con servidores que anuncian capacidades (server_v5.py)
+ - Protocolo binario compacto (bin1, ver binwire.py) y compresión zlib
+   (compression.py) si el servidor los anuncia
  - Detección automática de servidores básicos (p. ej. servidor_joel.py) y desactivación
    de funciones avanzadas como la barra lateral de "Mis chats"
  - Mayor tolerancia con protocolos de texto plano sin mensajes JSON
@@ -20,12 +22,16 @@ Comparado con client_v4.py, este cliente incluye:
 import os
 import socket
 import threading
-import time
 import json
 import shlex
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
 
+import binwire
+import compression
+from clock import now_ts
+from framing import LineFramer
+
 # -------------------------
 # Config
 # -------------------------
@@ -34,13 +40,11 @@ DEFAULT_HOST = '127.0.0.1'
 DEFAULT_PORT = 55555          # Debe coincidir con server.py
 HISTORY_DIR = 'chat_history'
 LOAD_CHUNK = 100              # Líneas por “paginado” al hacer scroll arriba
+MAX_LINE_LENGTH = 256 * 1024  # Bytes máximos por línea recibida del servidor
 
 # -------------------------
 # Utilidades
 # -------------------------
-def now_ts():
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-
 def ensure_history_dir(path=None):
     target = HISTORY_DIR if path is None else path
     if not os.path.exists(target):
@@ -127,6 +131,8 @@ class ChatClient:
         self.running = False
         self.username = None
         self.server_key = 'default'
+        self.wire = 'text'                          # 'text' o 'bin1' según el handshake
+        self.deflater = None                        # compression.Deflater si se negoció zlib
 
         self.current_room = 'global'                # sala activa
         self.visited_rooms = set(['global'])        # salas visitadas (modelo: 1 sala activa a la vez)
@@ -404,7 +410,7 @@ class ChatClient:
         result = {
             'capabilities': caps,
             'initial_lines': [],
-            'leftover': '',
+            'framer': LineFramer(MAX_LINE_LENGTH),
             'handshake_mode': 'legacy',
         }
 
@@ -426,11 +432,8 @@ class ChatClient:
         if not data:
             raise ConnectionError("Servidor cerró la conexión durante el handshake.")
 
-        text = data.decode('utf-8', errors='replace')
-        parts = text.split('\n')
-        leftover = ''
-        if parts and text and not text.endswith('\n'):
-            leftover = parts.pop()
+        # Las líneas incompletas quedan en el framer y las termina listen_loop
+        parts = result['framer'].feed(data)
 
         handshake_detected = False
         prompt_received = False
@@ -453,7 +456,6 @@ class ChatClient:
                 initial_lines.append(line)
 
         result['initial_lines'] = initial_lines
-        result['leftover'] = leftover
 
         if handshake_detected:
             caps['features'] = set(features)
@@ -468,8 +470,19 @@ class ChatClient:
                 response_parts.append('public=1')
             if caps['supports_sidebar']:
                 response_parts.append('sidebar=1')
+            if 'ping' in features:
+                response_parts.append('ping=1')
+            acks = []
+            if binwire.FEATURE in features:
+                response_parts.append(f'wire={binwire.FEATURE}')
+                acks.append(binwire.ACK_LINE)
+            if compression.FEATURE in features:
+                response_parts.append(f'compress={compression.FEATURE}')
+                acks.append(compression.ACK_LINE)
             sock.sendall((' '.join(response_parts) + "\n").encode('utf-8'))
             result['handshake_mode'] = 'v5'
+            if acks:
+                self._await_acks(sock, result, acks)
         else:
             sock.sendall((username + "\n").encode('utf-8'))
             caps['features'] = set()
@@ -477,6 +490,48 @@ class ChatClient:
 
         return result
 
+    def _await_acks(self, sock, result, acks):
+        """Lee hasta el último acuse (``WIRE bin1`` / ``COMPRESS zlib``); lo
+        que llegue después ya viaja en el formato negociado y pasa al framer
+        que usará listen_loop."""
+        framer = result['framer']
+        last_ack = acks[-1]
+        is_last = lambda line: line.strip('\r') == last_ack
+        data = b''
+        while True:
+            lines = framer.feed_until(data, is_last)
+            done = bool(lines) and is_last(lines[-1])
+            for line in lines:
+                line = line.strip('\r')
+                if line and line not in acks and 'NOMBRE' not in line.upper():
+                    result['initial_lines'].append(line)
+            if done:
+                break
+            data = sock.recv(4096)
+            if not data:
+                raise ConnectionError("Servidor cerró la conexión durante el handshake.")
+        pending = framer.pending()
+        if binwire.ACK_LINE in acks:
+            framer = binwire.TextFrameDecoder(MAX_LINE_LENGTH)
+            result['wire'] = binwire.FEATURE
+        else:
+            framer = LineFramer(MAX_LINE_LENGTH)
+        if compression.ACK_LINE in acks:
+            framer = compression.InflatingFramer(framer)
+            result['deflater'] = compression.Deflater()
+        result['framer'] = framer
+        if pending:
+            result['initial_lines'].extend(line.strip('\r') for line in framer.feed(pending))
+
+    def _encode_outgoing(self, text):
+        if self.wire == binwire.FEATURE:
+            data = binwire.encode_line(text)
+        else:
+            data = (text + "\n").encode('utf-8')
+        if self.deflater is not None:
+            data = self.deflater.pack(data)
+        return data
+
     def connect(self):
         if self.sock:
             messagebox.showinfo("Info", "Ya estás conectado.")
@@ -502,6 +557,8 @@ class ChatClient:
 
             self.sock = s
             self.username = username
+            self.wire = handshake.get('wire', 'text')
+            self.deflater = handshake.get('deflater')
             self.running = True
             self.server_key = self._build_server_key(host, port)
             self.history_index = {}
@@ -537,10 +594,10 @@ class ChatClient:
                 if line:
                     self.process_server_line(line)
 
-            initial_buffer = handshake.get('leftover', '') or ''
+            framer = handshake.get('framer')
 
             # Iniciar hilo listener
-            self.listener_thread = threading.Thread(target=self.listen_loop, args=(initial_buffer,), daemon=True)
+            self.listener_thread = threading.Thread(target=self.listen_loop, args=(framer,), daemon=True)
             self.listener_thread.start()
 
         except Exception as e:
@@ -553,20 +610,23 @@ class ChatClient:
             self.sock = None
             self.running = False
 
-    def listen_loop(self, initial_buffer=""):
-        buffer = initial_buffer or ""
+    def listen_loop(self, framer=None):
+        if framer is None:
+            framer = LineFramer(MAX_LINE_LENGTH)
         try:
             while self.running and self.sock:
                 try:
                     data = self.sock.recv(4096)
                     if not data:
                         raise ConnectionResetError()
-                    buffer += data.decode('utf-8', errors='replace')
-                    # Procesar por líneas
-                    while '\n' in buffer:
-                        line, buffer = buffer.split('\n', 1)
+                    # Procesar por líneas (LineTooLong corta la conexión)
+                    for line in framer.feed(data):
                         line = line.strip('\r')
-                        if line:
+                        if line == 'PING' and 'ping' in self.server_caps.get('features', ()):
+                            # latido del servidor: se contesta desde el hilo de la UI,
+                            # el mismo que hace el resto de los envíos
+                            self.master.after(0, self._send_raw, 'PONG')
+                        elif line:
                             self.master.after(0, self.process_server_line, line)
                 except socket.timeout:
                     continue
@@ -730,7 +790,7 @@ class ChatClient:
         else:
             # Mensaje normal -> se envía a la sala actual y se muestra como "Tú:"
             try:
-                self.sock.sendall((text + "\n").encode('utf-8'))
+                self.sock.sendall(self._encode_outgoing(text))
                 self._append_local(f"[{now_ts()}] Tú: {text}", room=self.current_room)
             except Exception as e:
                 self._append_local(f"[{now_ts()}] Error al enviar: {e}", room=self.current_room)
@@ -742,7 +802,7 @@ class ChatClient:
     def _send_raw(self, raw: str):
         try:
             if self.sock:
-                self.sock.sendall((raw + "\n").encode('utf-8'))
+                self.sock.sendall(self._encode_outgoing(raw))
         except Exception as e:
             self._append_local(f"[{now_ts()}] Error al enviar comando: {e}", room=self.current_room)
 
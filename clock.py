@@ -0,0 +1,30 @@
+"""Reloj compartido por servidores y clientes.
+
+``now_ts()`` devuelve la hora local legible ('%Y-%m-%d %H:%M:%S') pero la
+formatea a lo sumo una vez por segundo: el resto de las llamadas de ese
+segundo devuelven la misma cadena ya armada. ``epoch_ms()`` es el instante
+numérico que viaja junto a esa cadena en los mensajes (campo ``epoch_ms``),
+para que nadie tenga que volver a parsear fechas; ``monotonic_ms()`` sirve
+para medir intervalos dentro de un proceso.
+"""
+
+import time
+
+_cached = (None, '')  # (segundo epoch, texto); se reemplaza entero, sin locks
+
+
+def now_ts():
+    global _cached
+    second = int(time.time())
+    cached = _cached
+    if cached[0] != second:
+        cached = _cached = (second, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second)))
+    return cached[1]
+
+
+def epoch_ms():
+    return time.time_ns() // 1_000_000
+
+
+def monotonic_ms():
+    return time.monotonic_ns() // 1_000_000
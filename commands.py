@@ -0,0 +1,78 @@
+"""Registro de comandos ``/...`` compartido por server_v4, server_v4-UDP y server_v5.
+
+Cada servidor arma un CommandRegistry con sus handlers y le pasa las líneas
+que empiezan con '/'. El registro:
+ - separa la línea con ``tokenize``: un ``str.split`` salvo que haya comillas
+   o barras invertidas, recién ahí usa shlex;
+ - busca el comando en un dict (nombre en minúsculas -> Command);
+ - valida la cantidad de argumentos: si faltan responde el texto de uso; los
+   opcionales ausentes llegan como None y los que sobran se ignoran;
+ - oculta los comandos ``admin`` a quien no lo es (responde como si no
+   existieran).
+
+Los handlers reciben el contexto que pasa el servidor (p. ej. ``username,
+conn``) seguido de los argumentos posicionales.
+"""
+
+import shlex
+
+INVALID = "❌ Comando inválido."
+UNKNOWN = "❌ Comando desconocido."
+
+
+def tokenize(line):
+    """Palabras de la línea; None si las comillas no cierran."""
+    if '"' in line or "'" in line or '\\' in line:
+        try:
+            return shlex.split(line)
+        except ValueError:
+            return None
+    return line.split()
+
+
+class Command:
+    __slots__ = ('name', 'handler', 'min_args', 'max_args', 'usage', 'admin')
+
+    def __init__(self, name, handler, min_args, max_args, usage, admin):
+        self.name = name
+        self.handler = handler
+        self.min_args = min_args
+        self.max_args = max_args
+        self.usage = usage
+        self.admin = admin
+
+
+class CommandRegistry:
+    def __init__(self, reply, invalid=INVALID, unknown=UNKNOWN):
+        self.reply = reply  # reply(destino, texto): cómo contestarle al que envió el comando
+        self.invalid = invalid
+        self.unknown = unknown
+        self.commands = {}
+
+    def register(self, name, handler, *, min_args=0, max_args=0, usage=None, admin=False):
+        max_args = max(max_args, min_args)
+        self.commands[name.lower()] = Command(name, handler, min_args, max_args, usage, admin)
+
+    def command(self, name, **options):
+        """Igual que ``register``, como decorador."""
+        def decorator(handler):
+            self.register(name, handler, **options)
+            return handler
+        return decorator
+
+    def dispatch(self, line, reply_to, *context, is_admin=False):
+        parts = tokenize(line)
+        if not parts:
+            self.reply(reply_to, self.invalid)
+            return
+        command = self.commands.get(parts[0].lower())
+        if command is None or (command.admin and not is_admin):
+            self.reply(reply_to, self.unknown)
+            return
+        args = parts[1:command.max_args + 1]
+        if len(args) < command.min_args:
+            self.reply(reply_to, command.usage or self.invalid)
+            return
+        if len(args) < command.max_args:
+            args += [None] * (command.max_args - len(args))
+        command.handler(*context, *args)
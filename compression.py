@@ -0,0 +1,86 @@
+"""Compresión por conexión (deflate en streaming) negociada en el handshake.
+
+El servidor anuncia ``zlib`` en ``features=`` del banner HELLO_V5; el cliente
+agrega ``compress=zlib`` a su línea CLIENT_V5 y espera la línea de texto
+``COMPRESS zlib``. Desde ahí cada sentido de la conexión es un único stream
+deflate crudo (wbits=-15) con un diccionario compartido precargado con las
+frases que más repite el servidor, así hasta el primer aviso sale comprimido.
+
+Cada escritor hace Z_SYNC_FLUSH al final de un frame (o de un lote de frames),
+de modo que el receptor siempre puede decodificar todo lo recibido sin esperar
+al siguiente mensaje.
+"""
+
+import zlib
+
+from framing import LineTooLong
+
+FEATURE = 'zlib'
+ACK_LINE = 'COMPRESS zlib'
+LEVEL = 6
+WBITS = -15
+MAX_EXPANSION = 64  # bytes descomprimidos por byte recibido antes de cortar...
+MIN_BUDGET = 256 * 1024  # ...salvo en trozos chicos, que siempre pueden dar esto
+
+# Lo más frecuente va al final: deflate alcanza antes las distancias cortas.
+PHRASES = (
+    "Salas públicas disponibles: (vacía), "
+    "❌ Comando desconocido.❌ Contraseña incorrecta.No estás en la sala '"
+    "Has salido de la sala '. Sala activa: global."
+    "[JSON/system] {\"type\": \"list_response\", \"users\": [\""
+    "{\"type\": \"system\", \"text\": \"Bienvenido "
+    "✅ Bienvenido . Estás en 'global'.ℹ️ se ha unido al chat global."
+    "✅ Te has unido a la sala '"
+    "ℹ️  se ha desconectado de la sala '"
+    "ℹ️  ha abandonado la sala '"
+    "🔔  se ha unido a la sala '"
+    "\", \"time\": \"20"
+    "{\"type\": \"msg\", \"user\": \"\", \"text\": \""
+).encode('utf-8')
+
+
+class CompressedStreamError(LineTooLong):
+    """Stream deflate inválido o que se expande más de lo permitido."""
+
+
+class Deflater:
+    """Extremo emisor: ``compress`` acumula, ``sync`` cierra el bloque."""
+
+    __slots__ = ('_comp',)
+
+    def __init__(self):
+        self._comp = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS, zdict=PHRASES)
+
+    def compress(self, data):
+        return self._comp.compress(data)
+
+    def sync(self):
+        return self._comp.flush(zlib.Z_SYNC_FLUSH)
+
+    def pack(self, data):
+        """Comprime un frame completo y lo deja listo para enviar."""
+        return self._comp.compress(data) + self._comp.flush(zlib.Z_SYNC_FLUSH)
+
+
+class InflatingFramer:
+    """Envuelve un framer (LineFramer o los de binwire): descomprime lo
+    recibido y se lo pasa. Limita la expansión por trozo recibido para que
+    un stream malicioso no pueda inflarse sin control."""
+
+    __slots__ = ('inner', '_decomp')
+
+    def __init__(self, inner):
+        self.inner = inner
+        self._decomp = zlib.decompressobj(WBITS, zdict=PHRASES)
+
+    def feed(self, data):
+        try:
+            plain = self._decomp.decompress(data, max(len(data) * MAX_EXPANSION, MIN_BUDGET))
+        except zlib.error as exc:
+            raise CompressedStreamError(f'Stream comprimido inválido: {exc}') from exc
+        if self._decomp.unconsumed_tail:
+            raise CompressedStreamError('Expansión de datos comprimidos excesiva')
+        return self.inner.feed(plain)
+
+    def __len__(self):
+        return len(self.inner)
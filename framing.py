@@ -0,0 +1,96 @@
+"""Framer incremental de líneas para los protocolos de texto/JSON por línea.
+
+Reemplaza el patrón ``buffer += data.decode(); buffer.split('\\n', 1)``, que
+copia el resto del buffer una vez por cada línea (costo cuadrático cuando el
+cliente envía muchas líneas juntas) y no pone límite a una línea sin '\\n'.
+
+Uso:
+    framer = LineFramer()
+    for line in framer.feed(sock.recv(4096)):
+        ...
+"""
+
+DEFAULT_MAX_LINE = 64 * 1024  # bytes
+
+
+class LineTooLong(Exception):
+    """Se lanza cuando una línea supera el máximo sin encontrar '\\n'."""
+
+
+class LineFramer:
+    """Acumula bytes en un ``bytearray`` y entrega líneas completas.
+
+    - Cada línea se decodifica una sola vez, directamente desde un
+      ``memoryview`` del buffer (no se decodifica por trozo, así que un
+      carácter UTF-8 partido entre dos ``recv`` llega intacto).
+    - La búsqueda de '\\n' continúa donde terminó la anterior, así que una
+      línea larga que llega en muchos trozos no se vuelve a escanear.
+    - El buffer se compacta una vez por ``feed``, no una vez por línea.
+    """
+
+    __slots__ = ('max_line', 'encoding', 'errors', '_buf', '_scan')
+
+    def __init__(self, max_line=DEFAULT_MAX_LINE, encoding='utf-8', errors='replace'):
+        self.max_line = max_line
+        self.encoding = encoding
+        self.errors = errors
+        self._buf = bytearray()
+        self._scan = 0
+
+    def __len__(self):
+        return len(self._buf)
+
+    def feed(self, data):
+        """Agrega ``data`` y devuelve la lista de líneas completas (sin '\\n').
+
+        Lanza LineTooLong si una línea completa o el resto pendiente supera
+        ``max_line`` bytes.
+        """
+        buf = self._buf
+        buf += data
+        lines = []
+        start = 0
+        pos = self._scan
+        with memoryview(buf) as view:
+            while True:
+                idx = buf.find(b'\n', pos)
+                if idx < 0:
+                    break
+                if idx - start > self.max_line:
+                    raise LineTooLong(f'Línea de {idx - start} bytes')
+                lines.append(str(view[start:idx], self.encoding, self.errors))
+                start = pos = idx + 1
+        if start:
+            del buf[:start]
+        self._scan = len(buf)
+        if self._scan > self.max_line:
+            raise LineTooLong(f'Línea de más de {self.max_line} bytes sin terminar')
+        return lines
+
+    def feed_until(self, data, stop):
+        """Como ``feed``, pero se detiene en la primera línea para la que
+        ``stop(line)`` es verdadero (incluida). Lo que sigue queda sin procesar
+        y se obtiene con ``pending()``; sirve para cambiar de framing a mitad
+        del flujo (p. ej. tras negociar el protocolo binario)."""
+        buf = self._buf
+        buf += data
+        lines = []
+        while True:
+            idx = buf.find(b'\n')
+            if idx < 0:
+                break
+            if idx > self.max_line:
+                raise LineTooLong(f'Línea de {idx} bytes')
+            line = buf[:idx].decode(self.encoding, self.errors)
+            del buf[:idx + 1]
+            lines.append(line)
+            if stop(line):
+                break
+        self._scan = 0
+        if len(buf) > self.max_line and buf.find(b'\n') < 0:
+            raise LineTooLong(f'Línea de más de {self.max_line} bytes sin terminar')
+        return lines
+
+    def pending(self):
+        """Devuelve (sin consumir) los bytes que aún no forman una línea."""
+        return bytes(self._buf)
@@ -0,0 +1,104 @@
+"""Traspaso en caliente entre dos procesos de server_v5 por un socket Unix.
+
+El proceso en marcha escucha en ``--handoff-socket``; el nuevo se lanza con
+``--takeover`` y se conecta ahí. El viejo congela sus sesiones y manda:
+
+ 1. una cabecera ``!QI`` (largo del estado, cantidad de descriptores);
+ 2. el estado en JSON (salas, usuarios y lo pendiente de cada sesión);
+ 3. los descriptores con SCM_RIGHTS, de a MAX_FDS por mensaje. Cada tanda
+    viaja pegada a un único byte, así que leer exactamente un byte por
+    ``recv_fds`` nunca mezcla dos tandas.
+
+El nuevo contesta ``OK`` cuando tiene todo, y el viejo termina. El nuevo
+espera a leer EOF (el viejo ya salió) antes de atender, para que nunca haya
+dos procesos leyendo los mismos sockets.
+"""
+
+import json
+import os
+import socket
+import struct
+
+REQUEST = b'TAKEOVER\n'
+ACK = b'OK'
+HEADER = struct.Struct('!QI')
+MAX_FDS = 250  # por mensaje; Linux acepta hasta 253 (SCM_MAX_FD)
+
+
+class HandoffError(Exception):
+    pass
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise HandoffError('El otro proceso cerró el canal de traspaso')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def listen(path):
+    """Socket de escucha del canal (reemplaza uno viejo que haya quedado)."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    return sock
+
+
+def read_request(chan, timeout=5.0):
+    chan.settimeout(timeout)
+    try:
+        return _recv_exact(chan, len(REQUEST)) == REQUEST
+    except (OSError, HandoffError):
+        return False
+    finally:
+        chan.settimeout(None)
+
+
+def send_state(chan, state, fds, timeout=30.0):
+    """Envía estado y descriptores; devuelve cuando el nuevo proceso acusó."""
+    body = json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    chan.settimeout(timeout)
+    chan.sendall(HEADER.pack(len(body), len(fds)) + body)
+    for start in range(0, len(fds), MAX_FDS):
+        socket.send_fds(chan, [b'F'], fds[start:start + MAX_FDS])
+    if _recv_exact(chan, len(ACK)) != ACK:
+        raise HandoffError('Acuse de traspaso inválido')
+
+
+def take_over(path, timeout=30.0):
+    """Pide el traspaso al proceso que escucha en ``path``.
+
+    Devuelve ``(estado, descriptores)`` o None si no hay nadie escuchando.
+    """
+    chan = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        chan.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        chan.close()
+        return None
+    with chan:
+        chan.settimeout(timeout)
+        chan.sendall(REQUEST)
+        size, count = HEADER.unpack(_recv_exact(chan, HEADER.size))
+        state = json.loads(_recv_exact(chan, size).decode('utf-8'))
+        fds = []
+        while len(fds) < count:
+            data, received, flags, _ = socket.recv_fds(chan, 1, MAX_FDS)
+            if not data:
+                raise HandoffError('Canal cerrado antes de recibir todos los sockets')
+            if flags & getattr(socket, 'MSG_CTRUNC', 0):
+                raise HandoffError('Descriptores truncados (¿límite de archivos abiertos?)')
+            fds.extend(received)
+        chan.sendall(ACK)
+        # EOF = el proceso viejo terminó y ya no toca los sockets
+        while chan.recv(4096):
+            pass
+    return state, fds
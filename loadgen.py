@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""Generador de carga y medición de latencia de difusión para los servidores.
+
+Abre miles de clientes simulados con asyncio contra un servidor ya en marcha
+(server_v5, server_v4, server_v3 o server_v4-UDP), los reparte en salas,
+envía mensajes a una tasa objetivo y mide:
+ - tiempo de conexión (hasta confirmar la sala) de cada cliente;
+ - mensajes enviados y entregas recibidas por segundo;
+ - latencia de difusión extremo a extremo (p50/p99/p999) de cada entrega.
+
+Cada mensaje lleva en el cuerpo ``~lg:<emisor>:<seq>:<perf_counter_ns>~``;
+como emisores y receptores viven en este mismo proceso, el receptor resta
+ese instante al de llegada sin depender de relojes externos. El marcador se
+busca en la línea cruda, así sirve igual para texto y para JSON.
+
+Protocolos (``--protocol``):
+ - text: nombre en la primera línea y ``/join`` (server_v4, server_v5).
+ - client_v5: ``CLIENT_V5 username=...`` y ``/join`` (server_v5).
+ - json: ``join`` + ``join_room``/``msg_room`` (server_v3). Con ``--rooms 0``
+   todos quedan en 'global' y se usa ``msg``, que también acepta server_v5.
+ - udp: ``HELLO <nombre>`` por datagramas (server_v4-UDP).
+
+Con ``--rooms 0`` nadie sale de 'global'. Ojo: server_v3 deja a todos en
+'global' aunque se unan a otra sala, así que el alta de N clientes le cuesta
+N² avisos; con muchos clientes conviene ``--settle`` generoso.
+
+La latencia incluye la planificación del propio generador (un solo hilo);
+``loop_lag_ms`` mide cuánto se atrasa su event loop para detectar cuándo el
+cuello de botella es el generador y no el servidor.
+
+Ejemplos:
+    python server_v5.py --engine loop &
+    python loadgen.py --protocol client_v5 --clients 2000 --rooms 40 --rate 2000
+    python loadgen.py --protocol json --clients 500 --rooms 10 --output runs.jsonl --label v3
+    python loadgen.py --protocol udp --clients 200 --rooms 4 --rate 500
+
+El resultado se imprime como un objeto JSON (y con ``--output`` se agrega al
+archivo, una línea por corrida) para poder comparar corridas.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import time
+
+MARKER = b'~lg:'
+MARKER_END = b'~'
+PROTOCOLS = ('text', 'client_v5', 'json', 'udp')
+
+
+class HandshakeFailed(Exception):
+    """El servidor rechazó el nombre o la sala."""
+
+
+def raise_nofile_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize_ms(values_ns):
+    values = sorted(values_ns)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values) / 1e6, 3),
+        'p50': round(percentile(values, 0.50) / 1e6, 3),
+        'p99': round(percentile(values, 0.99) / 1e6, 3),
+        'p999': round(percentile(values, 0.999) / 1e6, 3),
+        'max': round(values[-1] / 1e6, 3),
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.measuring = False
+        self.sent = 0
+        self.skipped = 0
+        self.expected = 0
+        self.delivered = 0
+        self.latencies = []
+
+
+class LoadClient:
+    """Un cliente simulado. Las líneas recibidas pasan por ``on_line``:
+    durante el handshake van a ``inbox``; después sólo se buscan marcadores."""
+
+    def __init__(self, index, name, room, protocol, stats):
+        self.index = index
+        self.name = name
+        self.room = room
+        self.protocol = protocol
+        self.stats = stats
+        self.inbox = asyncio.Queue()
+        self.ready = False
+        self.writer = None
+        self.transport = None
+        self.reader_task = None
+
+    # -- lo que se envía según el protocolo ---------------------------------
+
+    def hello_line(self):
+        if self.protocol == 'json':
+            return json.dumps({'type': 'join', 'user': self.name})
+        if self.protocol == 'client_v5':
+            return f'CLIENT_V5 username={self.name}'
+        if self.protocol == 'udp':
+            return f'HELLO {self.name}'
+        return self.name
+
+    def join_line(self):
+        if self.protocol == 'json':
+            return json.dumps({'type': 'join_room', 'room': self.room})
+        return f'/join {self.room}'
+
+    def message_line(self, text):
+        if self.protocol == 'json':
+            if self.room == 'global':
+                return json.dumps({'type': 'msg', 'text': text}, ensure_ascii=False)
+            return json.dumps({'type': 'msg_room', 'room': self.room, 'text': text}, ensure_ascii=False)
+        return text
+
+    # -- transporte -----------------------------------------------------------
+
+    async def open(self, host, port):
+        loop = asyncio.get_running_loop()
+        if self.protocol == 'udp':
+            self.transport, _ = await loop.create_datagram_endpoint(
+                lambda: DatagramClient(self), remote_addr=(host, port)
+            )
+        else:
+            reader, self.writer = await asyncio.open_connection(host, port)
+            self.transport = self.writer.transport
+            self.reader_task = asyncio.create_task(self._read_loop(reader))
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.on_line(line)
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        self.inbox.put_nowait(None)
+
+    def send(self, text):
+        data = (text + '\n').encode('utf-8')
+        if self.protocol == 'udp':
+            self.transport.sendto(data)
+        else:
+            self.transport.write(data)
+
+    def backlogged(self, limit):
+        return self.transport.get_write_buffer_size() > limit
+
+    def close(self):
+        if self.transport is not None:
+            if self.protocol == 'udp':
+                try:
+                    self.send('/quitar')  # el servidor UDP no detecta desconexiones
+                except OSError:
+                    pass
+            self.transport.close()
+
+    # -- recepción ------------------------------------------------------------
+
+    def on_line(self, line):
+        if not self.ready:
+            self.inbox.put_nowait(line)
+            return
+        start = line.find(MARKER)
+        if start < 0:
+            return
+        end = line.find(MARKER_END, start + len(MARKER))
+        if end < 0:
+            return
+        now = time.perf_counter_ns()
+        sender, _, sent_ns = line[start + len(MARKER):end].split(b':')
+        if int(sender) == self.index:
+            return  # server_v3 devuelve el mensaje también al emisor
+        stats = self.stats
+        if stats.measuring:
+            stats.delivered += 1
+            stats.latencies.append(now - int(sent_ns))
+
+    async def expect(self, ok, failures, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            line = await asyncio.wait_for(self.inbox.get(), remaining)
+            if line is None:
+                raise HandshakeFailed('conexión cerrada por el servidor')
+            text = line.decode('utf-8', 'replace')
+            if ok in text:
+                return
+            for failure in failures:
+                if failure in text:
+                    raise HandshakeFailed(text.strip())
+
+    async def handshake(self, timeout):
+        self.send(self.hello_line())
+        if self.protocol == 'json':
+            await self.expect(f'Bienvenido {self.name}', ('Nombre de usuario',), timeout)
+        else:
+            await self.expect(f'Bienvenido {self.name}', ('Nombre inválido', 'Nombre en uso'), timeout)
+        if self.room == 'global':
+            return
+        self.send(self.join_line())
+        if self.protocol == 'json':
+            await self.expect('join_room_ok', ('join_room_failed',), timeout)
+        else:
+            await self.expect(f"Te has unido a la sala '{self.room}'", ('Contraseña incorrecta',), timeout)
+
+
+class DatagramClient(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        for line in data.split(b'\n'):
+            if line:
+                self.client.on_line(line)
+
+
+async def connect_client(client, host, port, gate, timeout, connect_times, failures):
+    async with gate:
+        started = time.perf_counter_ns()
+        try:
+            await asyncio.wait_for(client.open(host, port), timeout)
+            await client.handshake(timeout)
+        except (OSError, asyncio.TimeoutError, HandshakeFailed) as exc:
+            failures.append(f'{type(exc).__name__}: {exc}')
+            client.close()
+            return False
+        connect_times.append(time.perf_counter_ns() - started)
+        client.ready = True
+        return True
+
+
+async def measure_loop_lag(samples, interval=0.01):
+    while True:
+        started = time.perf_counter_ns()
+        await asyncio.sleep(interval)
+        samples.append(max(0, time.perf_counter_ns() - started - int(interval * 1e9)))
+
+
+async def drive(senders, room_sizes, stats, rate, duration, payload, write_limit):
+    """Envía ``rate`` mensajes por segundo, rotando entre los emisores."""
+    padding = 'x' * max(0, payload)
+    started = time.perf_counter()
+    next_sender = 0
+    seq = 0
+    while True:
+        elapsed = time.perf_counter() - started
+        if elapsed >= duration:
+            return elapsed
+        due = int(elapsed * rate) - seq
+        for _ in range(due):
+            client = senders[next_sender]
+            next_sender = (next_sender + 1) % len(senders)
+            seq += 1
+            if client.backlogged(write_limit):
+                stats.skipped += 1
+                continue
+            text = f'~lg:{client.index}:{seq}:{time.perf_counter_ns()}~ {padding}'.rstrip()
+            client.send(client.message_line(text))
+            stats.sent += 1
+            stats.expected += room_sizes[client.room] - 1
+        await asyncio.sleep(0.002)
+
+
+async def run(args):
+    nofile = raise_nofile_limit()
+    if args.clients + 64 > nofile:
+        print(f'Aviso: límite de descriptores {nofile} menor que los clientes pedidos', file=sys.stderr)
+    stats = Stats()
+    prefix = args.prefix or f'lg{os.getpid() % 10000}x'
+    clients = []
+    for i in range(args.clients):
+        room = f'{args.room_prefix}{i % args.rooms}' if args.rooms else 'global'
+        clients.append(LoadClient(i, f'{prefix}{i}', room, args.protocol, stats))
+
+    lag_samples = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag_samples))
+    gate = asyncio.Semaphore(args.connect_concurrency)
+    connect_times = []
+    failures = []
+    connect_started = time.perf_counter()
+    results = await asyncio.gather(
+        *(connect_client(c, args.host, args.port, gate, args.connect_timeout, connect_times, failures)
+          for c in clients)
+    )
+    connect_secs = time.perf_counter() - connect_started
+    connected = [c for c, ok in zip(clients, results) if ok]
+
+    room_sizes = {}
+    for client in connected:
+        room_sizes[client.room] = room_sizes.get(client.room, 0) + 1
+    senders = connected[:args.senders] if args.senders else connected
+
+    result = {
+        'label': args.label,
+        'protocol': args.protocol,
+        'host': args.host,
+        'port': args.port,
+        'clients': args.clients,
+        'rooms': args.rooms,
+        'target_rate': args.rate,
+        'duration': args.duration,
+        'payload_bytes': args.payload,
+        'connected': len(connected),
+        'connect_failed': len(failures),
+        'connect_secs': round(connect_secs, 3),
+        'connect_ms': summarize_ms(connect_times),
+    }
+    if failures:
+        result['connect_errors'] = sorted(set(failures))[:5]
+
+    try:
+        if senders:
+            await asyncio.sleep(args.settle)
+            lag_samples.clear()
+            stats.measuring = True
+            elapsed = await drive(senders, room_sizes, stats, args.rate, args.duration, args.payload, args.write_limit)
+            await asyncio.sleep(args.drain)
+            stats.measuring = False
+            result.update(
+                sent=stats.sent,
+                skipped_backpressure=stats.skipped,
+                sent_per_sec=round(stats.sent / elapsed, 1),
+                expected_deliveries=stats.expected,
+                delivered=stats.delivered,
+                delivered_per_sec=round(stats.delivered / elapsed, 1),
+                delivery_ratio=round(stats.delivered / stats.expected, 4) if stats.expected else None,
+                latency_ms=summarize_ms(stats.latencies),
+                loop_lag_ms=summarize_ms(lag_samples),
+            )
+    finally:
+        lag_task.cancel()
+        for client in clients:
+            client.close()
+        await asyncio.sleep(0.1)
+        for client in clients:
+            if client.reader_task is not None:
+                client.reader_task.cancel()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generador de carga y latencia de difusión.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=55555)
+    parser.add_argument('--protocol', choices=PROTOCOLS, default='client_v5')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=20, help="Cantidad de salas (0 = todos en 'global').")
+    parser.add_argument('--room-prefix', default='lg_')
+    parser.add_argument('--prefix', help='Prefijo de los nombres de usuario (por defecto depende del pid).')
+    parser.add_argument('--senders', type=int, default=0, help='Clientes que envían (0 = todos).')
+    parser.add_argument('--rate', type=float, default=1000.0, help='Mensajes por segundo en total.')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--payload', type=int, default=0, help='Bytes de relleno por mensaje.')
+    parser.add_argument('--settle', type=float, default=2.0, help='Espera tras conectar antes de medir.')
+    parser.add_argument('--drain', type=float, default=2.0, help='Espera tras enviar para recibir lo pendiente.')
+    parser.add_argument('--connect-concurrency', type=int, default=200)
+    parser.add_argument('--connect-timeout', type=float, default=10.0)
+    parser.add_argument(
+        '--write-limit', type=int, default=256 * 1024,
+        help='Bytes pendientes de escritura por cliente a partir de los que se saltea un envío.',
+    )
+    parser.add_argument('--label', default='', help='Etiqueta libre para identificar la corrida.')
+    parser.add_argument('--output', help='Agregar el resultado (una línea JSON) a este archivo.')
+    args = parser.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    line = json.dumps(result, ensure_ascii=False)
+    print(line, flush=True)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Logging asíncrono de server_v5: los hilos de sockets sólo encolan.
+
+``install`` reemplaza los handlers del logger raíz (los de basicConfig) por un
+DroppingQueueHandler y los pasa a un QueueListener que corre en su propio
+hilo. Así formatear y escribir en stderr (o en archivos) nunca bloquea a un
+hilo de conexión ni al event loop; si la cola se llena, los registros se
+descartan y se cuentan en vez de esperar.
+
+WarningAggregator junta avisos repetidos: el primero de cada clave sale
+enseguida y los siguientes dentro de la ventana se resumen en una sola línea
+("N fallos de envío a X en el último segundo").
+
+Con ``lifecycle_path`` se agrega un archivo JSONL con un objeto por evento de
+conexión (conexión, registro, rechazo, desconexión), pensado para procesarlo
+con herramientas y no para leerlo.
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LIFECYCLE_LOGGER = 'server_v5.lifecycle'
+WINDOW = 1.0  # segundos entre resúmenes de avisos repetidos
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que no bloquea ni formatea en el hilo que loguea."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # El formateo queda para el hilo del listener: el registro viaja con
+        # sus args (en el servidor son cadenas y tuplas, no cambian después).
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class ExcludeLifecycle(logging.Filter):
+    """Para los handlers comunes: los eventos del ciclo de vida van sólo al JSONL."""
+
+    def filter(self, record):
+        return not record.name.startswith(LIFECYCLE_LOGGER)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """``record.msg`` es el nombre del evento y ``record.fields`` sus datos."""
+
+    def format(self, record):
+        event = {'ts': round(record.created, 3), 'pid': record.process, 'event': record.msg}
+        event.update(getattr(record, 'fields', {}))
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+class WarningAggregator:
+    """Avisos repetitivos por clave (p. ej. el usuario al que falla un envío)."""
+
+    def __init__(self, logger, first, summary):
+        self.logger = logger
+        self.first = first  # formato con (clave, detalle)
+        self.summary = summary  # formato con (repeticiones, clave, último detalle)
+        self.lock = threading.Lock()
+        self.pending = {}  # clave -> [repeticiones, último detalle]
+        _register_flush(self)
+
+    def warning(self, key, detail):
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is not None:
+                entry[0] += 1
+                entry[1] = detail
+                return
+            self.pending[key] = [0, detail]
+        self.logger.warning(self.first, key, detail)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for key, (repeats, detail) in pending.items():
+            if repeats:
+                self.logger.warning(self.summary, repeats, key, detail)
+
+
+_pending_flush = []
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def _flush_loop():
+    while True:
+        time.sleep(WINDOW)
+        for item in list(_pending_flush):
+            item.flush()
+
+
+def _register_flush(item):
+    """Agrega ``item.flush`` al hilo que corre cada WINDOW segundos."""
+    global _flusher
+    with _flusher_lock:
+        _pending_flush.append(item)
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name='log-aggregator', daemon=True)
+            _flusher.start()
+
+
+class LogPipeline:
+    def __init__(self, handler, listener):
+        self.handler = handler
+        self.listener = listener
+        self.reported = 0
+        _register_flush(self)
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    def flush(self):
+        dropped = self.handler.dropped
+        if dropped != self.reported:
+            logging.getLogger(__name__).warning(
+                'Cola de logging llena: %d registros descartados', dropped - self.reported
+            )
+            self.reported = dropped
+
+    def stop(self):
+        """Vacía la cola (lo que quedó se escribe) y detiene el listener."""
+        self.listener.stop()
+
+
+def install(queue_size=10000, lifecycle_path=None):
+    """Con ``queue_size`` 0 los handlers siguen siendo síncronos (sólo se
+    agrega el archivo de eventos). Devuelve el LogPipeline o None."""
+    root = logging.getLogger()
+    targets = list(root.handlers)
+    lifecycle = logging.getLogger(LIFECYCLE_LOGGER)
+    lifecycle.propagate = False
+    lifecycle.setLevel(logging.INFO)
+    if lifecycle_path:
+        # el logger de eventos no propaga: sólo llega a este archivo (en
+        # modo cola comparte el listener, así que los demás destinos lo filtran)
+        sink = logging.FileHandler(lifecycle_path, encoding='utf-8')
+        sink.setFormatter(JsonLinesFormatter())
+        sink.addFilter(logging.Filter(LIFECYCLE_LOGGER))
+        if queue_size <= 0:
+            lifecycle.addHandler(sink)
+            return None
+        for target in targets:
+            target.addFilter(ExcludeLifecycle())
+        targets.append(sink)
+    elif queue_size <= 0:
+        return None
+    log_queue = queue.Queue(queue_size)
+    handler = DroppingQueueHandler(log_queue)
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    if lifecycle_path:
+        lifecycle.addHandler(handler)
+    listener = logging.handlers.QueueListener(log_queue, *targets, respect_handler_level=True)
+    listener.start()
+    return LogPipeline(handler, listener)
@@ -0,0 +1,205 @@
+"""Log durable y de solo-agregar de lo que difunde server_v5 (``--log-dir``).
+
+Formato en disco:
+ - Segmentos ``<primer_seq>.log`` con un objeto JSON por línea:
+   ``{"seq": N, "ts": epoch, "room": ..., "type": "msg"|"system", ...}``.
+ - Junto a cada segmento, un índice disperso ``<primer_seq>.idx`` con una
+   entrada ``struct('>QQ')`` (seq, offset en bytes) cada INDEX_INTERVAL bytes
+   escritos, para buscar un seq sin leer el segmento entero.
+
+Escritura con group commit: ``append`` sólo asigna el número de secuencia y
+encola (nunca toca el disco desde el hilo del socket); un hilo escritor junta
+lo pendiente cada ``commit_interval`` segundos, lo escribe de una vez y hace
+un único fsync por lote. Un segmento rota al pasar ``segment_bytes`` y los
+más viejos se borran según ``retention_bytes`` / ``retention_secs``.
+"""
+
+import collections
+import json
+import logging
+import os
+import struct
+import threading
+import time
+
+LOGGER = logging.getLogger('server_v5.log')
+
+INDEX_ENTRY = struct.Struct('>QQ')
+INDEX_INTERVAL = 4096  # bytes de segmento entre entradas del índice
+SEGMENT_DIGITS = 20
+
+
+def _segment_name(base_seq, suffix):
+    return f'{base_seq:0{SEGMENT_DIGITS}d}{suffix}'
+
+
+class MessageLog:
+    def __init__(
+        self,
+        directory,
+        segment_bytes=64 * 1024 * 1024,
+        retention_bytes=0,
+        retention_secs=0,
+        commit_interval=0.05,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_secs = retention_secs
+        self.commit_interval = commit_interval
+        os.makedirs(directory, exist_ok=True)
+        self.pending = collections.deque()
+        self.seq_lock = threading.Lock()
+        self.next_seq = self._recover_next_seq()
+        self.segment = None
+        self.index = None
+        self.segment_size = 0
+        self.last_indexed = None
+        self.stopping = threading.Event()
+        self.writer = threading.Thread(target=self._run, name='message-log', daemon=True)
+        self.writer.start()
+
+    # -- API usada por el servidor --------------------------------------
+
+    def append(self, room, obj):
+        """Encola ``obj`` (dict del mensaje) para la sala. Devuelve su seq."""
+        with self.seq_lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.pending.append((seq, time.time(), room, obj))
+        return seq
+
+    def close(self):
+        self.stopping.set()
+        self.writer.join()
+
+    # -- lectura ------------------------------------------------------------
+
+    def segments(self):
+        return sorted(
+            int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log') and name[:-4].isdigit()
+        )
+
+    def read_from(self, seq):
+        """Itera los registros (dicts) con número de secuencia >= ``seq``."""
+        bases = self.segments()
+        start = 0
+        for i, base in enumerate(bases):
+            if base <= seq:
+                start = i
+        for base in bases[start:]:
+            offset = self._index_lookup(base, seq)
+            with open(os.path.join(self.directory, _segment_name(base, '.log')), 'rb') as f:
+                f.seek(offset)
+                for raw in f:
+                    if not raw.endswith(b'\n'):
+                        break  # cola de un lote que no llegó a escribirse entero
+                    record = json.loads(raw)
+                    if record['seq'] >= seq:
+                        yield record
+
+    def _index_lookup(self, base, seq):
+        offset = 0
+        try:
+            with open(os.path.join(self.directory, _segment_name(base, '.idx')), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return 0
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        for entry_seq, entry_offset in INDEX_ENTRY.iter_unpack(data[:usable]):
+            if entry_seq > seq:
+                break
+            offset = entry_offset
+        return offset
+
+    # -- escritor -----------------------------------------------------------
+
+    def _recover_next_seq(self):
+        bases = self.segments()
+        if not bases:
+            return 1
+        last = 0
+        path = os.path.join(self.directory, _segment_name(bases[-1], '.log'))
+        with open(path, 'rb') as f:
+            for raw in f:
+                if raw.endswith(b'\n'):
+                    last = json.loads(raw)['seq']
+        return max(last + 1, bases[-1])
+
+    def _run(self):
+        while not self.stopping.wait(self.commit_interval):
+            self._commit()
+        self._commit()
+        if self.segment:
+            self.segment.close()
+            self.index.close()
+
+    def _commit(self):
+        if not self.pending:
+            return
+        batch = []
+        while self.pending:
+            batch.append(self.pending.popleft())
+        try:
+            self._write_batch(batch)
+        except OSError as exc:
+            LOGGER.error('No se pudo escribir el log de mensajes (%d registros): %s', len(batch), exc)
+
+    def _write_batch(self, batch):
+        chunks = []
+        for seq, ts, room, obj in batch:
+            if self.segment is None or self.segment_size >= self.segment_bytes:
+                self._flush_chunks(chunks)
+                chunks = []
+                self._rotate(seq)
+            record = dict(obj, seq=seq, ts=round(ts, 3), room=room)
+            data = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+            if self.last_indexed is None or self.segment_size - self.last_indexed >= INDEX_INTERVAL:
+                self.index.write(INDEX_ENTRY.pack(seq, self.segment_size))
+                self.last_indexed = self.segment_size
+            chunks.append(data)
+            self.segment_size += len(data)
+        self._flush_chunks(chunks)
+        self.index.flush()
+        os.fsync(self.segment.fileno())
+
+    def _flush_chunks(self, chunks):
+        if chunks:
+            self.segment.write(b''.join(chunks))
+            self.segment.flush()
+
+    def _rotate(self, base_seq):
+        if self.segment is not None:
+            os.fsync(self.segment.fileno())
+            self.segment.close()
+            self.index.flush()
+            os.fsync(self.index.fileno())
+            self.index.close()
+        self.segment = open(os.path.join(self.directory, _segment_name(base_seq, '.log')), 'ab')
+        self.index = open(os.path.join(self.directory, _segment_name(base_seq, '.idx')), 'ab')
+        self.segment_size = self.segment.tell()
+        self.last_indexed = None
+        self._apply_retention(base_seq)
+
+    def _apply_retention(self, current_base):
+        if not self.retention_bytes and not self.retention_secs:
+            return
+        now = time.time()
+        old = [base for base in self.segments() if base != current_base]
+        sizes = {}
+        for base in old:
+            sizes[base] = os.path.getsize(os.path.join(self.directory, _segment_name(base, '.log')))
+        total = sum(sizes.values())
+        for base in old:  # del más viejo al más nuevo
+            path = os.path.join(self.directory, _segment_name(base, '.log'))
+            too_big = self.retention_bytes and total > self.retention_bytes
+            too_old = self.retention_secs and now - os.path.getmtime(path) > self.retention_secs
+            if not (too_big or too_old):
+                break
+            for suffix in ('.log', '.idx'):
+                try:
+                    os.unlink(os.path.join(self.directory, _segment_name(base, suffix)))
+                except OSError:
+                    pass
+            total -= sizes[base]
+            LOGGER.info('Segmento de log %d eliminado por retención', base)
@@ -0,0 +1,207 @@
+"""Métricas de server_v5: contadores, histogramas y gauges en formato Prometheus.
+
+Actualizar una métrica tiene que costar casi nada porque se hace en el camino
+caliente (cada mensaje, cada difusión, cada envío). Por eso no hay locks al
+actualizar: cada hilo suma en su propia celda (un dict indexado por el id del
+hilo, que sólo escribe ese hilo) y las celdas se suman recién al leer. Los
+gauges no se actualizan nunca: son funciones que se evalúan al exportar.
+
+``render()`` devuelve el formato de texto de Prometheus; ``serve_admin``
+lo publica en ``GET /metrics`` desde un puerto local aparte.
+"""
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_get_ident = threading.get_ident
+
+# segundos: de 50 µs a 5 s
+DURATION_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Counter:
+    __slots__ = ('_cells',)
+
+    def __init__(self):
+        self._cells = {}
+
+    def inc(self, amount=1):
+        cells = self._cells
+        ident = _get_ident()
+        cells[ident] = cells.get(ident, 0) + amount
+
+    def value(self):
+        return sum(list(self._cells.values()))
+
+
+class Histogram:
+    """Buckets fijos; cada celda es ``[cuenta por bucket..., +Inf, suma]``."""
+
+    __slots__ = ('bounds', '_cells')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self._cells = {}
+
+    def observe(self, value):
+        ident = _get_ident()
+        cell = self._cells.get(ident)
+        if cell is None:
+            cell = self._cells[ident] = [0] * (len(self.bounds) + 2)
+        cell[bisect.bisect_left(self.bounds, value)] += 1
+        cell[-1] += value
+
+    def snapshot(self):
+        """Devuelve (cuentas por bucket sin acumular, suma)."""
+        totals = [0] * (len(self.bounds) + 2)
+        for cell in list(self._cells.values()):
+            for i, v in enumerate(cell):
+                totals[i] += v
+        return totals[:-1], totals[-1]
+
+    def quantile(self, q):
+        """Cota superior del bucket donde cae el cuantil ``q`` (None si vacío)."""
+        counts, _ = self.snapshot()
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Family:
+    """Una métrica con nombre, ayuda y (opcionalmente) una etiqueta."""
+
+    def __init__(self, kind, name, help_text, label=None, factory=None, fn=None):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.factory = factory
+        self.fn = fn
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, value):
+        child = self.children.get(value)
+        if child is None:
+            with self.lock:
+                child = self.children.get(value)
+                if child is None:
+                    child = self.children[value] = self.factory()
+        return child
+
+    # sin etiqueta, la familia se usa directamente como su único hijo
+    def inc(self, amount=1):
+        self.labels(None).inc(amount)
+
+    def observe(self, value):
+        self.labels(None).observe(value)
+
+    def value(self):
+        return self.labels(None).value()
+
+    def quantile(self, q):
+        return self.labels(None).quantile(q)
+
+
+REGISTRY = []
+
+
+def counter(name, help_text, label=None):
+    family = Family('counter', name, help_text, label, Counter)
+    REGISTRY.append(family)
+    return family
+
+
+def histogram(name, help_text, buckets=DURATION_BUCKETS, label=None):
+    family = Family('histogram', name, help_text, label, lambda: Histogram(buckets))
+    REGISTRY.append(family)
+    return family
+
+
+def gauge(name, help_text, fn, label=None):
+    """``fn()`` devuelve un número o, con ``label``, un dict valor -> número."""
+    family = Family('gauge', name, help_text, label, fn=fn)
+    REGISTRY.append(family)
+    return family
+
+
+def _labels(family, value, extra=''):
+    parts = []
+    if family.label is not None and value is not None:
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{family.label}="{escaped}"')
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render():
+    lines = []
+    for family in REGISTRY:
+        lines.append(f'# HELP {family.name} {family.help}')
+        lines.append(f'# TYPE {family.name} {family.kind}')
+        if family.kind == 'gauge':
+            try:
+                result = family.fn()
+            except Exception:
+                continue
+            items = result.items() if family.label is not None else [(None, result)]
+            for value, number in items:
+                lines.append(f'{family.name}{_labels(family, value)} {_number(number)}')
+            continue
+        for value, child in sorted(family.children.items(), key=lambda kv: str(kv[0])):
+            if family.kind == 'counter':
+                lines.append(f'{family.name}_total{_labels(family, value)} {_number(child.value())}')
+                continue
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(child.bounds + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f'{family.name}_bucket{_labels(family, value, le)} {cumulative}')
+            lines.append(f'{family.name}_sum{_labels(family, value)} {_number(total)}')
+            lines.append(f'{family.name}_count{_labels(family, value)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+class _AdminHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_admin(host, port):
+    """Publica ``/metrics`` en un hilo aparte. Devuelve el servidor HTTP."""
+    server = ThreadingHTTPServer((host, port), _AdminHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-admin', daemon=True).start()
+    return server
@@ -0,0 +1,87 @@
+"""Perfilado por muestreo del servidor en marcha, a pedido.
+
+Mientras no hay un perfil en curso no corre nada: ni hilos ni hooks de
+trazado. ``start`` lanza un hilo que durante ``duration`` segundos toma cada
+``interval`` segundos la pila de todos los hilos con ``sys._current_frames()``
+y, al terminar, escribe las pilas en formato "collapsed" (una línea
+``hilo;función (archivo:línea);... cuenta``), el que aceptan flamegraph.pl,
+speedscope o inferno.
+
+Muestrear no cambia el comportamiento de los hilos perfilados (a diferencia
+de cProfile), aunque el hilo muestreador compite por el GIL: con intervalos
+de milisegundos el costo es chico pero no nulo mientras dura el perfil.
+"""
+
+import collections
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+LOGGER = logging.getLogger('server_v5.profiler')
+
+MAX_DURATION = 300.0
+_THREAD_NUMBER = re.compile(r'^Thread-\d+ ')
+
+
+def _frame_label(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def _thread_label(thread):
+    # "Thread-12 (handle_client)" -> "(handle_client)": un stack por función,
+    # no uno por conexión
+    return _THREAD_NUMBER.sub('', thread.name) if thread else 'desconocido'
+
+
+class SamplingProfiler:
+    def __init__(self, directory, interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = None  # ruta del perfil en curso
+
+    def start(self, duration):
+        """Empieza un perfil. Devuelve la ruta destino o None si ya hay uno."""
+        duration = min(max(duration, self.interval), MAX_DURATION)
+        with self.lock:
+            if self.running:
+                return None
+            stamp = time.strftime('%Y%m%d-%H%M%S')
+            path = os.path.join(self.directory, f'server_v5-{os.getpid()}-{stamp}.folded')
+            self.running = path
+        threading.Thread(target=self._run, args=(path, duration), name='profiler', daemon=True).start()
+        return path
+
+    def _run(self, path, duration):
+        stacks = collections.Counter()
+        own = threading.get_ident()
+        samples = 0
+        deadline = time.monotonic() + duration
+        try:
+            while time.monotonic() < deadline:
+                threads = {t.ident: t for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    names = []
+                    while frame is not None:
+                        names.append(_frame_label(frame.f_code))
+                        frame = frame.f_back
+                    names.append(_thread_label(threads.get(ident)))
+                    names.reverse()
+                    stacks[';'.join(names)] += 1
+                samples += 1
+                time.sleep(self.interval)
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            LOGGER.info('Perfil escrito en %s (%d muestras, %d pilas distintas)', path, samples, len(stacks))
+        except OSError as exc:
+            LOGGER.error('No se pudo escribir el perfil %s: %s', path, exc)
+        finally:
+            with self.lock:
+                self.running = None
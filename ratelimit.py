@@ -0,0 +1,84 @@
+"""Token buckets por clave para limitar la difusión de mensajes.
+
+Cada ámbito (``user``, ``room``, ``ip``...) tiene una tasa (tokens por
+segundo) y una ráfaga (capacidad del bucket); cada clave del ámbito tiene su
+propio bucket, creado lleno la primera vez que aparece. Los buckets se
+rellenan de forma perezosa al consultarlos, así que no hay hilos ni
+temporizadores.
+
+``acquire`` mira todos los ámbitos de un mensaje a la vez y sólo consume si
+alcanza en todos: un mensaje rechazado o demorado por la sala no le gasta
+tokens al usuario.
+"""
+
+import threading
+import time
+
+PRUNE_EVERY = 4096  # buckets nuevos entre barridas de los que ya están llenos
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'stamp')
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp
+
+
+class RateLimits:
+    def __init__(self):
+        self.scopes = {}  # ámbito -> (tasa, ráfaga, {clave: TokenBucket})
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        return bool(self.scopes)
+
+    def configure(self, scope, rate, burst=None):
+        """``rate`` 0 desactiva el ámbito; la ráfaga por defecto es ``rate``."""
+        if rate <= 0:
+            self.scopes.pop(scope, None)
+            return
+        self.scopes[scope] = (rate, max(burst or rate, 1), {})
+
+    def acquire(self, keys, now=None, cost=1):
+        """``keys``: dict ámbito -> clave (los ámbitos no configurados se
+        ignoran). Devuelve ``(0, None)`` y consume si hay tokens en todos; si
+        no, ``(segundos de espera, ámbito que limita)`` sin consumir nada."""
+        if now is None:
+            now = time.monotonic()
+        wait, limiting = 0.0, None
+        with self.lock:
+            buckets = []
+            for scope, key in keys.items():
+                config = self.scopes.get(scope)
+                if config is None or key is None:
+                    continue
+                rate, burst, table = config
+                bucket = table.get(key)
+                if bucket is None:
+                    bucket = table[key] = TokenBucket(burst, now)
+                    self.created += 1
+                else:
+                    bucket.tokens = min(burst, bucket.tokens + (now - bucket.stamp) * rate)
+                    bucket.stamp = now
+                if bucket.tokens < cost:
+                    missing = (cost - bucket.tokens) / rate
+                    if missing > wait:
+                        wait, limiting = missing, scope
+                buckets.append(bucket)
+            if limiting is None:
+                for bucket in buckets:
+                    bucket.tokens -= cost
+            if self.created >= PRUNE_EVERY:
+                self._prune(now)
+        return wait, limiting
+
+    def _prune(self, now):
+        # un bucket que ya se rellenó del todo equivale a uno nuevo
+        self.created = 0
+        for rate, burst, table in self.scopes.values():
+            full = [key for key, b in table.items() if b.tokens + (now - b.stamp) * rate >= burst]
+            for key in full:
+                del table[key]
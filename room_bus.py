@@ -0,0 +1,256 @@
+"""Bus local entre procesos worker de server_v5 (modo ``--workers N``).
+
+Con ``--workers N`` el proceso supervisor lanza N workers que escuchan en el
+mismo puerto con SO_REUSEPORT (el kernel reparte las conexiones) y levanta un
+RoomBusHub en un socket Unix. Cada worker se conecta con un RoomBusClient.
+
+El hub es la única autoridad para lo que tiene que ser global:
+ - nombres de usuario (``claim``/``release``), para que register_client
+   rechace un nombre en uso en cualquier worker;
+ - presencia: cada alta o baja lleva una versión global y se anuncia a
+   todos los workers (``presence``); un worker que se conecta recibe primero
+   el estado completo (``presence_sync``). Así cada worker tiene una réplica
+   local y /listar no consulta al hub;
+ - contraseña de cada sala (``room``): la primera creación gana en todos los
+   workers;
+ - difusión: ``publish`` se reenvía como ``deliver`` a los demás workers, que
+   lo entregan a sus miembros locales.
+
+Protocolo: un objeto JSON por línea (mismo framing que los clientes). Las
+peticiones que esperan respuesta llevan ``req`` y el hub contesta con
+``{"op": "reply", "req": ..., ...}``.
+"""
+
+import itertools
+import json
+import logging
+import os
+import selectors
+import socket
+import threading
+
+from framing import LineFramer, LineTooLong
+
+LOGGER = logging.getLogger('server_v5.bus')
+
+BUS_MAX_LINE = 1024 * 1024
+REQUEST_TIMEOUT = 5.0
+
+
+def _encode(obj):
+    return (json.dumps(obj, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+class RoomBusHub(threading.Thread):
+    """Hub del bus: corre como hilo en el proceso supervisor."""
+
+    def __init__(self, path):
+        super().__init__(name='room-bus-hub', daemon=True)
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(64)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ, None)
+        self.workers = {}  # socket -> LineFramer
+        self.owners = {}  # username -> socket del worker que lo registró
+        self.room_passwords = {}  # sala -> contraseña (None = pública)
+        self.presence_version = 0
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    sock, _ = self.listener.accept()
+                    self.workers[sock] = LineFramer(BUS_MAX_LINE)
+                    self.selector.register(sock, selectors.EVENT_READ, sock)
+                    self._send(
+                        sock,
+                        {'op': 'presence_sync', 'users': list(self.owners), 'version': self.presence_version},
+                    )
+                else:
+                    self._on_readable(key.data)
+
+    def _on_readable(self, sock):
+        try:
+            data = sock.recv(65536)
+        except OSError:
+            data = b''
+        try:
+            lines = self.workers[sock].feed(data) if data else None
+        except LineTooLong:
+            lines = None
+        if lines is None:
+            self._drop_worker(sock)
+            return
+        for line in lines:
+            if sock not in self.workers:
+                return  # se descartó mientras se atendían sus líneas
+            try:
+                self._handle(sock, json.loads(line))
+            except (ValueError, KeyError) as exc:
+                LOGGER.warning('Mensaje de bus inválido: %s', exc)
+            except OSError as exc:
+                LOGGER.warning('Error de socket en el bus: %s', exc)
+                self._drop_worker(sock)
+
+    def _drop_worker(self, sock):
+        if self.workers.pop(sock, None) is None:
+            return
+        self.selector.unregister(sock)
+        orphans = [user for user, owner in self.owners.items() if owner is sock]
+        for user in orphans:
+            del self.owners[user]
+        LOGGER.warning('Worker desconectado del bus; liberados %d usuarios', len(orphans))
+        sock.close()
+        for user in orphans:
+            self._presence('leave', user)
+
+    def _send(self, sock, obj):
+        try:
+            sock.sendall(_encode(obj))
+        except OSError:
+            self._drop_worker(sock)
+
+    def _fanout(self, data, skip=None):
+        """Manda ``data`` a todos los workers salvo ``skip``. Los que fallan se
+        descartan recién al terminar: así el ``leave`` de sus usuarios no se
+        adelanta a lo que todavía falta repartir."""
+        dead = []
+        for sock in list(self.workers):
+            if sock is skip:
+                continue
+            try:
+                sock.sendall(data)
+            except OSError:
+                dead.append(sock)
+        for sock in dead:
+            self._drop_worker(sock)
+
+    def _presence(self, event, user):
+        self.presence_version += 1
+        self._fanout(_encode({'op': 'presence', 'event': event, 'user': user, 'version': self.presence_version}))
+
+    def _reply(self, sock, req, **fields):
+        fields['op'] = 'reply'
+        fields['req'] = req
+        self._send(sock, fields)
+
+    def _handle(self, sock, msg):
+        if sock not in self.workers:
+            return  # worker descartado: no se le registra nada más
+        op = msg['op']
+        if op == 'publish':
+            self._fanout(_encode(dict(msg, op='deliver')), skip=sock)
+        elif op == 'claim':
+            user = msg['user']
+            ok = user not in self.owners
+            self._reply(sock, msg['req'], ok=ok)
+            if ok and sock in self.workers:  # si la respuesta falló, se descartó
+                self.owners[user] = sock
+                self._presence('join', user)
+        elif op == 'release':
+            if self.owners.get(msg['user']) is sock:
+                del self.owners[msg['user']]
+                self._presence('leave', msg['user'])
+        elif op == 'room':
+            password = self.room_passwords.setdefault(msg['room'], msg.get('password') or None)
+            self._reply(sock, msg['req'], password=password)
+        else:
+            LOGGER.warning('Operación de bus desconocida: %s', op)
+
+
+class RoomBusClient:
+    """Extremo de un worker. Las peticiones bloquean hasta la respuesta del
+    hub, salvo que se pase ``callback``: entonces vuelven enseguida y la
+    respuesta se entrega como las difusiones remotas a ``on_deliver``, desde
+    el hilo lector o a través de ``dispatch`` si el motor necesita otro hilo
+    (el event loop nunca espera al bus). Lo mismo con los cambios de
+    presencia a ``presence.reset`` / ``presence.apply``."""
+
+    def __init__(self, path, on_deliver, dispatch=None, presence=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.on_deliver = on_deliver
+        self.dispatch = dispatch
+        self.presence = presence
+        self.send_lock = threading.Lock()
+        self.pending = {}  # req -> [threading.Event, respuesta] o callback
+        self.req_ids = itertools.count(1)
+        self.reader = threading.Thread(target=self._read_loop, name='room-bus-reader', daemon=True)
+        self.reader.start()
+
+    def _send(self, obj):
+        data = _encode(obj)
+        with self.send_lock:
+            self.sock.sendall(data)
+
+    def _request(self, obj, callback=None):
+        req = next(self.req_ids)
+        obj['req'] = req
+        if callback is not None:
+            self.pending[req] = callback
+            self._send(obj)
+            return None
+        slot = [threading.Event(), None]
+        self.pending[req] = slot
+        try:
+            self._send(obj)
+            if not slot[0].wait(REQUEST_TIMEOUT):
+                raise TimeoutError(f"El bus no respondió a '{obj['op']}'")
+            return slot[1]
+        finally:
+            self.pending.pop(req, None)
+
+    def _read_loop(self):
+        framer = LineFramer(BUS_MAX_LINE)
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                LOGGER.error('Conexión con el bus perdida')
+                os._exit(1)
+            for line in framer.feed(data):
+                msg = json.loads(line)
+                if msg['op'] == 'reply':
+                    slot = self.pending.pop(msg['req'], None)
+                    if callable(slot):
+                        self._call(slot, msg)
+                    elif slot:
+                        slot[1] = msg
+                        slot[0].set()
+                elif msg['op'] == 'deliver':
+                    self._call(self.on_deliver, msg['room'], msg.get('text'), msg.get('json'), msg.get('exclude'))
+                elif msg['op'] == 'presence' and self.presence is not None:
+                    self._call(self.presence.apply, msg['event'], msg['user'], msg['version'])
+                elif msg['op'] == 'presence_sync' and self.presence is not None:
+                    self._call(self.presence.reset, msg['users'], msg['version'])
+
+    def _call(self, fn, *args):
+        if self.dispatch:
+            self.dispatch(fn, *args)
+        else:
+            fn(*args)
+
+    def publish(self, room, text, json_obj, exclude):
+        self._send({'op': 'publish', 'room': room, 'text': text, 'json': json_obj, 'exclude': exclude})
+
+    def claim(self, username, callback=None):
+        request = {'op': 'claim', 'user': username}
+        if callback is not None:
+            return self._request(request, lambda reply: callback(reply['ok']))
+        return self._request(request)['ok']
+
+    def release(self, username):
+        self._send({'op': 'release', 'user': username})
+
+    def room_password(self, room, password, callback=None):
+        """Registra la sala si es nueva y devuelve su contraseña global."""
+        request = {'op': 'room', 'room': room, 'password': password}
+        if callback is not None:
+            return self._request(request, lambda reply: callback(reply['password']))
+        return self._request(request)['password']
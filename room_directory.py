@@ -0,0 +1,91 @@
+"""Índice de las salas públicas para ``/rooms``.
+
+Mantiene, al día con cada alta de sala y cada unión o salida:
+ - las salas públicas ordenadas por ``(nombre.lower(), nombre)`` en una lista
+   (alta con bisect.insort), así un listado por prefijo o desde un cursor es
+   una búsqueda binaria más un corte de ``limit`` elementos;
+ - la cantidad de miembros de cada una y, por cantidad, el conjunto de salas
+   que la tienen, para listar las más activas sin recorrer todas.
+
+Las salas con contraseña no entran: no se listan nunca.
+"""
+
+import bisect
+import heapq
+import threading
+
+
+def _key(name):
+    return (name.lower(), name)
+
+
+class RoomDirectory:
+    def __init__(self):
+        self.names = []  # [(nombre.lower(), nombre)] ordenada
+        self.counts = {}  # nombre -> miembros
+        self.by_count = {}  # miembros -> set(nombres); sin las salas vacías
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, password=None, members=0):
+        """Alta de una sala; las protegidas se ignoran."""
+        if password:
+            return
+        with self.lock:
+            if name in self.counts:
+                return
+            bisect.insort(self.names, _key(name))
+            self.counts[name] = 0
+            self._move(name, 0, members)
+
+    def update(self, name, members):
+        """Nueva cantidad de miembros de ``name`` (llamar con el lock de la sala)."""
+        with self.lock:
+            old = self.counts.get(name)
+            if old is None or old == members:
+                return
+            self._move(name, old, members)
+
+    def _move(self, name, old, new):
+        if old:
+            bucket = self.by_count[old]
+            bucket.discard(name)
+            if not bucket:
+                del self.by_count[old]
+        if new:
+            self.by_count.setdefault(new, set()).add(name)
+        self.counts[name] = new
+
+    def page(self, prefix='', after=None, limit=100):
+        """Hasta ``limit`` salas ``(nombre, miembros)`` en orden alfabético
+        que empiezan con ``prefix`` y van después del cursor ``after`` (el
+        nombre de la última sala de la página anterior). Devuelve también el
+        cursor de la página siguiente, o None si no hay más."""
+        prefix = prefix.lower()
+        with self.lock:
+            start = bisect.bisect_left(self.names, (prefix,))
+            if after is not None:
+                start = max(start, bisect.bisect_right(self.names, _key(after)))
+            found = []
+            for lowered, name in self.names[start:start + limit + 1]:
+                if not lowered.startswith(prefix):
+                    break
+                found.append((name, self.counts[name]))
+        if len(found) > limit:
+            del found[limit:]
+            return found, found[-1][0]
+        return found, None
+
+    def most_active(self, limit=10):
+        """Las ``limit`` salas con más miembros (empates por nombre)."""
+        found = []
+        with self.lock:
+            for count in sorted(self.by_count, reverse=True):
+                needed = limit - len(found)
+                if needed <= 0:
+                    break
+                bucket = self.by_count[count]
+                found.extend((name, count) for name in heapq.nsmallest(needed, bucket, key=_key))
+        return found
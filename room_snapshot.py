@@ -0,0 +1,122 @@
+"""Instantáneas de las salas de server_v5 (``--snapshot-file``).
+
+Formato: texto UTF-8. La primera línea es una cabecera JSON
+``{"version": 1, "written": epoch, "rooms": N}`` y cada línea siguiente es un
+array JSON con hasta CHUNK_ROOMS salas ``[nombre, contraseña, miembros]``.
+Codificar de a tandas chicas acota cuánto retiene el GIL cada json.dumps (el
+hilo de la instantánea nunca frena el despacho más que eso) y cargarla son
+unos pocos json.loads.
+
+Se escribe en ``<ruta>.<pid>.tmp``, fsync, ``os.replace`` y fsync del
+directorio: tras un corte queda la instantánea anterior o la nueva, nunca una
+a medias.
+Un hilo la reescribe cada ``interval`` segundos sólo si cambió algo; ``close``
+escribe la última al apagar.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger('server_v5.snapshot')
+
+FORMAT_VERSION = 1
+CHUNK_ROOMS = 512  # salas por línea
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def encode(entries):
+    """Líneas (bytes) del cuerpo de la instantánea, sin la cabecera."""
+    return [
+        json.dumps(entries[start:start + CHUNK_ROOMS], ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        + b'\n'
+        for start in range(0, len(entries), CHUNK_ROOMS)
+    ]
+
+
+def write(path, body, count):
+    header = {'version': FORMAT_VERSION, 'written': time.time(), 'rooms': count}
+    tmp = f'{path}.{os.getpid()}.tmp'  # durante un traspaso escriben dos procesos
+    with open(tmp, 'wb') as f:
+        f.write(json.dumps(header, separators=(',', ':')).encode('utf-8') + b'\n')
+        f.writelines(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def load(path):
+    """Lista de ``[nombre, contraseña, miembros]``; vacía si no hay archivo."""
+    try:
+        with open(path, 'rb') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return []
+    try:
+        header = json.loads(lines[0])
+        if header.get('version') != FORMAT_VERSION:
+            raise SnapshotError(f"Versión de instantánea desconocida: {header.get('version')}")
+        entries = []
+        for line in lines[1:]:
+            entries.extend(json.loads(line))
+    except (IndexError, ValueError, AttributeError) as exc:
+        raise SnapshotError(f'Instantánea ilegible: {exc}') from exc
+    if len(entries) != header.get('rooms'):
+        raise SnapshotError(f"Instantánea incompleta: {len(entries)} de {header.get('rooms')} salas")
+    return entries
+
+
+class RoomSnapshots:
+    """Escribe ``collect()`` en ``path`` cada ``interval`` segundos si cambió."""
+
+    def __init__(self, path, collect, interval=30.0):
+        self.path = path
+        self.collect = collect
+        self.interval = interval
+        self.last = None  # cuerpo de la última escritura
+        self.lock = threading.Lock()  # el hilo y close no escriben a la vez
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='room-snapshot', daemon=True)
+
+    def start(self):
+        if self.interval > 0:
+            self.thread.start()
+
+    def save(self):
+        """Escribe si hay cambios; devuelve True si tocó el disco."""
+        with self.lock:
+            started = time.monotonic()
+            entries = self.collect()
+            body = encode(entries)
+            if body == self.last:
+                return False
+            write(self.path, body, len(entries))
+            self.last = body
+        LOGGER.debug('Instantánea de %d salas en %.1f ms', len(entries), (time.monotonic() - started) * 1000)
+        return True
+
+    def close(self):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        self._save_logged()
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            self._save_logged()
+
+    def _save_logged(self):
+        try:
+            self.save()
+        except OSError as exc:
+            LOGGER.warning('No se pudo escribir la instantánea %s: %s', self.path, exc)
@@ -3,24 +3,24 @@
 server.py
 Servidor de chat simple basado en sockets.
 Protocolo: JSON por línea (cada mensaje termina en '\n')
-Campos principales: type, user, text, time
+Campos principales: type, user, text, time, epoch_ms
 """
 
 import socket
 import threading
 import json
-import time
+
+from clock import epoch_ms, now_ts
+from framing import LineFramer, LineTooLong
 
 HOST = '0.0.0.0'  # escuchar en todas las interfaces
 PORT = 50000      # puerto (puedes cambiarlo)
+MAX_LINE_LENGTH = 64 * 1024  # bytes por línea; más largo se desconecta
 
 # Diccionario: username -> (conn, addr)
 clients = {}
 clients_lock = threading.Lock()
 
-def now_ts():
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-
 def send_json(conn, obj):
     try:
         data = (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
@@ -50,7 +50,7 @@ def broadcast(obj, exclude_conn=None):
                 pass
             clients.pop(u, None)
             # anunciar que el usuario se fue
-            broadcast({'type':'system', 'text': f'{u} se ha desconectado (forzado).', 'time': now_ts()})
+            broadcast({'type':'system', 'text': f'{u} se ha desconectado (forzado).', 'time': now_ts(), 'epoch_ms': epoch_ms()})
 
 def handle_client(conn, addr):
     """
@@ -58,30 +58,30 @@ def handle_client(conn, addr):
     Espera primer mensaje: join con {"type":"join","user":"nombre"}.
     Luego procesa mensajes.
     """
-    buf = ''
+    framer = LineFramer(MAX_LINE_LENGTH)
     username = None
     try:
         conn.settimeout(0.5)
         while True:
+            lines = []
             try:
                 data = conn.recv(4096)
                 if not data:
                     raise ConnectionResetError()
-                buf += data.decode('utf-8')
+                lines = framer.feed(data)
             except socket.timeout:
                 # permitimos timeouts para chequear shutdown / etc.
                 pass
             except ConnectionResetError:
                 raise
             # procesar líneas completas
-            while '\n' in buf:
-                line, buf = buf.split('\n', 1)
+            for line in lines:
                 if not line.strip():
                     continue
                 try:
                     msg = json.loads(line)
                 except json.JSONDecodeError:
-                    send_json(conn, {'type':'system', 'text':'Mensaje mal formado.' , 'time': now_ts()})
+                    send_json(conn, {'type':'system', 'text':'Mensaje mal formado.' , 'time': now_ts(), 'epoch_ms': epoch_ms()})
                     continue
 
                 mtype = msg.get('type')
@@ -89,37 +89,42 @@ def handle_client(conn, addr):
                     # registro
                     requested = msg.get('user', '').strip()
                     if not requested:
-                        send_json(conn, {'type':'system','text':'Nombre de usuario inválido.','time':now_ts()})
+                        send_json(conn, {'type':'system','text':'Nombre de usuario inválido.','time':now_ts(),'epoch_ms':epoch_ms()})
                         conn.close()
                         return
                     with clients_lock:
                         if requested in clients:
                             # usuario ya existe
-                            send_json(conn, {'type':'system','text':'Nombre de usuario en uso.','time':now_ts()})
+                            send_json(conn, {'type':'system','text':'Nombre de usuario en uso.','time':now_ts(),'epoch_ms':epoch_ms()})
                             conn.close()
                             return
                         username = requested
                         clients[username] = (conn, addr)
                         print(f"[SERVER] {username} se unió desde {addr}")
                     # confirmar y anunciar
-                    send_json(conn, {'type':'system','text':f'Bienvenido {username}!', 'time': now_ts()})
-                    broadcast({'type':'system','text':f'{username} se ha unido al chat.', 'time': now_ts()}, exclude_conn=conn)
+                    send_json(conn, {'type':'system','text':f'Bienvenido {username}!', 'time': now_ts(), 'epoch_ms': epoch_ms()})
+                    broadcast({'type':'system','text':f'{username} se ha unido al chat.', 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_conn=conn)
                 elif mtype == 'msg':
                     text = msg.get('text', '')
                     if text.startswith('/listar'):
                         # enviar lista de usuarios
                         with clients_lock:
                             lista = list(clients.keys())
-                        send_json(conn, {'type':'list_response','users': lista, 'time': now_ts()})
+                        send_json(conn, {'type':'list_response','users': lista, 'time': now_ts(), 'epoch_ms': epoch_ms()})
                     elif text.startswith('/quitar'):
                         # quitar cliente voluntariamente
-                        send_json(conn, {'type':'system','text':'Desconectando...','time': now_ts()})
+                        send_json(conn, {'type':'system','text':'Desconectando...','time': now_ts(), 'epoch_ms': epoch_ms()})
                         raise ConnectionResetError("cliente solicitó desconexión")
                     else:
                         # mensaje normal: re-enviar a todos
-                        broadcast({'type':'msg','user': username, 'text': text, 'time': now_ts()}, exclude_conn=None)
+                        broadcast({'type':'msg','user': username, 'text': text, 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_conn=None)
                 else:
-                    send_json(conn, {'type':'system','text':'Tipo de mensaje desconocido.','time': now_ts()})
+                    send_json(conn, {'type':'system','text':'Tipo de mensaje desconocido.','time': now_ts(), 'epoch_ms': epoch_ms()})
+    except LineTooLong:
+        try:
+            send_json(conn, {'type':'system','text':'Línea demasiado larga. Cerrando.','time':now_ts(),'epoch_ms':epoch_ms()})
+        except Exception:
+            pass
     except (ConnectionResetError, BrokenPipeError):
         # desconexión
         pass
@@ -136,7 +141,7 @@ def handle_client(conn, addr):
                         pass
                     clients.pop(username, None)
             print(f"[SERVER] {username} desconectado.")
-            broadcast({'type':'system','text':f'{username} se ha desconectado.', 'time': now_ts()})
+            broadcast({'type':'system','text':f'{username} se ha desconectado.', 'time': now_ts(), 'epoch_ms': epoch_ms()})
         else:
             try:
                 conn.close()
@@ -16,10 +16,13 @@ from datetime import datetime
 from pathlib import Path
 from shutil import disk_usage
 
+from framing import LineFramer, LineTooLong
+
 HOST = "0.0.0.0"
 PORT = 56000
 ENCODING = "utf-8"
 BUFFER_SIZE = 4096
+MAX_LINE_LENGTH = 4096
 
 
 class CommandError(Exception):
@@ -332,14 +335,17 @@ def handle_client(conn: socket.socket, addr) -> None:
         send_text(conn, WELCOME_TEXT)
         send_text(conn, "Para desconectarse utilice el comando 'quit'.")
         send_text(conn, PROMPT)
-        buffer = ""
+        framer = LineFramer(MAX_LINE_LENGTH, encoding=ENCODING, errors="ignore")
         while True:
             data = conn.recv(BUFFER_SIZE)
             if not data:
                 break
-            buffer += data.decode(ENCODING, errors="ignore")
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
+            try:
+                lines = framer.feed(data)
+            except LineTooLong:
+                send_text(conn, "Error: línea demasiado larga. Cerrando conexión.")
+                return
+            for line in lines:
                 command = line.strip().lower()
                 if not command:
                     send_text(conn, PROMPT)
@@ -8,17 +8,20 @@ Tipos principales:
  - leave_room: {'type':'leave_room','room': 'nombre'}
  - msg_room: {'type':'msg_room','room':'nombre','text':'...'}
  - list_rooms: {'type':'list_rooms'}
- - system messages: {'type':'system','text':..., 'time':...}
+ - system messages: {'type':'system','text':..., 'time':..., 'epoch_ms':...}
  - room_list_response: {'type':'room_list_response','rooms': {'room': [user,...], ...} }
 """
 
 import socket
 import threading
 import json
-import time
+
+from clock import epoch_ms, now_ts
+from framing import LineFramer, LineTooLong
 
 HOST = '0.0.0.0'
 PORT = 55555
+MAX_LINE_LENGTH = 64 * 1024  # bytes por línea; más largo se desconecta
 
 clients = {}        # username -> (conn, addr)
 clients_lock = threading.Lock()
@@ -27,9 +30,6 @@ rooms = {'global': set()}       # room_name -> set(usernames)
 user_rooms = {}                 # username -> set(room_name)
 rooms_lock = threading.Lock()
 
-def now_ts():
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-
 def send_json(conn, obj):
     data = (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
     conn.sendall(data)
@@ -54,40 +54,40 @@ def broadcast_room(room, obj, exclude_username=None):
                 pass
 
 def handle_client(conn, addr):
-    buf = ''
+    framer = LineFramer(MAX_LINE_LENGTH)
     username = None
     try:
         conn.settimeout(0.5)
         while True:
+            lines = []
             try:
                 data = conn.recv(4096)
                 if not data:
                     raise ConnectionResetError()
-                buf += data.decode('utf-8')
+                lines = framer.feed(data)
             except socket.timeout:
                 pass
             except ConnectionResetError:
                 raise
-            while '\n' in buf:
-                line, buf = buf.split('\n', 1)
+            for line in lines:
                 if not line.strip():
                     continue
                 try:
                     msg = json.loads(line)
                 except Exception:
-                    send_json(conn, {'type':'system','text':'Mensaje mal formado.','time': now_ts()})
+                    send_json(conn, {'type':'system','text':'Mensaje mal formado.','time': now_ts(), 'epoch_ms': epoch_ms()})
                     continue
 
                 mtype = msg.get('type')
                 if mtype == 'join':
                     requested = msg.get('user','').strip()
                     if not requested:
-                        send_json(conn, {'type':'system','text':'Nombre de usuario inválido.','time': now_ts()})
+                        send_json(conn, {'type':'system','text':'Nombre de usuario inválido.','time': now_ts(), 'epoch_ms': epoch_ms()})
                         conn.close()
                         return
                     with clients_lock:
                         if requested in clients:
-                            send_json(conn, {'type':'system','text':'Nombre de usuario en uso.','time': now_ts()})
+                            send_json(conn, {'type':'system','text':'Nombre de usuario en uso.','time': now_ts(), 'epoch_ms': epoch_ms()})
                             conn.close()
                             return
                         username = requested
@@ -97,62 +97,67 @@ def handle_client(conn, addr):
                         rooms.setdefault('global', set()).add(username)
                         user_rooms.setdefault(username, set()).add('global')
                     print(f"[SERVER] {username} conectado desde {addr}")
-                    send_json(conn, {'type':'system','text': f'Bienvenido {username}!', 'time': now_ts()})
+                    send_json(conn, {'type':'system','text': f'Bienvenido {username}!', 'time': now_ts(), 'epoch_ms': epoch_ms()})
                     # anunciar en global (excepto al que llega)
-                    broadcast_room('global', {'type':'system','text': f'{username} se ha unido al chat (global).', 'time': now_ts()}, exclude_username=username)
+                    broadcast_room('global', {'type':'system','text': f'{username} se ha unido al chat (global).', 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=username)
 
                 elif not username:
-                    send_json(conn, {'type':'system','text':'No estás registrado. Envía join primero.','time': now_ts()})
+                    send_json(conn, {'type':'system','text':'No estás registrado. Envía join primero.','time': now_ts(), 'epoch_ms': epoch_ms()})
                     conn.close()
                     return
 
                 elif mtype == 'join_room':
                     room = msg.get('room','').strip()
                     if not room:
-                        send_json(conn, {'type':'system','text':'Nombre de sala inválido.','time': now_ts()})
+                        send_json(conn, {'type':'system','text':'Nombre de sala inválido.','time': now_ts(), 'epoch_ms': epoch_ms()})
                         continue
                     with rooms_lock:
                         rooms.setdefault(room, set()).add(username)
                         user_rooms.setdefault(username, set()).add(room)
-                    send_json(conn, {'type':'system','text':f'Te has unido a la sala "{room}".','time': now_ts()})
-                    broadcast_room(room, {'type':'system','text':f'{username} se ha unido a la sala "{room}".','time': now_ts()}, exclude_username=username)
+                    send_json(conn, {'type':'system','text':f'Te has unido a la sala "{room}".','time': now_ts(), 'epoch_ms': epoch_ms()})
+                    broadcast_room(room, {'type':'system','text':f'{username} se ha unido a la sala "{room}".','time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=username)
 
                 elif mtype == 'leave_room':
                     room = msg.get('room','').strip()
                     if not room:
-                        send_json(conn, {'type':'system','text':'Nombre de sala inválido.','time': now_ts()})
+                        send_json(conn, {'type':'system','text':'Nombre de sala inválido.','time': now_ts(), 'epoch_ms': epoch_ms()})
                         continue
                     with rooms_lock:
                         if room in user_rooms.get(username, set()):
                             user_rooms[username].discard(room)
                             rooms.get(room,set()).discard(username)
-                            send_json(conn, {'type':'system','text':f'Te has salido de la sala "{room}".','time': now_ts()})
-                            broadcast_room(room, {'type':'system','text':f'{username} ha abandonado la sala "{room}".','time': now_ts()}, exclude_username=username)
+                            send_json(conn, {'type':'system','text':f'Te has salido de la sala "{room}".','time': now_ts(), 'epoch_ms': epoch_ms()})
+                            broadcast_room(room, {'type':'system','text':f'{username} ha abandonado la sala "{room}".','time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=username)
                         else:
-                            send_json(conn, {'type':'system','text':f'No estabas en la sala "{room}".','time': now_ts()})
+                            send_json(conn, {'type':'system','text':f'No estabas en la sala "{room}".','time': now_ts(), 'epoch_ms': epoch_ms()})
 
                 elif mtype == 'msg_room':
                     room = msg.get('room','').strip()
                     text = msg.get('text','')
                     if not room or room not in rooms:
-                        send_json(conn, {'type':'system','text':'Sala desconocida.','time': now_ts()})
+                        send_json(conn, {'type':'system','text':'Sala desconocida.','time': now_ts(), 'epoch_ms': epoch_ms()})
                         continue
                     # enviar solo a miembros
-                    broadcast_room(room, {'type':'msg','user': username, 'text': text, 'room': room, 'time': now_ts()}, exclude_username=None)
+                    broadcast_room(room, {'type':'msg','user': username, 'text': text, 'room': room, 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=None)
 
                 elif mtype == 'list_rooms':
                     # enviar lista completa de rooms y miembros
                     with rooms_lock:
                         snapshot = { r: list(members) for r,members in rooms.items() }
-                    send_json(conn, {'type':'room_list_response','rooms': snapshot, 'time': now_ts()})
+                    send_json(conn, {'type':'room_list_response','rooms': snapshot, 'time': now_ts(), 'epoch_ms': epoch_ms()})
 
                 elif mtype == 'msg':
                     # backward compatibility: enviar a global
                     text = msg.get('text','')
-                    broadcast_room('global', {'type':'msg','user': username, 'text': text, 'room': 'global', 'time': now_ts()}, exclude_username=None)
+                    broadcast_room('global', {'type':'msg','user': username, 'text': text, 'room': 'global', 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=None)
 
                 else:
-                    send_json(conn, {'type':'system','text':'Tipo de mensaje desconocido.','time': now_ts()})
+                    send_json(conn, {'type':'system','text':'Tipo de mensaje desconocido.','time': now_ts(), 'epoch_ms': epoch_ms()})
+    except LineTooLong:
+        try:
+            send_json(conn, {'type':'system','text':'Línea demasiado larga. Cerrando.','time':now_ts(),'epoch_ms':epoch_ms()})
+        except Exception:
+            pass
     except (ConnectionResetError, BrokenPipeError):
         pass
     except Exception as e:
@@ -167,7 +172,7 @@ def handle_client(conn, addr):
                 rooms_to_clean = list(user_rooms.get(username, set()))
                 for r in rooms_to_clean:
                     rooms.get(r, set()).discard(username)
-                    broadcast_room(r, {'type':'system','text':f'{username} se ha desconectado.', 'time': now_ts()}, exclude_username=username)
+                    broadcast_room(r, {'type':'system','text':f'{username} se ha desconectado.', 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=username)
                 user_rooms.pop(username, None)
             print(f"[SERVER] {username} desconectado.")
         try:
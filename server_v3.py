@@ -16,17 +16,20 @@ Respuestas/acciones del servidor:
  - {'type':'join_room_ok', 'room': ...}
  - {'type':'join_room_failed', 'room': ..., 'reason': 'protected'/'wrong_password'/'no_such_room'}
  - {'type':'leave_room_ok', 'room': ...}
- - {'type':'msg', 'user':..., 'room':..., 'text':..., 'time':...}
+ - {'type':'msg', 'user':..., 'room':..., 'text':..., 'time':..., 'epoch_ms':...}
  - {'type':'room_list_response', 'rooms': {room: [users,...], ...}}  (NO incluye salas protegidas)
 """
 
 import socket
 import threading
 import json
-import time
+
+from clock import epoch_ms, now_ts
+from framing import LineFramer, LineTooLong
 
 HOST = '0.0.0.0'
 PORT = 55555
+MAX_LINE_LENGTH = 64 * 1024  # bytes por línea; más largo se desconecta
 
 clients = {}           # username -> (conn, addr)
 clients_lock = threading.Lock()
@@ -37,8 +40,6 @@ rooms_lock = threading.Lock()
 
 user_rooms = {}        # username -> set(room_name)
 
-def now_ts():
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
 
 def send_json(conn, obj):
     try:
@@ -102,29 +103,29 @@ def handle_leave_room(username, room):
     return True
 
 def handle_client(conn, addr):
-    buf = ''
+    framer = LineFramer(MAX_LINE_LENGTH)
     username = None
     try:
         conn.settimeout(0.5)
         while True:
+            lines = []
             try:
                 data = conn.recv(4096)
                 if not data:
                     raise ConnectionResetError()
-                buf += data.decode('utf-8')
+                lines = framer.feed(data)
             except socket.timeout:
                 pass
             except ConnectionResetError:
                 raise
-            while '\n' in buf:
-                line, buf = buf.split('\n', 1)
+            for line in lines:
                 if not line.strip():
                     continue
                 try:
                     msg = json.loads(line)
                 except Exception:
                     try:
-                        send_json(conn, {'type':'system','text':'Mensaje mal formado.','time':now_ts()})
+                        send_json(conn, {'type':'system','text':'Mensaje mal formado.','time':now_ts(),'epoch_ms':epoch_ms()})
                     except Exception:
                         pass
                     continue
@@ -133,12 +134,12 @@ def handle_client(conn, addr):
                 if mtype == 'join':
                     requested = msg.get('user','').strip()
                     if not requested:
-                        send_json(conn, {'type':'system','text':'Nombre de usuario inválido.','time':now_ts()})
+                        send_json(conn, {'type':'system','text':'Nombre de usuario inválido.','time':now_ts(),'epoch_ms':epoch_ms()})
                         conn.close()
                         return
                     with clients_lock:
                         if requested in clients:
-                            send_json(conn, {'type':'system','text':'Nombre de usuario en uso.','time':now_ts()})
+                            send_json(conn, {'type':'system','text':'Nombre de usuario en uso.','time':now_ts(),'epoch_ms':epoch_ms()})
                             conn.close()
                             return
                         username = requested
@@ -149,11 +150,11 @@ def handle_client(conn, addr):
                         rooms['global']['members'].add(username)
                         user_rooms.setdefault(username, set()).add('global')
                     print(f"[SERVER] {username} conectado desde {addr}")
-                    send_json(conn, {'type':'system','text': f'Bienvenido {username}!', 'time': now_ts()})
-                    broadcast_room('global', {'type':'system','text': f'{username} se ha unido al chat (global).', 'time': now_ts()}, exclude_username=username)
+                    send_json(conn, {'type':'system','text': f'Bienvenido {username}!', 'time': now_ts(), 'epoch_ms': epoch_ms()})
+                    broadcast_room('global', {'type':'system','text': f'{username} se ha unido al chat (global).', 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=username)
 
                 elif not username:
-                    send_json(conn, {'type':'system','text':'No estás registrado. Envía join primero.','time': now_ts()})
+                    send_json(conn, {'type':'system','text':'No estás registrado. Envía join primero.','time': now_ts(), 'epoch_ms': epoch_ms()})
                     conn.close()
                     return
 
@@ -161,65 +162,65 @@ def handle_client(conn, addr):
                     room = msg.get('room','').strip()
                     password = msg.get('password') if 'password' in msg else None
                     if not room:
-                        send_json(conn, {'type':'join_room_failed','room':room,'reason':'invalid_name','time':now_ts()})
+                        send_json(conn, {'type':'join_room_failed','room':room,'reason':'invalid_name','time':now_ts(),'epoch_ms':epoch_ms()})
                         continue
                     ok, reason = handle_join_room_request(username, conn, room, password)
                     if ok:
                         # confirm to requester
                         try:
-                            send_json(conn, {'type':'join_room_ok','room':room,'time':now_ts()})
+                            send_json(conn, {'type':'join_room_ok','room':room,'time':now_ts(),'epoch_ms':epoch_ms()})
                         except Exception:
                             pass
                         # announce to room (exclude requester)
-                        broadcast_room(room, {'type':'system','text': f'{username} se ha unido a la sala "{room}".', 'time': now_ts()}, exclude_username=username)
+                        broadcast_room(room, {'type':'system','text': f'{username} se ha unido a la sala "{room}".', 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=username)
                     else:
                         # failed -> inform requester with reason
                         try:
-                            send_json(conn, {'type':'join_room_failed','room':room,'reason':reason,'time':now_ts()})
+                            send_json(conn, {'type':'join_room_failed','room':room,'reason':reason,'time':now_ts(),'epoch_ms':epoch_ms()})
                         except Exception:
                             pass
 
                 elif mtype == 'leave_room':
                     room = msg.get('room','').strip()
                     if not room:
-                        send_json(conn, {'type':'system','text':'Nombre de sala inválido.','time': now_ts()})
+                        send_json(conn, {'type':'system','text':'Nombre de sala inválido.','time': now_ts(), 'epoch_ms': epoch_ms()})
                         continue
                     if room == 'global':
-                        send_json(conn, {'type':'system','text':'No puedes abandonar la sala global.','time': now_ts()})
+                        send_json(conn, {'type':'system','text':'No puedes abandonar la sala global.','time': now_ts(), 'epoch_ms': epoch_ms()})
                         continue
                     ok = handle_leave_room(username, room)
                     if ok:
                         try:
-                            send_json(conn, {'type':'leave_room_ok','room':room,'time':now_ts()})
+                            send_json(conn, {'type':'leave_room_ok','room':room,'time':now_ts(),'epoch_ms':epoch_ms()})
                         except Exception:
                             pass
-                        broadcast_room(room, {'type':'system','text': f'{username} ha abandonado la sala "{room}".', 'time': now_ts()}, exclude_username=username)
+                        broadcast_room(room, {'type':'system','text': f'{username} ha abandonado la sala "{room}".', 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=username)
                     else:
-                        send_json(conn, {'type':'system','text': f'No estabas en la sala "{room}".','time': now_ts()})
+                        send_json(conn, {'type':'system','text': f'No estabas en la sala "{room}".','time': now_ts(), 'epoch_ms': epoch_ms()})
 
                 elif mtype == 'msg_room':
                     room = msg.get('room','').strip()
                     text = msg.get('text','')
                     if not room:
-                        send_json(conn, {'type':'system','text':'Sala desconocida.','time': now_ts()})
+                        send_json(conn, {'type':'system','text':'Sala desconocida.','time': now_ts(), 'epoch_ms': epoch_ms()})
                         continue
                     with rooms_lock:
                         if room not in rooms:
-                            send_json(conn, {'type':'system','text':'Sala desconocida.','time': now_ts()})
+                            send_json(conn, {'type':'system','text':'Sala desconocida.','time': now_ts(), 'epoch_ms': epoch_ms()})
                             continue
                         # only if user is member - otherwise ignore
                         if username not in rooms[room]['members']:
-                            send_json(conn, {'type':'system','text':'No estás en esa sala. Únete primero.','time': now_ts()})
+                            send_json(conn, {'type':'system','text':'No estás en esa sala. Únete primero.','time': now_ts(), 'epoch_ms': epoch_ms()})
                             continue
                     # broadcast to members; include sender as well (client will ignore own re-broadcast)
-                    broadcast_room(room, {'type':'msg','user': username, 'text': text, 'room': room, 'time': now_ts()}, exclude_username=None)
+                    broadcast_room(room, {'type':'msg','user': username, 'text': text, 'room': room, 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=None)
 
                 elif mtype == 'list_rooms':
                     # build listing excluding protected rooms
                     with rooms_lock:
                         snapshot = { r: list(info['members']) for r, info in rooms.items() if info.get('password') is None }
                     try:
-                        send_json(conn, {'type':'room_list_response','rooms': snapshot, 'time': now_ts()})
+                        send_json(conn, {'type':'room_list_response','rooms': snapshot, 'time': now_ts(), 'epoch_ms': epoch_ms()})
                     except Exception:
                         pass
 
@@ -228,14 +229,19 @@ def handle_client(conn, addr):
                     text = msg.get('text','')
                     with rooms_lock:
                         if username in rooms.get('global', {}).get('members', set()):
-                            broadcast_room('global', {'type':'msg','user': username, 'text': text, 'room': 'global', 'time': now_ts()}, exclude_username=None)
+                            broadcast_room('global', {'type':'msg','user': username, 'text': text, 'room': 'global', 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=None)
 
                 else:
                     try:
-                        send_json(conn, {'type':'system','text':'Tipo de mensaje desconocido.','time': now_ts()})
+                        send_json(conn, {'type':'system','text':'Tipo de mensaje desconocido.','time': now_ts(), 'epoch_ms': epoch_ms()})
                     except Exception:
                         pass
 
+    except LineTooLong:
+        try:
+            send_json(conn, {'type':'system','text':'Línea demasiado larga. Cerrando.','time':now_ts(),'epoch_ms':epoch_ms()})
+        except Exception:
+            pass
     except (ConnectionResetError, BrokenPipeError):
         pass
     except Exception as e:
@@ -250,7 +256,7 @@ def handle_client(conn, addr):
                 rooms_to_clean = list(user_rooms.get(username, set()))
                 for r in rooms_to_clean:
                     rooms.get(r, {}).get('members', set()).discard(username)
-                    broadcast_room(r, {'type':'system','text': f'{username} se ha desconectado.', 'time': now_ts()}, exclude_username=username)
+                    broadcast_room(r, {'type':'system','text': f'{username} se ha desconectado.', 'time': now_ts(), 'epoch_ms': epoch_ms()}, exclude_username=username)
                 user_rooms.pop(username, None)
             print(f"[SERVER] {username} desconectado.")
         try:
@@ -3,7 +3,8 @@
 
 import socket
 import threading
-import shlex
+
+from commands import CommandRegistry
 
 HOST = '0.0.0.0'
 PORT = 55555
@@ -131,36 +132,21 @@ def handle_message(username, text):
     broadcast_room(room, f"{username}: {text}", exclude=username)
 
 
-def parse_command(line):
-    try:
-        return shlex.split(line)
-    except ValueError:
-        return []
+def handle_quit_command(username):
+    send_line(username, "👋 Desconectado por solicitud.")
+    raise DisconnectRequested()
+
+
+# Los handlers reciben (username, *argumentos); las respuestas van al usuario.
+COMMANDS = CommandRegistry(send_line)
+COMMANDS.register('/join', handle_join_command, min_args=1, max_args=2, usage="Uso: /join <sala> [contraseña]")
+COMMANDS.register('/leave', handle_leave_command, max_args=1)
+COMMANDS.register('/rooms', handle_rooms_command)
+COMMANDS.register('/quitar', handle_quit_command)
 
 
 def handle_command(username, line):
-    parts = parse_command(line)
-    if not parts:
-        send_line(username, "❌ Comando inválido.")
-        return
-    cmd = parts[0].lower()
-    if cmd == '/join':
-        if len(parts) < 2:
-            send_line(username, "Uso: /join <sala> [contraseña]")
-            return
-        room = parts[1]
-        password = parts[2] if len(parts) > 2 else None
-        handle_join_command(username, room, password)
-    elif cmd == '/leave':
-        target = parts[1] if len(parts) > 1 else None
-        handle_leave_command(username, target)
-    elif cmd == '/rooms':
-        handle_rooms_command(username)
-    elif cmd == '/quitar':
-        send_line(username, "👋 Desconectado por solicitud.")
-        raise DisconnectRequested()
-    else:
-        send_line(username, "❌ Comando desconocido.")
+    COMMANDS.dispatch(line, username, username)
 
 
 def cleanup_user(username):
@@ -3,10 +3,13 @@
 
 import socket
 import threading
-import shlex
+
+from commands import CommandRegistry
+from framing import LineFramer, LineTooLong
 
 HOST = '0.0.0.0'
 PORT = 55555
+MAX_LINE_LENGTH = 64 * 1024
 
 clients = {}  # username -> socket
 clients_lock = threading.Lock()
@@ -119,36 +122,21 @@ def handle_message(username, text):
     broadcast_room(room, f"{username}: {text}", exclude=username)
 
 
-def parse_command(line):
-    try:
-        return shlex.split(line)
-    except ValueError:
-        return []
+def handle_quit_command(username, conn):
+    send_line(conn, "👋 Desconectado por solicitud.")
+    raise DisconnectRequested()
+
+
+# Los handlers reciben (username, conn, *argumentos).
+COMMANDS = CommandRegistry(send_line)
+COMMANDS.register('/join', handle_join_command, min_args=1, max_args=2, usage="Uso: /join <sala> [contraseña]")
+COMMANDS.register('/leave', handle_leave_command, max_args=1)
+COMMANDS.register('/rooms', lambda username, conn: handle_rooms_command(conn))
+COMMANDS.register('/quitar', handle_quit_command)
 
 
 def handle_command(username, conn, line):
-    parts = parse_command(line)
-    if not parts:
-        send_line(conn, "❌ Comando inválido.")
-        return
-    cmd = parts[0].lower()
-    if cmd == '/join':
-        if len(parts) < 2:
-            send_line(conn, "Uso: /join <sala> [contraseña]")
-            return
-        room = parts[1]
-        password = parts[2] if len(parts) > 2 else None
-        handle_join_command(username, conn, room, password)
-    elif cmd == '/leave':
-        target = parts[1] if len(parts) > 1 else None
-        handle_leave_command(username, conn, target)
-    elif cmd == '/rooms':
-        handle_rooms_command(conn)
-    elif cmd == '/quitar':
-        send_line(conn, "👋 Desconectado por solicitud.")
-        raise DisconnectRequested()
-    else:
-        send_line(conn, "❌ Comando desconocido.")
+    COMMANDS.dispatch(line, conn, username, conn)
 
 
 def cleanup_user(username):
@@ -168,17 +156,18 @@ def cleanup_user(username):
 
 
 def handle_client(conn, addr):
-    buffer = ''
+    framer = LineFramer(MAX_LINE_LENGTH)
+    pending = []
     username = None
     try:
         send_line(conn, "Ingresa tu nombre (NOMBRE):")
         conn.settimeout(0.5)
-        while '\n' not in buffer:
+        while not pending:
             data = conn.recv(4096)
             if not data:
                 raise ConnectionResetError()
-            buffer += data.decode('utf-8', errors='replace')
-        line, buffer = buffer.split('\n', 1)
+            pending = framer.feed(data)
+        line, pending = pending[0], pending[1:]
         username = line.strip()
         if not username:
             send_line(conn, "Nombre inválido. Cerrando.")
@@ -197,16 +186,7 @@ def handle_client(conn, addr):
         broadcast_room('global', f"ℹ️ {username} se ha unido al chat global.", exclude=username)
 
         while True:
-            if '\n' not in buffer:
-                try:
-                    data = conn.recv(4096)
-                    if not data:
-                        raise ConnectionResetError()
-                    buffer += data.decode('utf-8', errors='replace')
-                except socket.timeout:
-                    continue
-            while '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
+            for line in pending:
                 line = line.strip('\r')
                 if not line:
                     continue
@@ -214,10 +194,23 @@ def handle_client(conn, addr):
                     handle_command(username, conn, line)
                 else:
                     handle_message(username, line)
+            pending = []
+            try:
+                data = conn.recv(4096)
+            except socket.timeout:
+                continue
+            if not data:
+                raise ConnectionResetError()
+            pending = framer.feed(data)
     except DisconnectRequested:
         pass
     except (ConnectionResetError, BrokenPipeError):
         pass
+    except LineTooLong:
+        try:
+            send_line(conn, "❌ Línea demasiado larga. Cerrando.")
+        except Exception:
+            pass
     finally:
         if username:
             cleanup_user(username)
@@ -5,17 +5,94 @@
 - Acepta client.py y client_v2.py (mensajes JSON por línea).
 - Handshake opcional "HELLO_V5" para clientes avanzados.
 - Sistema de logging detallado para depuración de conexiones.
+- Dos motores: un hilo por conexión (por defecto) o un único event loop
+  basado en selectors (``--engine loop``).
+- ``--workers N``: N procesos en el mismo puerto (SO_REUSEPORT) unidos por un
+  bus local (room_bus.py) para difusión, presencia y nombres únicos.
+- ``--log-dir``: log durable de mensajes y eventos (message_log.py).
+- Protocolo binario ``bin1`` y compresión ``zlib`` opcionales, negociados en
+  el handshake (binwire.py, compression.py).
+- ``--metrics-port``: métricas en formato Prometheus en un puerto local de
+  administración (metrics.py); ``/stats`` para los usuarios de ``--admin``.
+- ``/profile [segundos]`` (admin) o SIGUSR2: perfil por muestreo de todos los
+  hilos en formato collapsed para flamegraphs (profiler.py).
+- Logging en un hilo aparte detrás de una cola acotada, avisos repetidos
+  resumidos por segundo y ``--lifecycle-log`` en JSONL (log_pipeline.py).
+- Latidos PING/PONG negociados en HELLO_V5 (``ping=1``), TCP keepalive y
+  cortes por inactividad o registro incompleto en una rueda de tiempos
+  (timing_wheel.py).
+- ``--rate-user/--rate-room/--rate-ip``: token buckets que demoran o
+  descartan mensajes antes de difundirlos (ratelimit.py).
+- ``--max-sessions/--max-handshakes/--max-per-ip``: control de admisión en
+  accept(); lo que excede se rechaza con una línea ya codificada.
+- ``--handoff-socket`` / ``--takeover``: reinicio en caliente; el proceso
+  nuevo recibe el puerto, los sockets de los clientes (SCM_RIGHTS) y el
+  estado de salas y usuarios sin que nadie se desconecte (handoff.py).
+- ``--snapshot-file``: instantánea atómica de salas y contraseñas, escrita
+  en segundo plano y al apagar, que se carga al arrancar (room_snapshot.py).
+- ``/presencia`` (JSON): lista de usuarios paginada y después sólo altas y
+  bajas numeradas, para detectar saltos sin sondear ``/listar``.
+- ``/rooms [prefijo=..] [desde=..] [max=N]`` y ``/rooms activas``: páginas
+  de un índice ordenado de salas públicas (room_directory.py).
 """
 
+import abc
+import argparse
+import base64
+import collections
+import heapq
+import itertools
 import json
 import logging
+import os
+import selectors
+import shlex
+import signal
 import socket
+import subprocess
+import sys
+import tempfile
 import threading
 import time
-import shlex
+
+import binwire
+import compression
+import handoff
+import log_pipeline
+import metrics
+import profiler
+import ratelimit
+import room_directory
+import room_snapshot
+from clock import epoch_ms, now_ts
+from commands import CommandRegistry
+from framing import LineFramer, LineTooLong
+from message_log import MessageLog
+from room_bus import REQUEST_TIMEOUT, RoomBusClient, RoomBusHub
+from timing_wheel import TimingWheel
 
 HOST = '0.0.0.0'
 PORT = 55555
+HANDSHAKE_TIMEOUT = 1.0
+RECV_SIZE = 4096
+MAX_LINE_LENGTH = 64 * 1024  # bytes por línea; más largo se desconecta
+OUTBOUND_QUEUE_LIMIT = 1024  # frames por sesión
+SLOW_CONSUMER_POLICY = 'drop_oldest'
+COALESCE_WRITES = True  # juntar los envíos de cada ciclo en un sendmsg por conexión
+BACKLOG_SIZE = 50  # mensajes recientes por sala que se reenvían en /join
+BACKLOG_MEMORY = 32 * 1024 * 1024  # bytes totales entre todas las salas
+ADMIN_USERS = set()  # nombres que pueden usar los comandos de administración (--admin)
+PROFILE_SECONDS = 10.0  # duración por defecto de /profile y SIGUSR2
+HEARTBEAT_INTERVAL = 30.0  # inactividad antes de mandar PING a quien negoció 'ping' (0 = nunca)
+HEARTBEAT_TIMEOUT = 10.0  # espera máxima del PONG antes de dar la sesión por muerta
+IDLE_TIMEOUT = 0.0  # sesiones sin 'ping': cortar tras tanta inactividad (0 = nunca)
+LOGIN_TIMEOUT = 60.0  # conexiones que no completan el registro
+KEEPALIVE = (60, 10, 5)  # TCP keepalive: (inactividad, intervalo, sondas); inactividad 0 = desactivado
+RATE_POLICY = 'delay'  # mensajes que exceden un token bucket: 'delay' (se demoran) o 'reject'
+RATE_MAX_DELAY = 2.0  # con 'delay', esperas más largas se rechazan igual
+RATE_NOTICE_INTERVAL = 1.0  # a lo sumo un aviso de rechazo por segundo y usuario
+MAX_HANDSHAKES = 1024  # conexiones aceptadas que todavía no se registraron (0 = sin límite)
+LISTEN_BACKLOG = 200
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,45 +100,241 @@ logging.basicConfig(
 )
 
 LOGGER = logging.getLogger('server_v5')
+# Eventos de conexión en JSONL (--lifecycle-log); desactivados no cuestan nada.
+LIFECYCLE = logging.getLogger(log_pipeline.LIFECYCLE_LOGGER)
+LIFECYCLE_ENABLED = False
+LOG_PIPELINE = None
+SEND_FAILURES = log_pipeline.WarningAggregator(
+    LOGGER,
+    'Error difundiendo a %s: %s',
+    '%d fallos de envío más a %s en el último segundo (último: %s)',
+)
 
 
-def now_ts():
-    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+def lifecycle_event(event, **fields):
+    if LIFECYCLE_ENABLED:
+        LIFECYCLE.info(event, extra={'fields': fields})
 
 
-clients = {}  # username -> {'conn': socket, 'protocol': 'text'|'json', 'addr': addr}
+def _addr_text(addr):
+    return f'{addr[0]}:{addr[1]}' if isinstance(addr, tuple) else str(addr)
+
+
+clients = {}  # username -> {'username', 'conn', 'protocol': 'text'|'json', 'addr'}
 clients_lock = threading.Lock()
+SESSIONS = set()  # todas las ClientSession abiertas, registradas o no (para el traspaso en caliente)
+
+
+def _new_room(password=None):
+    # 'viewers': tupla de registros de `clients` cuya sala activa es esta sala.
+    # Se reemplaza entera en cada cambio (copy-on-write) para que
+    # broadcast_room la lea sin locks ni filtrado por mensaje.
+    return {'members': set(), 'password': password, 'viewers': (), 'lock': threading.Lock()}
 
-rooms = {'global': {'members': set(), 'password': None}}
+
+# Locks:
+#  - rooms_lock sólo protege el alta de salas en `rooms`.
+#  - el 'lock' de cada sala protege sus members/password/viewers, así que el
+#    tráfico de salas distintas nunca se serializa.
+#  - user_rooms / user_memberships de un usuario sólo los modifica su propia
+#    sesión (su hilo o el event loop), por eso no llevan lock.
+rooms = {'global': _new_room()}
 rooms_lock = threading.Lock()
+# Índice de salas públicas para /rooms: se actualiza en cada alta de sala y
+# en cada cambio de 'members' (bajo el lock de la sala).
+ROOM_DIRECTORY = room_directory.RoomDirectory()
+ROOM_DIRECTORY.add('global')
 user_rooms = {}  # username -> sala activa
 user_memberships = {}  # username -> set(salas en las que está unido)
 
+# RoomBusClient cuando el proceso es un worker de --workers N; None si el
+# servidor corre en un único proceso.
+ROOM_BUS = None
+# True con --engine loop: el hilo del loop no espera respuestas del bus (ver
+# BusPending).
+BUS_DEFERRED = False
+# Contraseñas de salas según el hub, pedidas sin esperar (BUS_DEFERRED); la
+# primera respuesta del hub para una sala no cambia nunca.
+BUS_ROOM_PASSWORDS = {}
+# MessageLog con --log-dir: registra todo lo que se difunde desde este proceso.
+MESSAGE_LOG = None
+# RoomSnapshots con --snapshot-file: salas y contraseñas sobreviven a un reinicio.
+ROOM_SNAPSHOTS = None
+# Perfilador por muestreo (profiler.py): inactivo hasta /profile o SIGUSR2.
+PROFILER = profiler.SamplingProfiler(tempfile.gettempdir())
+# HeartbeatMonitor: vencimientos de sesiones inactivas o muertas en una rueda
+# de tiempos; None si no hay ningún límite configurado.
+HEARTBEATS = None
+# Token buckets por usuario, sala e IP (ratelimit.py); sin ámbitos configurados
+# (--rate-user/--rate-room/--rate-ip) no se consulta nada.
+RATE_LIMITS = ratelimit.RateLimits()
+
+# Métricas (ver metrics.py). Los gauges se evalúan recién al exportar.
+CONNECTIONS = metrics.counter('chat_connections', 'Conexiones aceptadas.')
+DISCONNECTIONS = metrics.counter('chat_disconnections', 'Conexiones cerradas.')
+MESSAGES_IN = metrics.counter('chat_messages_in', 'Líneas recibidas de usuarios registrados.', label='protocol')
+MESSAGES_OUT = metrics.counter('chat_messages_out', 'Frames de difusión entregados por destinatario.', label='protocol')
+BYTES_IN = metrics.counter('chat_bytes_in', 'Bytes leídos de los sockets de clientes.')
+BYTES_OUT = metrics.counter('chat_bytes_out', 'Bytes escritos en los sockets de clientes.')
+FANOUT_SIZE = metrics.histogram(
+    'chat_broadcast_fanout', 'Destinatarios locales por difusión.', metrics.SIZE_BUCKETS
+)
+BROADCAST_SECONDS = metrics.histogram('chat_broadcast_seconds', 'Duración de la entrega local de una difusión.')
+HANDSHAKE_SECONDS = metrics.histogram(
+    'chat_handshake_seconds', 'Desde la conexión hasta el registro, según el camino del handshake.', label='path'
+)
+HEARTBEAT_PINGS = metrics.counter('chat_heartbeat_pings', 'PING enviados a sesiones inactivas.')
+SESSIONS_REAPED = metrics.counter(
+    'chat_sessions_reaped', 'Sesiones cortadas por el servidor por inactividad o sin PONG.', label='reason'
+)
+RATE_LIMITED = metrics.counter('chat_rate_limited', 'Mensajes frenados por un token bucket.', label='scope')
+RATE_REJECTED = metrics.counter('chat_rate_limit_rejected', 'Mensajes descartados por el limitador.')
+RATE_DELAY_SECONDS = metrics.histogram('chat_rate_limit_delay_seconds', 'Demoras impuestas por el limitador.')
+SHED = metrics.counter('chat_connections_shed', 'Conexiones rechazadas en accept() por sobrecarga.', label='reason')
+
 
 class DisconnectRequested(Exception):
     """Se lanza cuando el cliente solicita desconexión voluntaria."""
 
 
+class RateLimited(Exception):
+    """Con la política 'delay': el motor deja de leer la conexión ``wait``
+    segundos y después vuelve a procesar la misma línea."""
+
+    def __init__(self, wait):
+        super().__init__(wait)
+        self.wait = wait
+
+
+class BusPending(Exception):
+    """Con BUS_DEFERRED: la línea necesita una respuesta del hub. El motor deja
+    de leer la conexión, llama a ``send(resume)`` y, cuando el bus invoca
+    ``resume`` (en el hilo del loop), vuelve a procesar la misma línea; esta
+    vez la respuesta ya está guardada."""
+
+    def __init__(self, send):
+        super().__init__()
+        self.send = send
+
+
+def _bus_claim(username, conn):
+    """Reclama ``username`` en el hub; con BUS_DEFERRED la respuesta queda en
+    la sesión hasta que se reprocesa la línea."""
+    if not BUS_DEFERRED:
+        return ROOM_BUS.claim(username)
+    session = conn.session
+    claimed, session.bus_claim = session.bus_claim, None
+    if claimed is not None:
+        return claimed
+
+    def send(resume):
+        def replied(ok):
+            if conn.closed or conn.closing:
+                if ok:
+                    ROOM_BUS.release(username)  # la sesión se cerró esperando
+                return
+            session.bus_claim = ok
+            resume()
+
+        ROOM_BUS.claim(username, replied)
+
+    raise BusPending(send)
+
+
+def _bus_room_password(name, password):
+    if not BUS_DEFERRED:
+        return ROOM_BUS.room_password(name, password)
+    if name in BUS_ROOM_PASSWORDS:
+        return BUS_ROOM_PASSWORDS[name]
+
+    def send(resume):
+        def replied(stored):
+            BUS_ROOM_PASSWORDS[name] = stored
+            resume()
+
+        ROOM_BUS.room_password(name, password, replied)
+
+    raise BusPending(send)
+
+
 def register_client(username, conn, addr, protocol):
     with clients_lock:
         if username in clients:
             return False
-        clients[username] = {'conn': conn, 'protocol': protocol, 'addr': addr}
+    # El hub decide entre todos los workers; reclamar el nombre allí es
+    # atómico, así que dos sesiones locales con el mismo nombre no pasan ambas.
+    if ROOM_BUS is not None and not _bus_claim(username, conn):
+        return False
+    with clients_lock:
+        clients[username] = {'username': username, 'conn': conn, 'protocol': protocol, 'addr': addr}
+    if ROOM_BUS is None:
+        PRESENCE.apply('join', username)  # con --workers el alta la anuncia el hub
     LOGGER.info("Usuario %s registrado (%s) desde %s", username, protocol, addr)
     return True
 
 
-def initialize_memberships(username):
+def get_or_create_room(name, password=None):
+    """Devuelve (info, creada). Sólo toma rooms_lock si la sala no existe."""
+    info = rooms.get(name)
+    if info is not None:
+        return info, False
+    if ROOM_BUS is not None:
+        # La contraseña de una sala es global: la fija quien la creó primero
+        # en cualquier worker.
+        password = _bus_room_password(name, password or None)
     with rooms_lock:
-        rooms.setdefault('global', {'members': set(), 'password': None})
-        rooms['global']['members'].add(username)
-        user_rooms[username] = 'global'
-        user_memberships[username] = {'global'}
+        info = rooms.get(name)
+        if info is not None:
+            return info, False
+        info = rooms[name] = _new_room(password or None)
+        ROOM_DIRECTORY.add(name, info['password'])
+        return info, True
+
+
+def _remove_viewer(room, username):
+    info = rooms.get(room)
+    if info is None:
+        return
+    with info['lock']:
+        info['viewers'] = tuple(v for v in info['viewers'] if v['username'] != username)
+
+
+def _set_active_room(username, room):
+    """Cambia la sala activa de ``username`` y actualiza los 'viewers'."""
+    previous = user_rooms.get(username)
+    user_rooms[username] = room
+    if previous == room:
+        return
+    if previous is not None:
+        _remove_viewer(previous, username)
+    with clients_lock:
+        record = clients.get(username)
+    if record:
+        info, _ = get_or_create_room(room)
+        with info['lock']:
+            info['viewers'] = info['viewers'] + (record,)
+
+
+def initialize_memberships(username):
+    info, _ = get_or_create_room('global')
+    with info['lock']:
+        info['members'].add(username)
+        ROOM_DIRECTORY.update('global', len(info['members']))
+    user_memberships[username] = {'global'}
+    _set_active_room(username, 'global')
+
+
+def _is_binary(conn):
+    session = getattr(conn, 'session', None)
+    return session is not None and session.protocol == binwire.FEATURE
 
 
 def send_line(conn, text):
     try:
-        conn.sendall((text + "\n").encode('utf-8'))
+        if _is_binary(conn):
+            conn.sendall(binwire.encode_text(text))
+        else:
+            conn.sendall((text + "\n").encode('utf-8'))
         LOGGER.debug('→ %s', text)
     except Exception as exc:
         LOGGER.warning('Error enviando texto: %s', exc)
@@ -88,53 +361,206 @@ def _format_json_as_text(obj):
     return json.dumps(obj, ensure_ascii=False)
 
 
-def broadcast_room(room, *, text=None, json_obj=None, exclude=None):
-    with rooms_lock:
-        members = [
-            username
-            for username in rooms.get(room, {}).get('members', set())
-            if username != exclude and user_rooms.get(username, 'global') == room
-        ]
-    targets = []
-    with clients_lock:
-        for username in members:
-            info = clients.get(username)
-            if info:
-                targets.append((username, info))
-    text_data = (text + '\n').encode('utf-8') if text is not None else None
-    json_data = (
-        (json.dumps(json_obj, ensure_ascii=False) + '\n').encode('utf-8')
-        if json_obj is not None
-        else None
-    )
-    for target_username, info in targets:
-        conn = info['conn']
+def _encode_text_variant(frame):
+    text = frame.text if frame.text is not None else _format_json_as_text(frame.json_obj)
+    return (text + '\n').encode('utf-8')
+
+
+def _encode_json_variant(frame):
+    obj = frame.json_obj
+    if obj is None:
+        obj = {'type': 'system', 'text': frame.text, 'time': now_ts(), 'epoch_ms': epoch_ms()}
+    return (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+# Ids de salas y usuarios para bin1, iguales para todas las conexiones.
+INTERNS = binwire.InternTable()
+
+
+def _encode_bin_variant(frame):
+    obj = frame.json_obj
+    if obj is None or obj.get('type') != 'msg' or frame.room is None:
+        return binwire.encode_text(frame.text if frame.text is not None else _format_json_as_text(obj))
+    user = obj.get('user', '??')
+    room_id = INTERNS.id_for(frame.room)
+    user_id = INTERNS.id_for(user)
+    frame.interns = ((room_id, frame.room), (user_id, user))
+    return binwire.encode_msg(room_id, user_id, obj.get('epoch_ms') or epoch_ms(), obj.get('text', ''))
+
+
+# protocolo -> función que construye los bytes de esa variante
+WIRE_ENCODERS = {
+    'text': _encode_text_variant,
+    'json': _encode_json_variant,
+    binwire.FEATURE: _encode_bin_variant,
+}
+
+
+class FanoutFrame:
+    """Mensaje de difusión con una variante de cable por protocolo.
+
+    Cada variante (texto, JSON, ...) se construye y codifica a lo sumo una vez,
+    la primera vez que un destinatario de ese protocolo la pide, y todos los
+    destinatarios de ese protocolo reciben el mismo objeto ``bytes``.
+    """
+
+    __slots__ = ('text', 'json_obj', 'room', 'interns', '_wire')
+
+    def __init__(self, text=None, json_obj=None, room=None):
+        if text is None and json_obj is None:
+            raise ValueError('FanoutFrame necesita text o json_obj')
+        self.text = text
+        self.json_obj = json_obj
+        self.room = room
+        self.interns = ()  # (id, cadena) que usa la variante bin1
+        self._wire = {}
+
+    def wire(self, protocol):
+        data = self._wire.get(protocol)
+        if data is None:
+            encoder = WIRE_ENCODERS.get(protocol, _encode_text_variant)
+            data = self._wire[protocol] = encoder(self)
+        return data
+
+
+def broadcast_room(room, *, text=None, json_obj=None, exclude=None, frame=None):
+    if frame is None:
+        frame = FanoutFrame(text, json_obj, room)
+    deliver_local(room, frame, exclude)
+    if ROOM_BUS is not None:
+        ROOM_BUS.publish(room, frame.text, frame.json_obj, exclude)
+    if MESSAGE_LOG is not None:
+        MESSAGE_LOG.append(room, frame.json_obj or {'type': 'system', 'text': frame.text})
+    return frame
+
+
+def deliver_remote(room, text, json_obj, exclude):
+    """Entrega local de una difusión que llegó por el bus desde otro worker."""
+    frame = FanoutFrame(text, json_obj, room)
+    deliver_local(room, frame, exclude)
+    if json_obj is not None and json_obj.get('type') == 'msg':
+        BACKLOG.append(room, frame)
+
+
+def deliver_local(room, frame, exclude=None):
+    started = time.perf_counter()
+    room_info = rooms.get(room)
+    viewers = room_info['viewers'] if room_info else ()
+    sent = {}
+    for info in viewers:
+        if info['username'] == exclude:
+            continue
         try:
-            if info['protocol'] == 'json':
-                if json_data is not None:
-                    conn.sendall(json_data)
-                elif text is not None:
-                    fallback = {
-                        'type': 'system',
-                        'text': text,
-                        'time': now_ts(),
-                    }
-                    conn.sendall(
-                        (json.dumps(fallback, ensure_ascii=False) + '\n').encode('utf-8')
-                    )
+            protocol = info['protocol']
+            if protocol == binwire.FEATURE:
+                send_frames(info['conn'], protocol, (frame,))
             else:
-                if text_data is not None:
-                    conn.sendall(text_data)
-                elif json_obj is not None:
-                    fallback_text = _format_json_as_text(json_obj)
-                    conn.sendall((fallback_text + '\n').encode('utf-8'))
+                info['conn'].sendall(frame.wire(protocol))
+            sent[protocol] = sent.get(protocol, 0) + 1
         except Exception as exc:
-            LOGGER.warning(
-                'Error difundiendo a %s (%s): %s',
-                target_username,
-                info['protocol'],
-                exc,
-            )
+            SEND_FAILURES.warning(info['username'], exc)
+    for protocol, count in sent.items():
+        MESSAGES_OUT.labels(protocol).inc(count)
+    FANOUT_SIZE.observe(sum(sent.values()))
+    BROADCAST_SECONDS.observe(time.perf_counter() - started)
+
+
+def send_frames(conn, protocol, frames):
+    """Envía varios FanoutFrame en un único sendall.
+
+    En bin1 antepone las definiciones de ids que la conexión todavía no
+    recibió; el lock de la conexión asegura que una definición siempre sale
+    antes que cualquier frame que la use.
+    """
+    if protocol != binwire.FEATURE:
+        conn.sendall(b''.join(frame.wire(protocol) for frame in frames))
+        return
+    with conn.intern_lock:
+        known = conn.known_interns
+        parts = []
+        for frame in frames:
+            data = frame.wire(protocol)
+            for intern_id, value in frame.interns:
+                if intern_id not in known:
+                    known.add(intern_id)
+                    parts.append(binwire.encode_intern(intern_id, value))
+            parts.append(data)
+        conn.sendall(b''.join(parts))
+
+
+class RoomBacklog:
+    """Últimos mensajes de cada sala, ya codificados, para reenviar en /join.
+
+    Cada sala guarda a lo sumo ``per_room`` frames (un anillo: el más viejo
+    sale al entrar uno nuevo) con sus variantes texto y JSON ya codificadas.
+    El total entre salas no pasa de ``max_bytes``: si se excede se vacía la
+    sala que hace más tiempo que no recibe mensajes.
+    """
+
+    ENTRY_OVERHEAD = 160  # bytes aproximados de deque/tupla/FanoutFrame
+
+    def __init__(self, per_room=None, max_bytes=None):
+        self.per_room = BACKLOG_SIZE if per_room is None else per_room
+        self.max_bytes = BACKLOG_MEMORY if max_bytes is None else max_bytes
+        self.rooms = collections.OrderedDict()  # sala -> deque[(frame, costo)], menos activa primero
+        self.room_bytes = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def append(self, room, frame):
+        if self.per_room <= 0:
+            return
+        # Se codifican ambas variantes ahora, fuera del lock: el replay sólo
+        # concatena bytes.
+        cost = len(frame.wire('text')) + len(frame.wire('json')) + self.ENTRY_OVERHEAD
+        with self.lock:
+            ring = self.rooms.get(room)
+            if ring is None:
+                ring = self.rooms[room] = collections.deque()
+                self.room_bytes[room] = 0
+            else:
+                self.rooms.move_to_end(room)
+            ring.append((frame, cost))
+            self.room_bytes[room] += cost
+            self.total_bytes += cost
+            if len(ring) > self.per_room:
+                self._pop_oldest(room, ring)
+            while self.total_bytes > self.max_bytes:
+                victim = next(iter(self.rooms))
+                if victim == room:
+                    # sólo queda esta sala: se recorta su propio anillo
+                    self._pop_oldest(room, ring)
+                    if not ring:
+                        self._evict(room)
+                        break
+                else:
+                    self._evict(victim)
+
+    def _pop_oldest(self, room, ring):
+        _, cost = ring.popleft()
+        self.room_bytes[room] -= cost
+        self.total_bytes -= cost
+
+    def _evict(self, room):
+        del self.rooms[room]
+        self.total_bytes -= self.room_bytes.pop(room)
+
+    def recent(self, room, limit=None):
+        """Devuelve los últimos ``limit`` frames de la sala, del más viejo al
+        más nuevo."""
+        with self.lock:
+            ring = self.rooms.get(room)
+            frames = [frame for frame, _ in ring] if ring else []
+        if limit is not None:
+            frames = frames[-limit:] if limit > 0 else []
+        return frames
+
+    def stats(self):
+        with self.lock:
+            return {'rooms': len(self.rooms), 'bytes': self.total_bytes}
+
+
+BACKLOG = RoomBacklog()
 
 
 def handle_join_command(username, conn, room, password):
@@ -142,22 +568,23 @@ def handle_join_command(username, conn, room, password):
     if not room:
         send_line(conn, "❌ Debes indicar un nombre de sala.")
         return
-    with rooms_lock:
-        info = rooms.get(room)
-        already_member = False
-        if info:
-            already_member = username in info.get('members', set())
-            stored_pwd = info.get('password')
-            if not already_member and stored_pwd:
-                if password is None or password != stored_pwd:
-                    send_line(conn, "❌ Contraseña incorrecta.")
-                    return
-        else:
-            rooms[room] = {'members': set(), 'password': password if password else None}
-            info = rooms[room]
-        info['members'].add(username)
-        user_memberships.setdefault(username, set()).add(room)
-        user_rooms[username] = room
+    info, _ = get_or_create_room(room, password)
+    with info['lock']:
+        already_member = username in info['members']
+        stored_pwd = info['password']
+        denied = (
+            not already_member
+            and stored_pwd
+            and (password is None or password != stored_pwd)
+        )
+        if not denied:
+            info['members'].add(username)
+            ROOM_DIRECTORY.update(room, len(info['members']))
+    if denied:
+        send_line(conn, "❌ Contraseña incorrecta.")
+        return
+    user_memberships.setdefault(username, set()).add(room)
+    _set_active_room(username, room)
     if not already_member:
         broadcast_room(
             room,
@@ -166,34 +593,44 @@ def handle_join_command(username, conn, room, password):
                 'type': 'system',
                 'text': f"{username} se ha unido a la sala '{room}'.",
                 'time': now_ts(),
+                'epoch_ms': epoch_ms(),
             },
             exclude=username,
         )
     send_line(conn, f"✅ Te has unido a la sala '{room}'.")
+    with clients_lock:
+        record = clients.get(username)
+    backlog = BACKLOG.recent(room)
+    if backlog:
+        # un solo write para todo el historial reciente
+        send_frames(conn, record['protocol'] if record else 'text', backlog)
 
 
 def handle_leave_command(username, conn, target_room=None):
-    with rooms_lock:
-        current_active = user_rooms.get(username, 'global')
-        memberships = user_memberships.setdefault(username, set())
-        room = target_room.strip() if target_room else current_active
-        if room not in memberships:
-            send_line(conn, f"No estás en la sala '{room}'.")
-            return
-        if room == 'global':
-            send_line(conn, "No puedes salir del chat global.")
-            return
-        rooms.setdefault(room, {'members': set(), 'password': None})
-        rooms[room]['members'].discard(username)
-        memberships.discard(room)
-        if room == current_active:
-            new_active = 'global'
-            user_rooms[username] = new_active
-        else:
-            new_active = current_active
-        rooms.setdefault('global', {'members': set(), 'password': None})
-        rooms['global']['members'].add(username)
-        memberships.add('global')
+    current_active = user_rooms.get(username, 'global')
+    memberships = user_memberships.setdefault(username, set())
+    room = target_room.strip() if target_room else current_active
+    if room not in memberships:
+        send_line(conn, f"No estás en la sala '{room}'.")
+        return
+    if room == 'global':
+        send_line(conn, "No puedes salir del chat global.")
+        return
+    info, _ = get_or_create_room(room)
+    with info['lock']:
+        info['members'].discard(username)
+        ROOM_DIRECTORY.update(room, len(info['members']))
+    memberships.discard(room)
+    global_info, _ = get_or_create_room('global')
+    with global_info['lock']:
+        global_info['members'].add(username)
+        ROOM_DIRECTORY.update('global', len(global_info['members']))
+    memberships.add('global')
+    if room == current_active:
+        new_active = 'global'
+        _set_active_room(username, new_active)
+    else:
+        new_active = current_active
     send_line(conn, f"Has salido de la sala '{room}'. Sala activa: {new_active}.")
     broadcast_room(
         room,
@@ -202,39 +639,157 @@ def handle_leave_command(username, conn, target_room=None):
             'type': 'system',
             'text': f"{username} ha abandonado la sala '{room}'.",
             'time': now_ts(),
+            'epoch_ms': epoch_ms(),
         },
         exclude=username,
     )
 
 
-def handle_rooms_command(conn):
-    with rooms_lock:
-        public_rooms = [(room, len(info['members'])) for room, info in rooms.items() if not info.get('password')]
-    if not public_rooms:
+ROOMS_PAGE = 100  # salas por respuesta de /rooms si no se pide otra cantidad
+ROOMS_MAX_PAGE = 1000
+ROOMS_USAGE = "Uso: /rooms [prefijo=TEXTO] [desde=SALA] [max=N] | /rooms activas [max=N]"
+
+
+def handle_rooms_command(conn, *options):
+    """Página de salas públicas en orden alfabético (o las más activas) a
+    partir de ROOM_DIRECTORY, sin recorrer ``rooms``."""
+    prefix, after, limit, active = '', None, ROOMS_PAGE, False
+    for option in options:
+        if option is None:
+            continue
+        key, has_value, value = option.partition('=')
+        key = key.lower()
+        if key == 'activas' and not has_value:
+            active = True
+        elif key == 'prefijo' and has_value:
+            prefix = value
+        elif key == 'desde' and has_value:
+            after = value
+        elif key == 'max' and value.isdigit() and int(value) > 0:
+            limit = min(int(value), ROOMS_MAX_PAGE)
+        else:
+            send_line(conn, ROOMS_USAGE)
+            return
+    if active:
+        ranked = ROOM_DIRECTORY.most_active(limit)
+        listing = ', '.join(f"{room} ({count})" for room, count in ranked) or "(ninguna)"
+        send_line(conn, "Salas públicas más activas: " + listing)
+        return
+    found, cursor = ROOM_DIRECTORY.page(prefix, after, limit)
+    if not found:
         send_line(conn, "Salas públicas disponibles: (ninguna)")
         return
-    parts = []
-    for room, count in sorted(public_rooms, key=lambda x: x[0].lower()):
-        parts.append(f"{room} (vacía)" if count == 0 else room)
+    parts = [f"{room} (vacía)" if count == 0 else room for room, count in found]
     send_line(conn, "Salas públicas disponibles: " + ', '.join(parts))
+    if cursor is not None:
+        # el aviso va en su propia línea: los clientes parten la anterior por comas
+        more = ['/rooms'] + ([f'prefijo={prefix}'] if prefix else []) + [f'desde={cursor}']
+        if limit != ROOMS_PAGE:
+            more.append(f'max={limit}')
+        send_line(conn, "ℹ️ Hay más salas: " + ' '.join(shlex.quote(part) for part in more))
+
+
+def _format_ms(seconds):
+    if seconds is None:
+        return '-'
+    return '∞' if seconds == float('inf') else f'≤{seconds * 1000:g} ms'
+
+
+def _format_count(bound):
+    if bound is None:
+        return '-'
+    return '∞' if bound == float('inf') else f'≤{bound:g}'
+
+
+def _by_label(family):
+    values = {label: child.value() for label, child in list(family.children.items())}
+    return ', '.join(f'{label}={count}' for label, count in sorted(values.items())) or '0'
+
+
+def handle_stats_command(conn):
+    """Resumen de las métricas para administradores (lo mismo que /metrics)."""
+    queues = outbound_stats()
+    with clients_lock:
+        users = len(clients)
+    handshakes = ', '.join(
+        f'{path} p50 {_format_ms(child.quantile(0.5))} p99 {_format_ms(child.quantile(0.99))}'
+        for path, child in sorted(HANDSHAKE_SECONDS.children.items())
+    ) or '-'
+    lines = [
+        f'📊 Conexiones: {CONNECTIONS.value() - DISCONNECTIONS.value()} abiertas, '
+        f'{CONNECTIONS.value()} aceptadas; {users} usuarios registrados.',
+        f'📊 Mensajes recibidos: {_by_label(MESSAGES_IN)}; entregados: {_by_label(MESSAGES_OUT)}.',
+        f'📊 Bytes: {BYTES_IN.value()} recibidos, {BYTES_OUT.value()} enviados.',
+        f'📊 Difusión: fan-out p50 {_format_count(FANOUT_SIZE.quantile(0.5))} '
+        f'p99 {_format_count(FANOUT_SIZE.quantile(0.99))}; '
+        f'duración p50 {_format_ms(BROADCAST_SECONDS.quantile(0.5))} p99 {_format_ms(BROADCAST_SECONDS.quantile(0.99))}.',
+        f"📊 Colas de salida: {sum(q['depth'] for q in queues)} frames, "
+        f"máx {max((q['depth'] for q in queues), default=0)}, "
+        f"{sum(1 for q in queues if q['lagging'])} rezagadas, {sum(q['dropped'] for q in queues)} descartados.",
+        f'📊 Handshake: {handshakes}.',
+    ]
+    for line in lines:
+        send_line(conn, line)
+
+
+def handle_profile_command(conn, seconds):
+    try:
+        duration = float(seconds) if seconds else PROFILE_SECONDS
+    except ValueError:
+        send_line(conn, "Uso: /profile [segundos]")
+        return
+    path = PROFILER.start(duration)
+    if path is None:
+        send_line(conn, "❌ Ya hay un perfil en curso.")
+        return
+    send_line(conn, f"🔬 Perfilando {min(duration, profiler.MAX_DURATION):g} s; resultado en {path}")
+
+
+def _start_profile_signal(signum, frame):
+    path = PROFILER.start(PROFILE_SECONDS)
+    if path:
+        LOGGER.info('Perfil de %g s iniciado por señal: %s', PROFILE_SECONDS, path)
+
+
+def check_rate(username, room):
+    """True si el mensaje puede difundirse. Si excede algún bucket lanza
+    RateLimited (política 'delay') o avisa al usuario y devuelve False."""
+    info = clients.get(username)
+    addr = info['addr'] if info else None
+    ip = addr[0] if isinstance(addr, tuple) else None
+    wait, scope = RATE_LIMITS.acquire({'user': username, 'room': room, 'ip': ip})
+    if scope is None:
+        return True
+    RATE_LIMITED.labels(scope).inc()
+    if RATE_POLICY == 'delay' and wait <= RATE_MAX_DELAY:
+        RATE_DELAY_SECONDS.observe(wait)
+        raise RateLimited(wait)
+    RATE_REJECTED.inc()
+    now = time.monotonic()
+    if info and now - info.get('rate_notice', 0.0) >= RATE_NOTICE_INTERVAL:
+        info['rate_notice'] = now
+        text = 'Estás enviando mensajes demasiado rápido; se descartaron.'
+        try:
+            if info['protocol'] == 'json':
+                send_json(info['conn'], {'type': 'system', 'text': text, 'time': now_ts(), 'epoch_ms': epoch_ms()})
+            else:
+                send_line(info['conn'], '⏳ ' + text)
+        except OSError:
+            pass
+    return False
 
 
 def handle_message(username, text):
-    with rooms_lock:
-        room = user_rooms.get(username, 'global')
-    broadcast_room(
+    room = user_rooms.get(username, 'global')
+    if RATE_LIMITS.active and not check_rate(username, room):
+        return
+    frame = broadcast_room(
         room,
         text=f"{username}: {text}",
-        json_obj={'type': 'msg', 'user': username, 'text': text, 'time': now_ts()},
+        json_obj={'type': 'msg', 'user': username, 'text': text, 'time': now_ts(), 'epoch_ms': epoch_ms()},
         exclude=username,
     )
-
-
-def parse_command(line):
-    try:
-        return shlex.split(line)
-    except ValueError:
-        return []
+    BACKLOG.append(room, frame)
 
 
 def handle_json_payload(username, conn, line):
@@ -244,39 +799,15 @@ def handle_json_payload(username, conn, line):
         LOGGER.warning('JSON inválido recibido de %s: %s', username, line)
         send_json(
             conn,
-            {'type': 'system', 'text': 'JSON inválido recibido.', 'time': now_ts()},
+            {'type': 'system', 'text': 'JSON inválido recibido.', 'time': now_ts(), 'epoch_ms': epoch_ms()},
         )
         return
 
     mtype = msg.get('type')
     if mtype == 'msg':
         text = msg.get('text', '')
-        if text.startswith('/listar'):
-            with clients_lock:
-                users = list(clients.keys())
-            send_json(
-                conn,
-                {
-                    'type': 'list_response',
-                    'users': users,
-                    'time': now_ts(),
-                },
-            )
-        elif text.startswith('/quitar'):
-            send_json(
-                conn,
-                {'type': 'system', 'text': 'Desconectando...', 'time': now_ts()},
-            )
-            raise DisconnectRequested()
-        elif text.startswith('/'):
-            send_json(
-                conn,
-                {
-                    'type': 'system',
-                    'text': 'Comando no soportado en modo JSON.',
-                    'time': now_ts(),
-                },
-            )
+        if text[:1] == '/':
+            JSON_COMMANDS.dispatch(text, conn, username, conn)
         else:
             handle_message(username, text)
     elif mtype == 'join':
@@ -286,6 +817,7 @@ def handle_json_payload(username, conn, line):
                 'type': 'system',
                 'text': 'Ya estás conectado.',
                 'time': now_ts(),
+                'epoch_ms': epoch_ms(),
             },
         )
     elif mtype == 'system':
@@ -297,6 +829,7 @@ def handle_json_payload(username, conn, line):
                 'type': 'system',
                 'text': 'Tipo de mensaje desconocido.',
                 'time': now_ts(),
+                'epoch_ms': epoch_ms(),
             },
         )
 
@@ -313,43 +846,213 @@ def parse_client_handshake_line(line):
     return info
 
 
-def handle_command(username, conn, line):
-    parts = parse_command(line)
-    if not parts:
-        send_line(conn, "❌ Comando inválido.")
-        return
-    cmd = parts[0].lower()
-    if cmd == '/join':
-        if len(parts) < 2:
-            send_line(conn, "Uso: /join <sala> [contraseña]")
-            return
-        room = parts[1]
-        password = parts[2] if len(parts) > 2 else None
-        handle_join_command(username, conn, room, password)
-    elif cmd == '/leave':
-        target = parts[1] if len(parts) > 1 else None
-        handle_leave_command(username, conn, target)
-    elif cmd == '/rooms':
-        handle_rooms_command(conn)
-    elif cmd == '/quitar':
-        send_line(conn, "👋 Desconectado por solicitud.")
-        raise DisconnectRequested()
+def handle_quit_command(username, conn):
+    send_line(conn, "👋 Desconectado por solicitud.")
+    raise DisconnectRequested()
+
+
+def send_system_json(conn, text):
+    send_json(conn, {'type': 'system', 'text': text, 'time': now_ts(), 'epoch_ms': epoch_ms()})
+
+
+def handle_json_list_command(username, conn):
+    if ROOM_BUS is not None:
+        # réplica local de la presencia del hub: /listar no espera al bus. El
+        # hub anuncia el alta después de contestar el claim, así que quien
+        # recién entró puede no estar todavía.
+        with PRESENCE.lock:
+            users = list(PRESENCE.users)
+            if username not in PRESENCE.users:
+                users.append(username)
+    else:
+        with clients_lock:
+            users = list(clients.keys())
+    send_json(
+        conn,
+        {
+            'type': 'list_response',
+            'users': users,
+            'time': now_ts(),
+            'epoch_ms': epoch_ms(),
+        },
+    )
+
+
+def handle_json_quit_command(username, conn):
+    send_system_json(conn, 'Desconectando...')
+    raise DisconnectRequested()
+
+
+# ---------------------------------------------------------------------------
+# Presencia por suscripción (/presencia en modo JSON)
+# ---------------------------------------------------------------------------
+
+PRESENCE_PAGE = 500  # usuarios por mensaje de la instantánea inicial
+
+
+def _presence_line(obj):
+    obj['time'] = now_ts()
+    obj['epoch_ms'] = epoch_ms()
+    return (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+class PresenceSubscriber:
+    __slots__ = ('username', 'conn', 'pending')
+
+    def __init__(self, username, conn):
+        self.username = username
+        self.conn = conn
+        # deltas que llegan mientras se codifica la instantánea; None = en vivo
+        self.pending = []
+
+
+class Presence:
+    """Usuarios conectados y una versión que sube con cada alta o baja.
+
+    ``/presencia`` manda la lista completa en páginas de PRESENCE_PAGE
+    usuarios (``presence_snapshot``, todas con la versión del momento) y
+    desde ahí un ``presence`` por alta o baja con la versión siguiente. Un
+    cliente que ve un salto de versión (p. ej. su cola de salida descartó
+    frames) vuelve a pedir ``/presencia``. Los deltas se encolan bajo ``lock``
+    para que ningún suscriptor los reciba desordenados. Con --workers la
+    versión la pone el hub y los deltas llegan por el bus.
+    """
+
+    def __init__(self):
+        self.users = {}  # username -> None (dict: conserva el orden de llegada)
+        self.version = 0
+        self.subscribers = {}  # username -> PresenceSubscriber
+        self.lock = threading.Lock()
+
+    def apply(self, event, username, version=None):
+        """Registra un alta ('join') o una baja ('leave') y la avisa."""
+        with self.lock:
+            if version is None:
+                version = self.version + 1
+            elif version <= self.version:
+                return  # ya incluido en la sincronización con el hub
+            if event == 'join':
+                self.users[username] = None
+            else:
+                self.users.pop(username, None)
+                self.subscribers.pop(username, None)
+            self.version = version
+            if not self.subscribers:
+                return
+            data = _presence_line({'type': 'presence', 'event': event, 'user': username, 'version': version})
+            for sub in self.subscribers.values():
+                if sub.pending is not None:
+                    sub.pending.append(data)
+                    continue
+                try:
+                    sub.conn.sendall(data)
+                except Exception as exc:
+                    SEND_FAILURES.warning(sub.username, exc)
+
+    def reset(self, users, version):
+        """Estado completo (sincronización con el hub o traspaso en caliente)."""
+        with self.lock:
+            self.users = dict.fromkeys(users)
+            self.version = version
+
+    def subscribe(self, username, conn):
+        sub = PresenceSubscriber(username, conn)
+        with self.lock:
+            users = list(self.users)
+            version = self.version
+            self.subscribers[username] = sub
+        # la instantánea se codifica fuera del lock; lo que cambie mientras
+        # tanto queda en sub.pending y sale justo detrás
+        pages = [users[start:start + PRESENCE_PAGE] for start in range(0, len(users), PRESENCE_PAGE)] or [[]]
+        data = b''.join(
+            _presence_line(
+                {
+                    'type': 'presence_snapshot',
+                    'version': version,
+                    'users': page,
+                    'page': number,
+                    'last': number == len(pages) - 1,
+                }
+            )
+            for number, page in enumerate(pages)
+        )
+        with self.lock:
+            if self.subscribers.get(username) is not sub:
+                return  # se desconectó o volvió a suscribirse mientras tanto
+            pending, sub.pending = sub.pending, None
+            conn.sendall(data + b''.join(pending))
+
+    def resume(self, username, conn):
+        """Suscriptor que ya recibió la instantánea (traspaso en caliente)."""
+        sub = PresenceSubscriber(username, conn)
+        sub.pending = None
+        with self.lock:
+            self.subscribers[username] = sub
+
+    def unsubscribe(self, username):
+        with self.lock:
+            return self.subscribers.pop(username, None) is not None
+
+
+PRESENCE = Presence()
+metrics.gauge('chat_presence_subscribers', 'Sesiones suscriptas a /presencia.', lambda: len(PRESENCE.subscribers))
+
+
+def handle_json_presence_command(username, conn, mode):
+    if mode is None:
+        PRESENCE.subscribe(username, conn)
+    elif mode.lower() == 'off':
+        if PRESENCE.unsubscribe(username):
+            send_system_json(conn, 'Suscripción a /presencia cancelada.')
     else:
-        send_line(conn, "❌ Comando desconocido.")
+        send_system_json(conn, 'Uso: /presencia [off]')
+
+
+# Los handlers reciben (username, conn, *argumentos).
+COMMANDS = CommandRegistry(send_line)
+COMMANDS.register('/join', handle_join_command, min_args=1, max_args=2, usage="Uso: /join <sala> [contraseña]")
+COMMANDS.register('/leave', handle_leave_command, max_args=1)
+COMMANDS.register('/rooms', lambda username, conn, *options: handle_rooms_command(conn, *options), max_args=3)
+COMMANDS.register('/quitar', handle_quit_command)
+COMMANDS.register('/stats', lambda username, conn: handle_stats_command(conn), admin=True)
+COMMANDS.register(
+    '/profile', lambda username, conn, seconds: handle_profile_command(conn, seconds), max_args=1, admin=True
+)
+
+# En modo JSON los comandos viajan como texto de un 'msg' y sólo hay estos.
+JSON_COMMANDS = CommandRegistry(
+    send_system_json,
+    invalid='Comando no soportado en modo JSON.',
+    unknown='Comando no soportado en modo JSON.',
+)
+JSON_COMMANDS.register('/listar', handle_json_list_command)
+JSON_COMMANDS.register('/quitar', handle_json_quit_command)
+JSON_COMMANDS.register('/presencia', handle_json_presence_command, max_args=1)
+
+
+def handle_command(username, conn, line):
+    COMMANDS.dispatch(line, conn, username, conn, is_admin=username in ADMIN_USERS)
 
 
 def cleanup_user(username):
-    with rooms_lock:
-        memberships = user_memberships.pop(username, set())
-        current = user_rooms.pop(username, None)
-        rooms_to_notify = []
-        for room in memberships:
-            info = rooms.get(room)
-            if info:
+    memberships = user_memberships.pop(username, set())
+    current = user_rooms.pop(username, None)
+    if current is not None:
+        _remove_viewer(current, username)
+    rooms_to_notify = []
+    for room in memberships:
+        info = rooms.get(room)
+        if info:
+            with info['lock']:
                 info['members'].discard(username)
-                rooms_to_notify.append(room)
+                ROOM_DIRECTORY.update(room, len(info['members']))
+            rooms_to_notify.append(room)
     with clients_lock:
         info = clients.pop(username, None)
+    if info and ROOM_BUS is not None:
+        ROOM_BUS.release(username)
+    elif info:
+        PRESENCE.apply('leave', username)
     if info and info.get('conn'):
         try:
             info['conn'].close()
@@ -364,116 +1067,201 @@ def cleanup_user(username):
                 'type': 'system',
                 'text': f"{username} se ha desconectado de la sala '{room}'.",
                 'time': now_ts(),
+                'epoch_ms': epoch_ms(),
             },
             exclude=username,
         )
 
 
-def handle_client(conn, addr):
-    buffer = ''
-    username = None
-    pending_lines = []
-    pending_json_lines = []
-    handshake_username = None
-    protocol = None
-    handshake_sent = False
-    LOGGER.info('Conexión entrante de %s', addr)
-    registered = False
-    try:
-        conn.settimeout(1.0)
+HELLO_BANNER = f"HELLO_V5 features=rooms,public_rooms,sidebar,json,{binwire.FEATURE},{compression.FEATURE},ping"
 
-        while username is None:
-            try:
-                data = conn.recv(4096)
-                if not data:
-                    raise ConnectionResetError()
-                decoded = data.decode('utf-8', errors='replace')
-                buffer += decoded
-                LOGGER.debug('Datos iniciales desde %s: %r', addr, decoded)
-            except socket.timeout:
-                if not handshake_sent:
-                    LOGGER.debug('Timeout inicial desde %s: enviando HELLO_V5', addr)
-                    send_line(conn, "HELLO_V5 features=rooms,public_rooms,sidebar,json")
-                    send_line(conn, "Ingresa tu nombre (NOMBRE):")
-                    handshake_sent = True
-                    protocol = 'text'
-                    conn.settimeout(0.5)
-                continue
 
-            while '\n' in buffer and username is None:
-                line, buffer = buffer.split('\n', 1)
-                line = line.strip('\r')
-                if not line:
-                    continue
-                LOGGER.debug('Línea inicial de %s: %s', addr, line)
-                if line.startswith('{'):
-                    try:
-                        msg = json.loads(line)
-                    except json.JSONDecodeError:
-                        LOGGER.warning('JSON inicial inválido desde %s: %s', addr, line)
-                        if protocol == 'json':
-                            continue
-                    else:
-                        if msg.get('type') == 'join':
-                            candidate = msg.get('user', '').strip()
-                            if not candidate:
-                                send_json(
-                                    conn,
-                                    {
-                                        'type': 'system',
-                                        'text': 'Nombre de usuario inválido.',
-                                        'time': now_ts(),
-                                    },
-                                )
-                                return
-                            username = candidate
-                            protocol = 'json'
-                            continue
-                        else:
-                            LOGGER.warning('Mensaje inicial JSON inesperado de %s: %s', addr, msg)
-                            continue
-                if line.upper().startswith('CLIENT_V5'):
-                    protocol = 'text'
-                    info = parse_client_handshake_line(line)
-                    candidate = info.get('username')
-                    if candidate:
-                        username = candidate.strip()
-                        handshake_username = username
+class ClientSession:
+    """Estado de una conexión: handshake, registro y despacho de líneas.
+
+    Lo usan tanto el motor de hilos (handle_client) como el motor de event
+    loop (EventLoopServer), así ambos respetan exactamente la misma semántica
+    de handle_command / handle_json_payload.
+    """
+
+    def __init__(self, conn, addr, resumed=False):
+        self.conn = conn
+        self.addr = addr
+        self.framer = LineFramer(MAX_LINE_LENGTH)
+        self.username = None
+        self.protocol = None
+        self.handshake_username = None
+        self.handshake_sent = False
+        self.handshake_path = None
+        self.registered = False
+        self.connected_at = time.monotonic()
+        self.close_reason = 'closed'
+        # latidos (ver HeartbeatMonitor): cada recv anota last_seen
+        self.heartbeat = False  # el cliente negoció ping=1: contesta PING con PONG
+        self.last_seen = self.connected_at
+        self.ping_sent_at = None
+        self.wheel_tick = None
+        self.in_handshake = True  # ocupa un lugar de handshake en ADMISSION
+        self.bus_claim = None  # respuesta del hub al claim (BUS_DEFERRED)
+        # traspaso en caliente (motor de hilos): hilo lector, bytes leídos
+        # durante la pausa y si el hilo ya está detenido o terminó
+        self.reader = None
+        self.unread = b''
+        self.parked = False
+        self.done = False
+        SESSIONS.add(self)
+        if resumed:
+            return  # restore_session completa el resto
+        CONNECTIONS.inc()
+        lifecycle_event('connect', addr=_addr_text(addr))
+        if HEARTBEATS is not None:
+            HEARTBEATS.track(self)
+
+    def send_handshake_banner(self):
+        LOGGER.debug('Timeout inicial desde %s: enviando HELLO_V5', self.addr)
+        send_line(self.conn, HELLO_BANNER)
+        send_line(self.conn, "Ingresa tu nombre (NOMBRE):")
+        self.handshake_sent = True
+        self.protocol = 'text'
+
+    def handle_line(self, line):
+        """Procesa una línea completa. Devuelve False si la conexión debe cerrarse."""
+        line = line.strip('\r')
+        if not line:
+            return True
+        if self.heartbeat and (line == 'PONG' or line == 'PING'):
+            # ya cuenta como actividad; PING es el cliente comprobando al servidor
+            if line == 'PING':
+                send_line(self.conn, 'PONG')
+            return True
+        if self.username is None:
+            LOGGER.debug('Línea inicial de %s: %s', self.addr, line)
+            if not self._handle_handshake_line(line):
+                return False
+            if self.username is None:
+                return True
+            return self._register()
+        if not self.registered:
+            return self._register()  # misma línea tras BusPending
+        self.dispatch(line)
+        return True
+
+    def _handle_handshake_line(self, line):
+        if line.startswith('{'):
+            try:
+                msg = json.loads(line)
+            except json.JSONDecodeError:
+                LOGGER.warning('JSON inicial inválido desde %s: %s', self.addr, line)
+            else:
+                if msg.get('type') == 'join':
+                    candidate = msg.get('user', '').strip()
+                    if not candidate:
+                        send_json(
+                            self.conn,
+                            {
+                                'type': 'system',
+                                'text': 'Nombre de usuario inválido.',
+                                'time': now_ts(),
+                                'epoch_ms': epoch_ms(),
+                            },
+                        )
+                        return False
+                    self.username = candidate
+                    self.protocol = 'json'
+                    self.handshake_path = 'json'
                 else:
-                    protocol = protocol or 'text'
-                    username = line.strip()
+                    LOGGER.warning('Mensaje inicial JSON inesperado de %s: %s', self.addr, msg)
+                return True
+        if line.upper().startswith('CLIENT_V5'):
+            self.protocol = 'text'
+            self.handshake_path = 'client_v5'
+            info = parse_client_handshake_line(line)
+            candidate = info.get('username')
+            if candidate:
+                self.username = candidate.strip()
+                self.handshake_username = self.username
+            self.heartbeat = info.get('ping') == '1'
+            binary = info.get('wire') == binwire.FEATURE
+            compressed = info.get('compress') == compression.FEATURE
+            if binary or compressed:
+                self._switch_wire(binary, compressed)
+        else:
+            self.protocol = self.protocol or 'text'
+            self.username = line.strip()
+            # el camino legado: el nombre llega solo, normalmente tras el banner
+            self.handshake_path = 'timeout' if self.handshake_sent else 'text'
+        return True
+
+    def _switch_wire(self, binary, compressed):
+        """Acusa lo negociado (últimas líneas de texto) y cambia el framing.
+
+        El cliente no manda frames ni bytes comprimidos hasta leer los
+        acuses, así que en el framer de líneas no debería quedar nada.
+        """
+        if binary:
+            send_line(self.conn, binwire.ACK_LINE)
+        if compressed:
+            send_line(self.conn, compression.ACK_LINE)
+        if len(self.framer):
+            LOGGER.warning('%s envió datos antes del acuse; se descartan', self.addr)
+        if binary:
+            self.protocol = binwire.FEATURE
+            self.framer = binwire.LineFrameReader(MAX_LINE_LENGTH)
+            self.handshake_username = None
+        else:
+            self.framer = LineFramer(MAX_LINE_LENGTH)
+        if compressed:
+            self.framer = compression.InflatingFramer(self.framer)
+            self.conn.enable_compression()
 
+    def _register(self):
+        username = self.username
+        conn = self.conn
         if not username:
-            LOGGER.warning('Nombre inválido recibido desde %s', addr)
-            if protocol == 'json':
+            LOGGER.warning('Nombre inválido recibido desde %s', self.addr)
+            lifecycle_event('reject', addr=_addr_text(self.addr), reason='invalid_name')
+            if self.protocol == 'json':
                 send_json(
                     conn,
-                    {'type': 'system', 'text': 'Nombre inválido.', 'time': now_ts()},
+                    {'type': 'system', 'text': 'Nombre inválido.', 'time': now_ts(), 'epoch_ms': epoch_ms()},
                 )
             else:
                 send_line(conn, 'Nombre inválido. Cerrando.')
-            return
-
-        conn.settimeout(0.5)
+            return False
 
-        if not register_client(username, conn, addr, protocol or 'text'):
-            LOGGER.warning('Nombre %s en uso para %s', username, addr)
-            if protocol == 'json':
+        if not register_client(username, conn, self.addr, self.protocol or 'text'):
+            LOGGER.warning('Nombre %s en uso para %s', username, self.addr)
+            lifecycle_event('reject', addr=_addr_text(self.addr), user=username, reason='name_in_use')
+            if self.protocol == 'json':
                 send_json(
                     conn,
-                    {'type': 'system', 'text': 'Nombre en uso.', 'time': now_ts()},
+                    {'type': 'system', 'text': 'Nombre en uso.', 'time': now_ts(), 'epoch_ms': epoch_ms()},
                 )
             else:
                 send_line(conn, 'Nombre en uso. Intenta con otro.')
-            return
+            return False
 
         initialize_memberships(username)
-        registered = True
+        self.registered = True
+        if HEARTBEATS is not None:
+            HEARTBEATS.track(self)  # del plazo de registro a latidos/inactividad
+        self.in_handshake = False
+        ADMISSION.registered()
+        handshake = time.monotonic() - self.connected_at
+        HANDSHAKE_SECONDS.labels(self.handshake_path or 'text').observe(handshake)
+        lifecycle_event(
+            'register',
+            addr=_addr_text(self.addr),
+            user=username,
+            protocol=self.protocol,
+            handshake=self.handshake_path or 'text',
+            handshake_ms=round(handshake * 1000, 3),
+        )
 
-        if protocol == 'json':
+        if self.protocol == 'json':
             send_json(
                 conn,
-                {'type': 'system', 'text': f'Bienvenido {username}!', 'time': now_ts()},
+                {'type': 'system', 'text': f'Bienvenido {username}!', 'time': now_ts(), 'epoch_ms': epoch_ms()},
             )
         else:
             send_line(conn, f"✅ Bienvenido {username}. Estás en 'global'.")
@@ -485,102 +1273,1946 @@ def handle_client(conn, addr):
                 'type': 'system',
                 'text': f'{username} se ha unido al chat.',
                 'time': now_ts(),
+                'epoch_ms': epoch_ms(),
             },
             exclude=username,
         )
+        return True
 
-        # procesar datos pendientes acumulados durante el handshake
-        if protocol == 'text':
-            while '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
-                line = line.strip('\r')
-                if not line:
-                    continue
-                pending_lines.append(line)
-            for pending in pending_lines:
-                if not pending:
-                    continue
-                if handshake_username and pending.strip() == handshake_username:
-                    handshake_username = None
-                    continue
-                if pending.startswith('/'):
-                    handle_command(username, conn, pending)
-                else:
-                    handle_message(username, pending)
+    def dispatch(self, line):
+        if self.protocol == 'json':
+            handle_json_payload(self.username, self.conn, line)
+        elif self.handshake_username and line.strip() == self.handshake_username:
+            self.handshake_username = None
+        elif line.startswith('/'):
+            handle_command(self.username, self.conn, line)
         else:
-            while '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
-                line = line.strip('\r')
-                if line:
-                    pending_json_lines.append(line)
-            for pending in pending_json_lines:
-                handle_json_payload(username, conn, pending)
-
-        while True:
-            if '\n' not in buffer:
-                try:
-                    data = conn.recv(4096)
-                    if not data:
-                        raise ConnectionResetError()
-                    decoded = data.decode('utf-8', errors='replace')
-                    buffer += decoded
-                    LOGGER.debug('Datos recibidos de %s (%s): %r', username, protocol, decoded)
-                except socket.timeout:
-                    continue
+            handle_message(self.username, line)
+        # se cuenta al final: una línea demorada (RateLimited) se reintenta
+        # y cuenta una sola vez
+        MESSAGES_IN.labels(self.protocol).inc()
 
-            while '\n' in buffer:
-                line, buffer = buffer.split('\n', 1)
-                line = line.strip('\r')
-                if not line:
-                    continue
-                if protocol == 'json':
-                    handle_json_payload(username, conn, line)
-                else:
-                    if handshake_username and line.strip() == handshake_username:
-                        handshake_username = None
-                        continue
-                    if line.startswith('/'):
-                        handle_command(username, conn, line)
-                    else:
-                        handle_message(username, line)
-    except DisconnectRequested:
-        LOGGER.info('Desconexión solicitada por %s', username or addr)
-    except (ConnectionResetError, BrokenPipeError):
-        LOGGER.info('Conexión perdida con %s', username or addr)
-    except Exception as exc:
-        LOGGER.exception('Error manejando a %s: %s', username or addr, exc)
-    finally:
-        if registered and username:
-            cleanup_user(username)
+    def reject_long_line(self):
+        text = 'Línea demasiado larga. Cerrando.'
         try:
-            conn.close()
-        except Exception:
+            if self.protocol == 'json':
+                send_json(self.conn, {'type': 'system', 'text': text, 'time': now_ts(), 'epoch_ms': epoch_ms()})
+            else:
+                send_line(self.conn, '❌ ' + text)
+        except OSError:
             pass
 
+    def cleanup(self):
+        if self.registered and self.username:
+            self.registered = False
+            cleanup_user(self.username)
 
-def accept_loop(server_sock):
-    LOGGER.info('Escuchando en %s:%s', HOST, PORT)
-    while True:
-        try:
-            conn, addr = server_sock.accept()
-            LOGGER.info('Conexión aceptada de %s', addr)
-            thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-            thread.start()
-        except KeyboardInterrupt:
-            LOGGER.info('Detenido por KeyboardInterrupt')
-            break
-        except Exception as exc:
-            LOGGER.exception('Error en accept(): %s', exc)
-            break
+    def mark_closed(self, reason):
+        """Anota el motivo del cierre; gana el primero (p. ej. el corte por
+        falta de PONG frente al reset que provoca al cerrar el socket)."""
+        if self.close_reason == 'closed':
+            self.close_reason = reason
+
+    def closed(self):
+        """La conexión terminó (la llama cada motor una sola vez)."""
+        if HEARTBEATS is not None:
+            HEARTBEATS.forget(self)
+        SESSIONS.discard(self)
+        self.done = True
+        ADMISSION.release(self.addr[0], self.in_handshake)
+        DISCONNECTIONS.inc()
+        lifecycle_event(
+            'disconnect',
+            addr=_addr_text(self.addr),
+            user=self.username,
+            reason=self.close_reason,
+            duration_s=round(time.monotonic() - self.connected_at, 3),
+        )
 
 
-def main():
-    LOGGER.info('Arrancando server_v5 en %s:%s', HOST, PORT)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((HOST, PORT))
-        s.listen(200)
-        accept_loop(s)
+# ---------------------------------------------------------------------------
+# Latidos y sesiones inactivas
+# ---------------------------------------------------------------------------
+
+
+class HeartbeatMonitor:
+    """Corta sesiones muertas o inactivas usando una TimingWheel.
+
+    La actividad nunca toca la rueda: cada recv sólo anota ``last_seen``.
+    Cuando una sesión vence se mira cuánto hace que habló y se la reprograma
+    por lo que le falta, se le manda PING o se la corta. Así cada tick cuesta
+    lo que vence en ese tick, no un temporizador por conexión.
+
+    - sin registrar: se corta a los LOGIN_TIMEOUT segundos de conectar;
+    - con ``ping=1``: PING tras HEARTBEAT_INTERVAL sin tráfico y corte si el
+      PONG (o cualquier otra línea) no llega en HEARTBEAT_TIMEOUT;
+    - el resto (texto legado, JSON): corte tras IDLE_TIMEOUT, si hay; si no,
+      sólo las detecta el keepalive de TCP.
+    """
+
+    def __init__(self, wheel):
+        self.wheel = wheel
+
+    def track(self, session):
+        self._arm(session, time.monotonic())
+
+    def forget(self, session):
+        self.wheel.cancel(session)
+
+    def tick(self):
+        now = time.monotonic()
+        for session in self.wheel.advance(now):
+            try:
+                self._arm(session, now)
+            except Exception as exc:
+                LOGGER.exception('Error revisando la sesión de %s: %s', session.conn.label, exc)
+
+    def _arm(self, session, now):
+        delay = self._check(session, now)
+        if delay is not None:
+            self.wheel.schedule(session, delay)
+
+    def _check(self, session, now):
+        """Segundos hasta volver a mirar la sesión (None = no seguirla)."""
+        if session.conn.closed or session.conn.closing:
+            return None
+        if not session.registered:
+            if not LOGIN_TIMEOUT:
+                return None
+            elapsed = now - session.connected_at
+            if elapsed >= LOGIN_TIMEOUT:
+                return self._reap(session, 'login_timeout')
+            return LOGIN_TIMEOUT - elapsed
+        idle = now - session.last_seen
+        if session.heartbeat and HEARTBEAT_INTERVAL:
+            if session.ping_sent_at is not None:
+                if session.last_seen < session.ping_sent_at:
+                    waited = now - session.ping_sent_at
+                    if waited >= HEARTBEAT_TIMEOUT:
+                        return self._reap(session, 'heartbeat_timeout')
+                    return HEARTBEAT_TIMEOUT - waited
+                session.ping_sent_at = None
+            if idle < HEARTBEAT_INTERVAL:
+                return HEARTBEAT_INTERVAL - idle
+            session.ping_sent_at = now
+            HEARTBEAT_PINGS.inc()
+            try:
+                send_line(session.conn, 'PING')
+            except OSError:
+                return self._reap(session, 'reset')
+            return HEARTBEAT_TIMEOUT
+        if not IDLE_TIMEOUT:
+            return None
+        if idle >= IDLE_TIMEOUT:
+            return self._reap(session, 'idle_timeout')
+        return IDLE_TIMEOUT - idle
+
+    def _reap(self, session, reason):
+        LOGGER.info('Cortando la sesión de %s (%s)', session.conn.label, reason)
+        SESSIONS_REAPED.labels(reason).inc()
+        session.mark_closed(reason)
+        # cada motor termina el cierre: el hilo lector sale del recv y el
+        # event loop la cierra al final de la vuelta
+        session.conn.abort()
+        return None
+
+
+metrics.gauge(
+    'chat_heartbeat_tracked_sessions',
+    'Sesiones programadas en la rueda de latidos.',
+    lambda: len(HEARTBEATS.wheel) if HEARTBEATS is not None else 0,
+)
+
+
+def heartbeat_loop():
+    """Motor de hilos: avanza la rueda una vez por tick."""
+    while True:
+        time.sleep(HEARTBEATS.wheel.tick)
+        if not FREEZE.frozen:
+            HEARTBEATS.tick()
+
+
+def configure_keepalive(sock):
+    """TCP keepalive en el socket de escucha: las conexiones aceptadas heredan
+    las opciones (Linux), así que no cuesta nada por conexión."""
+    idle, interval, count = KEEPALIVE
+    if idle <= 0:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+        option = getattr(socket, name, None)
+        if option is not None and value > 0:
+            sock.setsockopt(socket.IPPROTO_TCP, option, int(value))
+
+
+# ---------------------------------------------------------------------------
+# Admisión de conexiones
+# ---------------------------------------------------------------------------
+
+REFUSAL = '❌ Servidor saturado, intenta de nuevo en unos segundos.\n'.encode('utf-8')
+
+
+class Admission:
+    """Cupos que se controlan en accept(), antes de crear hilo, sesión o colas.
+
+    ``admit`` reserva un lugar (sesión, handshake en curso y conexión de la
+    IP) o devuelve el motivo del rechazo. ``registered`` devuelve el lugar de
+    handshake cuando la sesión se registra y ``release`` el resto al cerrar.
+    Un cupo en 0 no limita. Con ``--workers N`` los cupos son por worker.
+    """
+
+    def __init__(self, max_sessions=0, max_handshakes=0, max_per_ip=0):
+        self.max_sessions = max_sessions
+        self.max_handshakes = max_handshakes
+        self.max_per_ip = max_per_ip
+        self.sessions = 0
+        self.handshakes = 0
+        self.per_ip = {}
+        self.lock = threading.Lock()
+
+    def admit(self, ip):
+        with self.lock:
+            if self.max_sessions and self.sessions >= self.max_sessions:
+                return 'sessions'
+            if self.max_handshakes and self.handshakes >= self.max_handshakes:
+                return 'handshakes'
+            count = self.per_ip.get(ip, 0)
+            if self.max_per_ip and count >= self.max_per_ip:
+                return 'per_ip'
+            self.sessions += 1
+            self.handshakes += 1
+            self.per_ip[ip] = count + 1
+        return None
+
+    def registered(self):
+        with self.lock:
+            self.handshakes -= 1
+
+    def release(self, ip, in_handshake):
+        with self.lock:
+            self.sessions -= 1
+            if in_handshake:
+                self.handshakes -= 1
+            count = self.per_ip.get(ip, 0) - 1
+            if count > 0:
+                self.per_ip[ip] = count
+            else:
+                self.per_ip.pop(ip, None)
+
+
+ADMISSION = Admission(max_handshakes=MAX_HANDSHAKES)
+SHED_WARNINGS = log_pipeline.WarningAggregator(
+    LOGGER,
+    'Conexión rechazada por sobrecarga (%s): %s',
+    '%d conexiones más rechazadas por sobrecarga (%s) en el último segundo (última: %s)',
+)
+metrics.gauge('chat_sessions_open', 'Conexiones admitidas y abiertas.', lambda: ADMISSION.sessions)
+metrics.gauge('chat_handshakes_in_flight', 'Conexiones admitidas que no completaron el registro.', lambda: ADMISSION.handshakes)
+
+
+def shed(sock, addr, reason):
+    """Rechaza una conexión recién aceptada con una línea ya codificada: sin
+    hilo, sesión ni colas de por medio, y sin esperar a que el cliente lea."""
+    SHED.labels(reason).inc()
+    SHED_WARNINGS.warning(reason, addr)
+    lifecycle_event('shed', addr=_addr_text(addr), reason=reason)
+    try:
+        sock.send(REFUSAL, SEND_FLAGS)
+    except OSError:
+        pass
+    sock.close()
+
+
+# ---------------------------------------------------------------------------
+# Colas de salida por sesión
+# ---------------------------------------------------------------------------
+
+SEND_FLAGS = getattr(socket, 'MSG_DONTWAIT', 0)
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+SLOW_CONSUMER_POLICIES = ('drop_oldest', 'disconnect', 'lag')
+CLOSE_LINGER = 5.0  # segundos máximos para vaciar la cola al cerrar
+
+
+class OutboundQueue:
+    """Cola de salida acotada (en frames) de una sesión.
+
+    Políticas cuando se llena:
+     - drop_oldest: se descarta el frame pendiente más antiguo.
+     - disconnect: se desconecta al consumidor lento.
+     - lag: la sesión queda marcada como rezagada y se descartan los frames
+       nuevos hasta que la cola se vacía; entonces se le avisa cuántos perdió.
+    """
+
+    def __init__(self, limit=None, policy=None):
+        self.limit = max(2, limit or OUTBOUND_QUEUE_LIMIT)
+        self.policy = policy or SLOW_CONSUMER_POLICY
+        self.frames = collections.deque()
+        self.offset = 0  # bytes ya enviados del primer frame
+        self.sending = False
+        self.in_flight = 0  # frames entregados por peek al sendmsg en curso
+        self.dropped = 0
+        self.lagging = False
+        self.lag_dropped = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def push(self, data, send=None):
+        """Encola ``data``. Devuelve False si la política exige desconectar.
+
+        Si la cola está vacía y se pasa ``send`` (escritura no bloqueante que
+        devuelve los bytes aceptados), se escribe directamente y sólo se encola
+        el resto.
+        """
+        with self.lock:
+            if send is not None and not self.frames:
+                sent = send(data)
+                if sent >= len(data):
+                    return True
+                data = data[sent:]
+            if self.lagging:
+                self.dropped += 1
+                self.lag_dropped += 1
+                return True
+            if len(self.frames) >= self.limit:
+                if self.policy == 'disconnect':
+                    return False
+                self.dropped += 1
+                if self.policy == 'lag':
+                    self.lagging = True
+                    self.lag_dropped = 1
+                    return True
+                # los frames que peek entregó al sendmsg en curso y el primero
+                # a medio enviar no se tocan: se descarta el más viejo de los
+                # demás o, si no hay ninguno, el que llega
+                keep = self.in_flight if self.sending else (1 if self.offset else 0)
+                if len(self.frames) <= keep:
+                    return True
+                del self.frames[keep]
+            self.frames.append(data)
+            return True
+
+    def push_notice(self, data):
+        """Encola un aviso propio del servidor, aunque la cola esté llena."""
+        with self.lock:
+            self.frames.append(data)
+
+    def _views(self):
+        frames = self.frames
+        views = [memoryview(frames[0])[self.offset:]]
+        for i in range(1, min(len(frames), IOV_MAX)):
+            views.append(frames[i])
+        return views
+
+    def peek(self):
+        """Marca la cola como en envío y devuelve los frames pendientes (a lo
+        sumo IOV_MAX) para un único sendmsg, o None si está vacía."""
+        with self.lock:
+            if not self.frames:
+                return None
+            self.sending = True
+            views = self._views()
+            self.in_flight = len(views)
+            return views
+
+    def consume(self, sent):
+        """Descuenta ``sent`` bytes enviados.
+
+        Devuelve la cantidad de frames perdidos mientras la sesión estuvo
+        rezagada si la cola acaba de vaciarse (0 en cualquier otro caso).
+        """
+        with self.lock:
+            if not self.sending:
+                return 0  # clear() vació la cola durante el envío
+            self.sending = False
+            self.in_flight = 0
+            return self._consume_locked(sent)
+
+    def _consume_locked(self, sent):
+        self.offset += sent
+        while self.frames and self.offset >= len(self.frames[0]):
+            self.offset -= len(self.frames.popleft())
+        if not self.frames:
+            self.offset = 0
+        if not self.frames and self.lagging:
+            self.lagging = False
+            lost, self.lag_dropped = self.lag_dropped, 0
+            return lost
+        return 0
+
+    def flush(self, sendv):
+        """Envía de una vez lo pendiente con ``sendv(views)`` (no bloqueante).
+
+        No hace nada si el escritor del motor ya está enviando esta cola.
+        Devuelve lo mismo que ``consume``.
+        """
+        with self.lock:
+            if self.sending or not self.frames:
+                return 0
+            return self._consume_locked(sendv(self._views()))
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.offset = 0
+            self.sending = False
+            self.in_flight = 0
+
+    def detach(self):
+        """Saca todo lo pendiente como bytes (traspaso en caliente). Si el
+        escritor está a mitad de un envío, espera a que lo termine."""
+        while True:
+            with self.lock:
+                if not self.sending:
+                    data = b''.join(self._views()) if self.frames else b''
+                    self.frames.clear()
+                    self.offset = 0
+                    return data
+            time.sleep(0.001)
+
+
+def lag_notice(protocol, lost):
+    text = f"Conexión lenta: se descartaron {lost} mensajes."
+    if protocol == binwire.FEATURE:
+        return binwire.encode_text('⚠️ ' + text)
+    if protocol == 'json':
+        payload = json.dumps({'type': 'system', 'text': text, 'time': now_ts(), 'epoch_ms': epoch_ms()}, ensure_ascii=False)
+    else:
+        payload = '⚠️ ' + text
+    return (payload + '\n').encode('utf-8')
+
+
+# Conexiones con frames encolados durante el ciclo de despacho en curso del
+# hilo (dict usado como conjunto ordenado), o None fuera de un ciclo.
+_write_batch = threading.local()
+
+
+def begin_write_batch():
+    """Desde aquí, los sendall de este hilo sólo encolan (ver flush_write_batch)."""
+    if COALESCE_WRITES:
+        _write_batch.conns = {}
+
+
+def flush_write_batch():
+    """Cierra el ciclo: un sendmsg por conexión tocada con todos sus frames."""
+    conns = getattr(_write_batch, 'conns', None)
+    _write_batch.conns = None
+    if conns:
+        for conn in conns:
+            conn.flush()
+
+
+class BufferedConnection(abc.ABC):
+    """Interfaz de socket que usan los handlers (sendall/close).
+
+    ``sendall`` nunca bloquea. Dentro de un ciclo de despacho
+    (begin_write_batch/flush_write_batch) sólo encola, y al final del ciclo
+    todo lo acumulado sale en un único ``sendmsg`` vectorizado. Fuera de un
+    ciclo, si la cola está vacía escribe lo que el kernel acepte sin esperar.
+    En ambos casos el resto queda en la OutboundQueue de la sesión, que vacía
+    el escritor correspondiente al motor.
+
+    Cada motor la completa con ``wake_writer`` y ``abort``.
+    """
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.queue = OutboundQueue()
+        self.closed = False
+        self.closing = False
+        self.session = None
+        self.known_interns = set()  # ids bin1 ya definidos en esta conexión
+        self.intern_lock = threading.Lock()
+        self.deflater = None  # compression.Deflater si se negoció zlib
+        self.compress_lock = None
+        self.sync_pending = False
+
+    def enable_compression(self):
+        self.deflater = compression.Deflater()
+        self.compress_lock = threading.Lock()
+        # descartar bytes de un stream deflate lo corrompería
+        self.queue.policy = 'disconnect'
+
+    @property
+    def label(self):
+        if self.session and self.session.username:
+            return self.session.username
+        return self.addr
+
+    def sendall(self, data):
+        if self.closed or self.closing:
+            raise BrokenPipeError('Conexión cerrada')
+        batch = getattr(_write_batch, 'conns', None)
+        if self.deflater is not None:
+            # comprimir y encolar juntos mantiene el orden del stream
+            with self.compress_lock:
+                data = self.deflater.compress(data)
+                if batch is None:
+                    data += self.deflater.sync()
+                else:
+                    self.sync_pending = True  # el Z_SYNC_FLUSH va al final del ciclo
+                if data:
+                    self._push(data, batch)
+        else:
+            self._push(data, batch)
+        if batch is not None:
+            batch[self] = None
+        elif len(self.queue):
+            self.wake_writer()
+
+    def _push(self, data, batch):
+        try:
+            accepted = self.queue.push(data, self._send_now if batch is None else None)
+        except OSError:
+            self.abort()
+            raise BrokenPipeError('Conexión cerrada')
+        if not accepted:
+            LOGGER.warning('Cola de salida de %s llena (%d frames): desconectando', self.label, len(self.queue))
+            self.abort()
+            raise BrokenPipeError('Consumidor lento desconectado')
+
+    def _send_now(self, data):
+        try:
+            sent = self.sock.send(data, SEND_FLAGS)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        BYTES_OUT.inc(sent)
+        return sent
+
+    def _sendv(self, views):
+        try:
+            sent = self.sock.sendmsg(views, (), SEND_FLAGS)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        BYTES_OUT.inc(sent)
+        return sent
+
+    def _lost_frames(self, lost):
+        protocol = self.session.protocol if self.session else 'text'
+        self.queue.push_notice(lag_notice(protocol, lost))
+
+    def flush(self):
+        """Envía lo encolado en el ciclo; lo que no entre queda para el escritor."""
+        if self.closed:
+            return
+        if self.sync_pending:
+            with self.compress_lock:
+                self.sync_pending = False
+                if not self.queue.push(self.deflater.sync()):
+                    LOGGER.warning('Cola de salida de %s llena: desconectando', self.label)
+                    self.abort()
+                    return
+        try:
+            lost = self.queue.flush(self._sendv)
+        except OSError:
+            self.abort()
+            return
+        if lost:
+            self._lost_frames(lost)
+        if len(self.queue) or self.closing:
+            # el escritor envía el resto y, si se está cerrando, cierra
+            self.wake_writer()
+
+    def write_ready(self):
+        """Escribe sin bloquear lo que el socket acepte. True si la cola quedó vacía."""
+        while True:
+            views = self.queue.peek()
+            if views is None:
+                return True
+            try:
+                sent = self.sock.sendmsg(views, (), SEND_FLAGS)
+            except (BlockingIOError, InterruptedError):
+                self.queue.consume(0)
+                return False
+            except OSError:
+                self.queue.consume(0)
+                raise
+            lost = self.queue.consume(sent)
+            if lost:
+                self._lost_frames(lost)
+
+    @abc.abstractmethod
+    def wake_writer(self):
+        """Avisa al escritor del motor que la cola tiene datos pendientes."""
+
+    @abc.abstractmethod
+    def abort(self):
+        """Corta la conexión descartando lo que quede en la cola."""
+
+
+class ThreadedConnection(BufferedConnection):
+    """Conexión del motor de hilos: el hilo lector usa ``recv`` bloqueante y
+    el SocketWriter compartido vacía la cola cuando el socket es escribible."""
+
+    def __init__(self, sock, addr, writer):
+        super().__init__(sock, addr)
+        self.writer = writer
+        self.close_deadline = None
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def wake_writer(self):
+        self.writer.schedule(self)
+
+    def abort(self):
+        self.queue.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.closed or self.closing:
+            return
+        self.closing = True
+        self.close_deadline = time.monotonic() + CLOSE_LINGER
+        self.writer.schedule(self)
+
+
+class SocketWriter(threading.Thread):
+    """Único hilo escritor del motor de hilos.
+
+    Sólo atiende sockets con datos atrasados: escribe con MSG_DONTWAIT y, si el
+    kernel no acepta más, espera en un selector a que el socket vuelva a ser
+    escribible. Así un cliente lento no frena al resto de la sala.
+    """
+
+    def __init__(self):
+        super().__init__(name='socket-writer', daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+        self.lock = threading.Lock()
+        self.ready = set()
+        self.waiting = set()
+
+    def schedule(self, conn):
+        with self.lock:
+            if conn in self.ready:
+                return
+            notify = not self.ready
+            self.ready.add(conn)
+        if notify:
+            try:
+                self.wake_w.send(b'\0')
+            except (BlockingIOError, OSError):
+                pass
+
+    def run(self):
+        while True:
+            timeout = 1.0 if self.waiting else None
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                else:
+                    self._flush(key.data)
+            with self.lock:
+                ready, self.ready = self.ready, set()
+            for conn in ready:
+                self._flush(conn)
+            now = time.monotonic()
+            for conn in [c for c in self.waiting if c.closing and c.close_deadline <= now]:
+                LOGGER.info('Cerrando %s con %d frames sin enviar', conn.label, len(conn.queue))
+                self._finalize(conn)
+
+    def _flush(self, conn):
+        if conn.closed:
+            return
+        try:
+            drained = conn.write_ready()
+        except OSError as exc:
+            LOGGER.info('Error escribiendo a %s: %s', conn.label, exc)
+            conn.abort()
+            drained = True
+        if drained:
+            if conn in self.waiting:
+                self.waiting.discard(conn)
+                self.selector.unregister(conn.sock)
+            if conn.closing:
+                self._finalize(conn)
+        elif conn not in self.waiting:
+            self.waiting.add(conn)
+            self.selector.register(conn.sock, selectors.EVENT_WRITE, conn)
+
+    def _finalize(self, conn):
+        if conn in self.waiting:
+            self.waiting.discard(conn)
+            self.selector.unregister(conn.sock)
+        conn.closed = True
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+
+
+def outbound_stats():
+    """Profundidad de cola por usuario conectado, para monitoreo."""
+    with clients_lock:
+        infos = list(clients.items())
+    stats = []
+    for username, info in infos:
+        queue = getattr(info['conn'], 'queue', None)
+        if queue is None:
+            continue
+        stats.append({
+            'user': username,
+            'depth': len(queue),
+            'dropped': queue.dropped,
+            'lagging': queue.lagging,
+        })
+    return stats
+
+
+def _queue_gauge(field):
+    def read():
+        return sum(s[field] for s in outbound_stats())
+    return read
+
+
+metrics.gauge('chat_users', 'Usuarios registrados en este proceso.', lambda: len(clients))
+metrics.gauge(
+    'chat_log_dropped', 'Registros de logging descartados con la cola llena.',
+    lambda: LOG_PIPELINE.dropped if LOG_PIPELINE else 0,
+)
+metrics.gauge('chat_outbound_queue_frames', 'Frames pendientes en todas las colas de salida.', _queue_gauge('depth'))
+metrics.gauge(
+    'chat_outbound_queue_max_frames',
+    'Cola de salida más larga.',
+    lambda: max((s['depth'] for s in outbound_stats()), default=0),
+)
+metrics.gauge('chat_outbound_lagging_sessions', 'Sesiones marcadas como rezagadas.', _queue_gauge('lagging'))
+metrics.gauge('chat_outbound_dropped_frames', 'Frames descartados por consumidores lentos.', _queue_gauge('dropped'))
+
+
+def queue_report_loop(interval):
+    while True:
+        time.sleep(interval)
+        busy = [s for s in outbound_stats() if s['depth'] or s['lagging']]
+        if not busy:
+            continue
+        busy.sort(key=lambda s: s['depth'], reverse=True)
+        LOGGER.info(
+            'Colas de salida ocupadas: %s',
+            ', '.join(
+                f"{s['user']}={s['depth']}" + (' (rezagado)' if s['lagging'] else '')
+                for s in busy[:10]
+            ),
+        )
+
+
+def wait_readable(sock, timeout):
+    with selectors.DefaultSelector() as sel:
+        sel.register(sock, selectors.EVENT_READ)
+        return bool(sel.select(timeout))
+
+
+def handle_line_throttled(session, line):
+    """Motor de hilos: si el limitador demora la línea, el hilo duerme sin
+    leer el socket (TCP frena al cliente) y la vuelve a procesar."""
+    while True:
+        try:
+            return session.handle_line(line)
+        except RateLimited as exc:
+            flush_write_batch()
+            time.sleep(exc.wait)
+            begin_write_batch()
+
+
+def _dispatch_chunk(session, data):
+    """Procesa los bytes leídos; False si la conexión debe cerrarse."""
+    lines = session.framer.feed(data)
+    begin_write_batch()
+    try:
+        for line in lines:
+            if not handle_line_throttled(session, line):
+                return False
+    finally:
+        flush_write_batch()
+    return True
+
+
+def handle_client(conn, addr, session=None, pending=b''):
+    """Hilo lector de una conexión. Con ``session`` retoma una sesión recibida
+    en un traspaso en caliente; ``pending`` son los bytes que el proceso
+    anterior leyó y no llegó a procesar."""
+    if session is None:
+        session = ClientSession(conn, addr)
+        LOGGER.info('Conexión entrante de %s', addr)
+    conn.session = session
+    session.reader = threading.get_ident()
+    try:
+        if pending:
+            if not _dispatch_chunk(session, pending):
+                return
+        elif session.username is None and not session.handshake_sent:
+            if not wait_readable(conn.sock, HANDSHAKE_TIMEOUT):
+                session.send_handshake_banner()
+        while True:
+            if FREEZE.frozen:
+                # traspaso en curso: no leer más; si se cancela, se sigue con
+                # lo que haya llegado mientras tanto
+                FREEZE.park(session)
+                data, session.unread = session.unread, b''
+                if not data:
+                    continue
+            else:
+                try:
+                    data = conn.recv(RECV_SIZE)
+                except BlockingIOError:
+                    # el traspaso puso el socket en no bloqueante para despertar este recv
+                    continue
+                if FREEZE.frozen:
+                    session.unread += data
+                    continue
+            if not data:
+                raise ConnectionResetError()
+            session.last_seen = time.monotonic()
+            BYTES_IN.inc(len(data))
+            LOGGER.debug('Datos recibidos de %s: %r', session.username or addr, data)
+            if not _dispatch_chunk(session, data):
+                return
+    except DisconnectRequested:
+        session.mark_closed('quit')
+        LOGGER.info('Desconexión solicitada por %s', session.username or addr)
+    except LineTooLong as exc:
+        session.mark_closed('line_too_long')
+        LOGGER.warning('Línea demasiado larga desde %s: %s', session.username or addr, exc)
+        session.reject_long_line()
+    except (ConnectionResetError, BrokenPipeError):
+        session.mark_closed('reset')
+        LOGGER.info('Conexión perdida con %s', session.username or addr)
+    except Exception as exc:
+        session.mark_closed('error')
+        LOGGER.exception('Error manejando a %s: %s', session.username or addr, exc)
+    finally:
+        session.cleanup()
+        conn.close()
+        session.closed()
+
+
+def accept_loop(server_sock, writer):
+    global HANDOFF_CHANNEL
+    LOGGER.info('Escuchando en %s:%s (motor de hilos)', *server_sock.getsockname()[:2])
+    while True:
+        try:
+            sock, addr = server_sock.accept()
+            reason = ADMISSION.admit(addr[0])
+            if reason is not None:
+                shed(sock, addr, reason)
+                continue
+            LOGGER.info('Conexión aceptada de %s', addr)
+            conn = ThreadedConnection(sock, addr, writer)
+            thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
+            try:
+                thread.start()
+            except RuntimeError:
+                # sin hilos disponibles: se rechaza esta conexión y se sigue aceptando
+                ADMISSION.release(addr[0], True)
+                shed(sock, addr, 'threads')
+        except BlockingIOError:
+            # sólo con un traspaso pedido: el socket quedó no bloqueante y
+            # SIGUSR1 interrumpió este accept()
+            chan, HANDOFF_CHANNEL = HANDOFF_CHANNEL, None
+            if chan is not None:
+                hand_off_threaded(chan, server_sock)
+            os.set_blocking(server_sock.fileno(), True)
+        except KeyboardInterrupt:
+            LOGGER.info('Detenido por KeyboardInterrupt')
+            break
+        except Exception as exc:
+            LOGGER.exception('Error en accept(): %s', exc)
+            break
+
+
+# ---------------------------------------------------------------------------
+# Motor de event loop (selectors)
+# ---------------------------------------------------------------------------
+
+
+class LoopConnection(BufferedConnection):
+    """Conexión no bloqueante del event loop: la cola se vacía cuando el
+    selector avisa que el socket es escribible."""
+
+    def __init__(self, server, sock, addr, resumed=False):
+        super().__init__(sock, addr)
+        self.server = server
+        self.write_pending = False
+        self.events = selectors.EVENT_READ
+        self.paused = False  # lectura suspendida (RateLimited o BusPending)
+        self.deferred_lines = None
+        self.bus_wait = None  # marca de la espera al bus en curso
+        self.session = ClientSession(self, addr, resumed)
+
+    def wake_writer(self):
+        if not self.write_pending:
+            self.server.want_write(self, True)
+
+    def abort(self):
+        self.queue.clear()
+        self.server.close_soon(self)
+
+    def close(self):
+        self.server.close_connection(self)
+
+
+class EventLoopServer:
+    """Atiende todas las conexiones desde un único hilo usando selectors.
+
+    No hay un hilo por cliente ni sondeos periódicos: el hilo sólo despierta
+    cuando hay datos, un socket vuelve a ser escribible, vence un temporizador
+    (el timeout del handshake HELLO_V5) u otro hilo encola trabajo con
+    call_soon_threadsafe (p. ej. las difusiones que llegan por el bus).
+    """
+
+    def __init__(self, server_sock):
+        self.server_sock = server_sock
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.timer_seq = 0
+        self.pending_close = []
+        self.callbacks = collections.deque()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+
+    def call_later(self, delay, callback, *args):
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (time.monotonic() + delay, self.timer_seq, callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        notify = not self.callbacks
+        self.callbacks.append((callback, args))
+        if notify:
+            try:
+                self.wake_w.send(b'\0')
+            except (BlockingIOError, OSError):
+                pass
+
+    def _run_callbacks(self):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        while self.callbacks:
+            callback, args = self.callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception as exc:
+                LOGGER.exception('Error en callback: %s', exc)
+
+    def want_write(self, conn, enabled):
+        if conn.closed:
+            return
+        conn.write_pending = enabled
+        self._update_events(conn)
+
+    def _update_events(self, conn):
+        events = (0 if conn.paused else selectors.EVENT_READ) | (selectors.EVENT_WRITE if conn.write_pending else 0)
+        if events == conn.events:
+            return
+        if not events:
+            self.selector.unregister(conn.sock)
+        elif not conn.events:
+            self.selector.register(conn.sock, events, conn)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def close_soon(self, conn):
+        self.pending_close.append(conn)
+
+    def close_connection(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+        conn.session.cleanup()
+        conn.session.closed()
+
+    def finish(self, conn):
+        """Cierra tras vaciar lo pendiente (p. ej. el mensaje de despedida)."""
+        conn.flush()
+        conn.session.cleanup()
+        if len(conn.queue) and not conn.closed:
+            conn.closing = True
+            self.call_later(CLOSE_LINGER, self.close_connection, conn)
+        else:
+            self.close_connection(conn)
+
+    def serve_forever(self):
+        self.server_sock.setblocking(False)
+        self.selector.register(self.server_sock, selectors.EVENT_READ, None)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, self)
+        LOGGER.info('Escuchando en %s:%s (motor event loop)', *self.server_sock.getsockname()[:2])
+        while True:
+            timeout = None
+            if self.timers:
+                timeout = max(0.0, self.timers[0][0] - time.monotonic())
+            events = self.selector.select(timeout)
+            # todo lo que se envíe en esta vuelta sale en un sendmsg por conexión
+            begin_write_batch()
+            for key, mask in events:
+                conn = key.data
+                if conn is None:
+                    self._accept()
+                    continue
+                if conn is self:
+                    self._run_callbacks()
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self._on_writable(conn)
+                if mask & selectors.EVENT_READ and not conn.closed and not conn.closing:
+                    self._on_readable(conn)
+            self._run_timers()
+            flush_write_batch()
+            while self.pending_close:
+                self.close_connection(self.pending_close.pop())
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.server_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                LOGGER.warning('Error en accept(): %s', exc)
+                return
+            reason = ADMISSION.admit(addr[0])
+            if reason is not None:
+                shed(sock, addr, reason)
+                continue
+            LOGGER.info('Conexión aceptada de %s', addr)
+            sock.setblocking(False)
+            conn = LoopConnection(self, sock, addr)
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+            self.call_later(HANDSHAKE_TIMEOUT, self._handshake_timeout, conn)
+
+    def _heartbeat_tick(self):
+        HEARTBEATS.tick()
+        self.call_later(HEARTBEATS.wheel.tick, self._heartbeat_tick)
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            try:
+                callback(*args)
+            except Exception as exc:
+                LOGGER.exception('Error en temporizador: %s', exc)
+
+    def _handshake_timeout(self, conn):
+        session = conn.session
+        if conn.closed or session.username is not None or session.handshake_sent:
+            return
+        try:
+            session.send_handshake_banner()
+        except OSError:
+            self.close_connection(conn)
+
+    def _on_readable(self, conn):
+        session = conn.session
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            session.mark_closed('reset')
+            LOGGER.info('Conexión perdida con %s', session.username or conn.addr)
+            self.close_connection(conn)
+            return
+        session.last_seen = time.monotonic()
+        BYTES_IN.inc(len(data))
+        try:
+            lines = session.framer.feed(data)
+        except LineTooLong as exc:
+            session.mark_closed('line_too_long')
+            LOGGER.warning('Línea demasiado larga desde %s: %s', session.username or conn.addr, exc)
+            session.reject_long_line()
+            self.finish(conn)
+            return
+        self._handle_lines(conn, lines)
+
+    def _pause_reading(self, conn, lines, wait):
+        """El limitador demoró una línea: se deja de leer el socket (TCP frena
+        al cliente) y las líneas pendientes se retoman tras ``wait``."""
+        conn.paused = True
+        conn.deferred_lines = lines
+        self._update_events(conn)
+        self.call_later(wait, self._resume_reading, conn)
+
+    def _resume_reading(self, conn):
+        if conn.closed or conn.closing:
+            return
+        conn.paused = False
+        self._update_events(conn)
+        lines, conn.deferred_lines = conn.deferred_lines, None
+        self._handle_lines(conn, lines)
+
+    def _wait_bus(self, conn, lines, pending):
+        """Como con el limitador, pero se retoma cuando responde el hub; si no
+        responde en REQUEST_TIMEOUT se corta la conexión."""
+        conn.paused = True
+        conn.deferred_lines = lines
+        self._update_events(conn)
+        token = conn.bus_wait = object()
+        pending.send(lambda: self._bus_replied(conn, token))
+        self.call_later(REQUEST_TIMEOUT, self._bus_timeout, conn, token)
+
+    def _bus_replied(self, conn, token):
+        if conn.bus_wait is token:
+            conn.bus_wait = None
+            self._resume_reading(conn)
+
+    def _bus_timeout(self, conn, token):
+        if conn.bus_wait is not token or conn.closed:
+            return
+        conn.bus_wait = None
+        conn.session.mark_closed('error')
+        LOGGER.error('El bus no respondió a tiempo para %s', conn.session.username or conn.addr)
+        self.close_connection(conn)
+
+    def _handle_lines(self, conn, lines):
+        session = conn.session
+        for index, line in enumerate(lines):
+            try:
+                keep = session.handle_line(line)
+            except RateLimited as exc:
+                self._pause_reading(conn, lines[index:], exc.wait)
+                return
+            except BusPending as exc:
+                self._wait_bus(conn, lines[index:], exc)
+                return
+            except DisconnectRequested:
+                session.mark_closed('quit')
+                LOGGER.info('Desconexión solicitada por %s', session.username or conn.addr)
+                self.finish(conn)
+                return
+            except (ConnectionResetError, BrokenPipeError):
+                session.mark_closed('reset')
+                LOGGER.info('Conexión perdida con %s', session.username or conn.addr)
+                self.close_connection(conn)
+                return
+            except Exception as exc:
+                session.mark_closed('error')
+                LOGGER.exception('Error manejando a %s: %s', session.username or conn.addr, exc)
+                self.close_connection(conn)
+                return
+            if not keep:
+                self.finish(conn)
+                return
+
+    def _on_writable(self, conn):
+        try:
+            drained = conn.write_ready()
+        except OSError:
+            self.close_connection(conn)
+            return
+        if not drained:
+            return
+        if conn.closing:
+            self.close_connection(conn)
+        else:
+            self.want_write(conn, False)
+
+    def hand_off(self, chan):
+        # todo el estado lo toca este hilo: no hace falta congelar nada
+        hand_off(chan, self.server_sock, resume=lambda: None)
+
+    def adopt(self, sock, addr, data):
+        sock.setblocking(False)
+        conn = LoopConnection(self, sock, addr, resumed=True)
+        session = conn.session
+        pending = restore_session(session, data)
+        self.selector.register(sock, selectors.EVENT_READ, conn)
+        if session.username is None and not session.handshake_sent:
+            self.call_later(HANDSHAKE_TIMEOUT, self._handshake_timeout, conn)
+
+        def start():
+            if len(conn.queue):
+                self.want_write(conn, True)
+            if pending:
+                try:
+                    lines = session.framer.feed(pending)
+                except LineTooLong:
+                    session.mark_closed('line_too_long')
+                    session.reject_long_line()
+                    self.finish(conn)
+                    return
+                self._handle_lines(conn, lines)
+        return start
+
+
+# ---------------------------------------------------------------------------
+# Instantáneas de salas (--snapshot-file)
+# ---------------------------------------------------------------------------
+
+def collect_rooms():
+    """``[nombre, contraseña, miembros]`` de cada sala, para room_snapshot.
+
+    rooms_lock sólo se toma para copiar el dict; contraseña y cantidad de
+    miembros se leen sin el lock de cada sala (lecturas atómicas bajo el GIL,
+    y una instantánea apenas desfasada alcanza).
+    """
+    with rooms_lock:
+        snapshot = list(rooms.items())
+    return [[name, info['password'], len(info['members'])] for name, info in snapshot]
+
+
+def restore_rooms(entries):
+    """Recrea las salas de una instantánea (vacías: los miembros vuelven solos)."""
+    protected = 0
+    with rooms_lock:
+        for name, password, _ in entries:
+            if name not in rooms:
+                rooms[name] = _new_room(password or None)
+                ROOM_DIRECTORY.add(name, password)
+            protected += bool(password)
+    return protected
+
+
+# ---------------------------------------------------------------------------
+# Traspaso en caliente (--handoff-socket / --takeover)
+# ---------------------------------------------------------------------------
+
+HANDOFF_PATH = None
+HANDOFF_CHANNEL = None  # canal pendiente para el motor de hilos (lo atiende accept_loop)
+PARK_TIMEOUT = 5.0  # espera máxima para que los hilos lectores se detengan
+
+
+class HandoffFreeze:
+    """Detiene los hilos lectores del motor de hilos durante un traspaso.
+
+    ``freeze`` marca el estado; cada lector, al ver la marca, deja de leer y
+    se queda en ``park`` hasta que el proceso termina o ``thaw`` cancela.
+    """
+
+    def __init__(self):
+        self.frozen = False
+        self.cond = threading.Condition()
+
+    def freeze(self):
+        with self.cond:
+            self.frozen = True
+
+    def thaw(self):
+        with self.cond:
+            self.frozen = False
+            self.cond.notify_all()
+
+    def park(self, session):
+        with self.cond:
+            session.parked = True
+            self.cond.notify_all()
+            while self.frozen:
+                self.cond.wait()
+            session.parked = False
+
+    def wait_parked(self, sessions, timeout):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not all(s.parked or s.done for s in sessions):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(min(remaining, 0.05))
+        return True
+
+
+FREEZE = HandoffFreeze()
+
+
+def _interrupt_syscall(signum, frame):
+    """SIGUSR1 sólo sirve para cortar un accept()/recv() bloqueado (EINTR)."""
+
+
+def _encode_line(protocol, line):
+    if protocol == binwire.FEATURE:
+        return binwire.encode_line(line)
+    return (line + '\n').encode('utf-8')
+
+
+def export_session(session, now):
+    conn = session.conn
+    deferred = getattr(conn, 'deferred_lines', None) or ()
+    # lo recibido y no procesado vuelve a ser bytes del stream, en orden
+    inbound = b''.join(_encode_line(session.protocol, line) for line in deferred)
+    inbound += session.framer.pending() + session.unread
+    return {
+        'addr': list(session.addr),
+        'username': session.username,
+        'protocol': session.protocol,
+        'registered': session.registered,
+        'handshake_username': session.handshake_username,
+        'handshake_sent': session.handshake_sent,
+        'handshake_path': session.handshake_path,
+        'heartbeat': session.heartbeat,
+        'age': now - session.connected_at,
+        'idle': now - session.last_seen,
+        'inbound': base64.b64encode(inbound).decode('ascii'),
+        'outbound': base64.b64encode(conn.queue.detach()).decode('ascii'),
+        'interns': sorted(conn.known_interns),
+    }
+
+
+def export_state(sessions):
+    now = time.monotonic()
+    users = {session.username for session in sessions if session.registered}
+    with BACKLOG.lock:
+        backlog = {room: [[frame.text, frame.json_obj] for frame, _ in ring] for room, ring in BACKLOG.rooms.items()}
+    return {
+        'version': 1,
+        'rooms': {
+            name: {'members': sorted(users.intersection(info['members'])), 'password': info['password']}
+            for name, info in list(rooms.items())
+        },
+        'user_rooms': {user: room for user, room in list(user_rooms.items()) if user in users},
+        'user_memberships': {
+            user: sorted(joined) for user, joined in list(user_memberships.items()) if user in users
+        },
+        'interns': dict(INTERNS.ids),
+        'backlog': backlog,
+        'presence': {'version': PRESENCE.version, 'subscribers': sorted(users.intersection(PRESENCE.subscribers))},
+        'sessions': [export_session(session, now) for session in sessions],
+    }
+
+
+def hand_off(chan, listener, resume):
+    """Manda el socket de escucha, las sesiones y el estado al proceso nuevo
+    y termina este. Si el envío falla, devuelve lo que sacó de las colas,
+    llama a ``resume`` y el proceso sigue atendiendo como si nada."""
+    candidates = [s for s in list(SESSIONS) if not s.done and not s.conn.closed and not s.conn.closing]
+    # el estado de zlib no se puede serializar: esas sesiones se cierran (sus
+    # clientes reconectan) y el resto recibe su aviso de salida antes del corte
+    sessions = [s for s in candidates if s.conn.deflater is None]
+    dropped = [s for s in candidates if s.conn.deflater is not None]
+    for session in dropped:
+        session.mark_closed('handoff')
+        session.cleanup()
+    for session in sessions:
+        session.conn.flush()
+    state = export_state(sessions)
+    fds = [listener.fileno()] + [session.conn.sock.fileno() for session in sessions]
+    try:
+        handoff.send_state(chan, state, fds)
+    except (OSError, handoff.HandoffError) as exc:
+        LOGGER.error('Traspaso fallido; este proceso sigue atendiendo: %s', exc)
+        for session, data in zip(sessions, state['sessions']):
+            outbound = base64.b64decode(data['outbound'])
+            if outbound:
+                session.conn.queue.push_notice(outbound)
+                session.conn.wake_writer()
+        for session in dropped:
+            session.conn.abort()
+        chan.close()
+        resume()
+        return
+    LOGGER.info('Traspaso completo: %d sesiones entregadas, %d cerradas (zlib)', len(sessions), len(dropped))
+    if MESSAGE_LOG is not None:
+        MESSAGE_LOG.close()
+    if LOG_PIPELINE is not None:
+        LOG_PIPELINE.stop()
+    # sin finally ni cleanup_user: los sockets y los usuarios siguen vivos
+    # en el proceso nuevo
+    os._exit(0)
+
+
+def hand_off_threaded(chan, listener):
+    """Motor de hilos: detiene a los lectores antes de exportar."""
+    sessions = [s for s in list(SESSIONS) if s.reader is not None and not s.done]
+    FREEZE.freeze()
+    for session in sessions:
+        try:
+            os.set_blocking(session.conn.sock.fileno(), False)
+            signal.pthread_kill(session.reader, signal.SIGUSR1)
+        except (OSError, ValueError, ProcessLookupError):
+            pass
+    if not FREEZE.wait_parked(sessions, PARK_TIMEOUT):
+        LOGGER.warning('Traspaso: algunos hilos lectores no se detuvieron a tiempo')
+
+    def resume():
+        for session in sessions:
+            try:
+                os.set_blocking(session.conn.sock.fileno(), True)
+            except (OSError, ValueError):
+                pass
+        FREEZE.thaw()
+
+    hand_off(chan, listener, resume)
+
+
+def restore_session(session, data):
+    """Carga en ``session`` lo exportado por el proceso anterior; devuelve
+    los bytes recibidos que quedan por procesar."""
+    now = time.monotonic()
+    conn = session.conn
+    session.username = data['username']
+    session.protocol = data['protocol']
+    session.handshake_username = data['handshake_username']
+    session.handshake_sent = data['handshake_sent']
+    session.handshake_path = data['handshake_path']
+    session.heartbeat = data['heartbeat']
+    session.connected_at = now - data['age']
+    session.last_seen = now - data['idle']
+    if session.protocol == binwire.FEATURE:
+        session.framer = binwire.LineFrameReader(MAX_LINE_LENGTH)
+    conn.known_interns = set(data['interns'])
+    outbound = base64.b64decode(data['outbound'])
+    if outbound:
+        conn.queue.push_notice(outbound)
+    ADMISSION.admit(session.addr[0])  # sin cupos: ya estaba adentro
+    if data['registered']:
+        session.registered = True
+        session.in_handshake = False
+        ADMISSION.registered()
+        with clients_lock:
+            clients[session.username] = {
+                'username': session.username,
+                'conn': conn,
+                'protocol': session.protocol or 'text',
+                'addr': session.addr,
+            }
+    if HEARTBEATS is not None:
+        HEARTBEATS.track(session)
+    lifecycle_event('resume', addr=_addr_text(session.addr), user=session.username)
+    return base64.b64decode(data['inbound'])
+
+
+def restore_state(state, fds, adopt):
+    """Reconstruye salas, usuarios y sesiones del proceso anterior.
+
+    ``adopt(sock, addr, datos)`` crea la conexión del motor y devuelve una
+    función que la pone a andar; se llaman todas recién cuando las salas y
+    los 'viewers' están completos.
+    """
+    for name, data in state['rooms'].items():
+        info = rooms.get(name)
+        if info is None:
+            info = rooms[name] = _new_room(data['password'])
+        info['password'] = data['password']
+        with info['lock']:
+            info['members'] = set(data['members'])
+            ROOM_DIRECTORY.add(name, data['password'])
+            ROOM_DIRECTORY.update(name, len(info['members']))
+    for user, joined in state['user_memberships'].items():
+        user_memberships[user] = set(joined)
+    INTERNS.ids.update(state['interns'])
+    INTERNS.counter = itertools.count(max(INTERNS.ids.values(), default=0) + 1)
+    for room, entries in state['backlog'].items():
+        for text, json_obj in entries:
+            BACKLOG.append(room, FanoutFrame(text, json_obj, room))
+    starts = []
+    for data, fd in zip(state['sessions'], fds):
+        sock = socket.socket(fileno=fd)
+        starts.append(adopt(sock, tuple(data['addr']), data))
+    for user, room in state['user_rooms'].items():
+        if user in clients:
+            _set_active_room(user, room)
+    # un proceso anterior a /presencia no manda 'presence'
+    presence = state.get('presence', {'version': 0, 'subscribers': ()})
+    with clients_lock:
+        PRESENCE.reset(list(clients), presence['version'])
+        for user in presence['subscribers']:
+            if user in clients:
+                PRESENCE.resume(user, clients[user]['conn'])
+    for start in starts:
+        start()
+    LOGGER.info('Traspaso recibido: %d sesiones, %d salas', len(starts), len(state['rooms']))
+
+
+def adopt_threaded(writer):
+    def adopt(sock, addr, data):
+        sock.setblocking(True)
+        conn = ThreadedConnection(sock, addr, writer)
+        session = ClientSession(conn, addr, resumed=True)
+        conn.session = session
+        pending = restore_session(session, data)
+
+        def start():
+            if len(conn.queue):
+                conn.wake_writer()
+            threading.Thread(target=handle_client, args=(conn, addr, session, pending), daemon=True).start()
+        return start
+    return adopt
+
+
+def start_handoff_listener(trigger):
+    sock = handoff.listen(HANDOFF_PATH)
+    threading.Thread(target=handoff_listener, args=(sock, trigger), name='handoff', daemon=True).start()
+    LOGGER.info('Traspaso en caliente disponible en %s', HANDOFF_PATH)
+
+
+def handoff_listener(sock, trigger):
+    """Atiende el canal de traspaso; ``trigger(canal)`` lo ejecuta en el motor."""
+    while True:
+        try:
+            chan, _ = sock.accept()
+        except OSError as exc:
+            LOGGER.warning('Canal de traspaso cerrado: %s', exc)
+            return
+        if not handoff.read_request(chan):
+            chan.close()
+            continue
+        LOGGER.info('Un proceso nuevo pidió el traspaso en caliente')
+        trigger(chan)
+
+
+def _request_threaded_handoff(listener):
+    def trigger(chan):
+        global HANDOFF_CHANNEL
+        HANDOFF_CHANNEL = chan
+        # accept_loop está bloqueado en accept(): no bloqueante + EINTR lo despierta
+        os.set_blocking(listener.fileno(), False)
+        signal.pthread_kill(threading.main_thread().ident, signal.SIGUSR1)
+    return trigger
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def run_supervisor(workers, bus_path, worker_argv):
+    """Levanta el hub del bus y N workers que comparten el puerto.
+
+    Los workers son este mismo script relanzado con ``--bus``; si uno muere,
+    sus usuarios quedan liberados en el hub y el resto sigue atendiendo.
+    """
+    bus_path = bus_path or os.path.join(tempfile.gettempdir(), f'server_v5-{os.getpid()}.bus')
+    hub = RoomBusHub(bus_path)
+    hub.start()
+    cmd = [sys.executable, os.path.abspath(__file__), *worker_argv, '--bus', bus_path]
+    procs = [subprocess.Popen(cmd + ['--worker-index', str(i)]) for i in range(workers)]
+    LOGGER.info('Supervisor: %d workers, bus en %s', workers, bus_path)
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+
+    def forward_profile(signum, frame):
+        for proc in procs:
+            if proc.poll() is None:
+                proc.send_signal(signum)
+
+    signal.signal(signal.SIGUSR2, forward_profile)
+    try:
+        alive = {proc.pid: proc for proc in procs}
+        while alive:
+            pid, status = os.wait()
+            if alive.pop(pid, None) is not None:
+                LOGGER.warning('Worker %d terminó (estado %d)', pid, status)
+    except KeyboardInterrupt:
+        LOGGER.info('Detenido por KeyboardInterrupt')
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        try:
+            os.unlink(bus_path)
+        except OSError:
+            pass
+
+
+def main(argv=None):
+    global OUTBOUND_QUEUE_LIMIT, SLOW_CONSUMER_POLICY, COALESCE_WRITES, BACKLOG, MESSAGE_LOG, ADMIN_USERS
+    global PROFILER, PROFILE_SECONDS, LOG_PIPELINE, LIFECYCLE_ENABLED
+    global HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, IDLE_TIMEOUT, LOGIN_TIMEOUT, KEEPALIVE, HEARTBEATS
+    global RATE_POLICY, RATE_MAX_DELAY, ADMISSION, LISTEN_BACKLOG, HANDOFF_PATH, ROOM_SNAPSHOTS
+    parser = argparse.ArgumentParser(description='Servidor de chat v5 (texto + JSON).')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument(
+        '--engine',
+        choices=('threads', 'loop'),
+        default='threads',
+        help='threads: un hilo por conexión; loop: un único event loop (selectors).',
+    )
+    parser.add_argument(
+        '--queue-limit',
+        type=int,
+        default=OUTBOUND_QUEUE_LIMIT,
+        help='Frames máximos en la cola de salida de cada sesión.',
+    )
+    parser.add_argument(
+        '--slow-policy',
+        choices=SLOW_CONSUMER_POLICIES,
+        default=SLOW_CONSUMER_POLICY,
+        help='Qué hacer cuando la cola de un cliente se llena.',
+    )
+    parser.add_argument(
+        '--no-coalesce',
+        action='store_true',
+        help='Enviar cada frame por separado en vez de un sendmsg por conexión y ciclo.',
+    )
+    parser.add_argument(
+        '--queue-report',
+        type=float,
+        default=0,
+        metavar='SEGUNDOS',
+        help='Registrar periódicamente las colas de salida ocupadas (0 = desactivado).',
+    )
+    parser.add_argument(
+        '--backlog',
+        type=int,
+        default=BACKLOG_SIZE,
+        metavar='N',
+        help='Mensajes recientes por sala reenviados al hacer /join (0 = desactivado).',
+    )
+    parser.add_argument(
+        '--backlog-memory',
+        type=float,
+        default=BACKLOG_MEMORY / (1024 * 1024),
+        metavar='MB',
+        help='Memoria total para los historiales de todas las salas.',
+    )
+    parser.add_argument(
+        '--log-dir',
+        default=None,
+        help='Directorio del log durable de mensajes (desactivado si no se indica).',
+    )
+    parser.add_argument('--log-segment-mb', type=float, default=64, help='Tamaño de rotación de cada segmento.')
+    parser.add_argument('--log-retention-mb', type=float, default=0, help='Tamaño total a conservar (0 = sin límite).')
+    parser.add_argument('--log-retention-hours', type=float, default=0, help='Antigüedad a conservar (0 = sin límite).')
+    parser.add_argument(
+        '--log-commit-ms',
+        type=float,
+        default=50,
+        help='Intervalo de group commit: un fsync por lote cada tantos milisegundos.',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Procesos worker en el mismo puerto (SO_REUSEPORT) unidos por un bus local.',
+    )
+    parser.add_argument(
+        '--bus-path',
+        default=None,
+        help='Socket Unix del bus entre workers (por defecto, uno temporal).',
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=0,
+        help='Puerto local de administración con GET /metrics (formato Prometheus); '
+        'con --workers N cada worker usa puerto + índice (0 = desactivado).',
+    )
+    parser.add_argument('--metrics-host', default='127.0.0.1', help='Interfaz del puerto de métricas.')
+    parser.add_argument(
+        '--admin',
+        action='append',
+        default=[],
+        metavar='USUARIO',
+        help='Usuario habilitado para los comandos de administración (/stats, /profile). Repetible.',
+    )
+    parser.add_argument(
+        '--profile-dir',
+        default=tempfile.gettempdir(),
+        help='Directorio de los perfiles (formato collapsed) de /profile y SIGUSR2.',
+    )
+    parser.add_argument('--profile-seconds', type=float, default=PROFILE_SECONDS, help='Duración por defecto del perfil.')
+    parser.add_argument('--profile-interval-ms', type=float, default=5, help='Intervalo entre muestras del perfil.')
+    parser.add_argument(
+        '--log-queue',
+        type=int,
+        default=10000,
+        help='Registros de logging en cola hacia el hilo escritor; llena, se descartan (0 = logging síncrono).',
+    )
+    parser.add_argument(
+        '--lifecycle-log',
+        default=None,
+        metavar='ARCHIVO',
+        help='Archivo JSONL con los eventos de conexión, registro y desconexión.',
+    )
+    parser.add_argument(
+        '--heartbeat',
+        type=float,
+        default=HEARTBEAT_INTERVAL,
+        metavar='SEGUNDOS',
+        help='Inactividad tras la cual se manda PING a los clientes que negociaron ping=1 (0 = nunca).',
+    )
+    parser.add_argument(
+        '--heartbeat-timeout',
+        type=float,
+        default=HEARTBEAT_TIMEOUT,
+        metavar='SEGUNDOS',
+        help='Espera máxima de la respuesta al PING antes de cortar la sesión.',
+    )
+    parser.add_argument(
+        '--idle-timeout',
+        type=float,
+        default=IDLE_TIMEOUT,
+        metavar='SEGUNDOS',
+        help='Cortar sesiones sin ping tras tanta inactividad (0 = nunca).',
+    )
+    parser.add_argument(
+        '--login-timeout',
+        type=float,
+        default=LOGIN_TIMEOUT,
+        metavar='SEGUNDOS',
+        help='Cortar conexiones que no completan el registro (0 = nunca).',
+    )
+    parser.add_argument(
+        '--keepalive',
+        type=float,
+        nargs=3,
+        default=KEEPALIVE,
+        metavar=('INACTIVIDAD', 'INTERVALO', 'SONDAS'),
+        help='TCP keepalive de las conexiones aceptadas (inactividad 0 = desactivado).',
+    )
+    for scope, what in (('user', 'usuario'), ('room', 'sala'), ('ip', 'IP de origen')):
+        parser.add_argument(
+            f'--rate-{scope}',
+            type=float,
+            nargs=2,
+            default=(0, 0),
+            metavar=('MSG_POR_SEG', 'RÁFAGA'),
+            help=f'Token bucket de mensajes difundidos por {what} (tasa 0 = sin límite).',
+        )
+    parser.add_argument(
+        '--rate-policy',
+        choices=('delay', 'reject'),
+        default=RATE_POLICY,
+        help='delay: dejar de leer al emisor hasta que haya tokens; reject: descartar el mensaje y avisar.',
+    )
+    parser.add_argument(
+        '--rate-max-delay',
+        type=float,
+        default=RATE_MAX_DELAY,
+        metavar='SEGUNDOS',
+        help='Con --rate-policy delay, esperas más largas se descartan igual.',
+    )
+    parser.add_argument(
+        '--max-sessions',
+        type=int,
+        default=0,
+        help='Conexiones abiertas como máximo; las demás se rechazan en accept() (0 = sin límite).',
+    )
+    parser.add_argument(
+        '--max-handshakes',
+        type=int,
+        default=MAX_HANDSHAKES,
+        help='Conexiones aceptadas sin registrarse a la vez (0 = sin límite).',
+    )
+    parser.add_argument(
+        '--max-per-ip',
+        type=int,
+        default=0,
+        help='Conexiones abiertas por IP de origen (0 = sin límite).',
+    )
+    parser.add_argument('--listen-backlog', type=int, default=LISTEN_BACKLOG, help='Cola de listen() del kernel.')
+    parser.add_argument(
+        '--handoff-socket',
+        default=None,
+        metavar='RUTA',
+        help='Socket Unix por el que un proceso nuevo (--takeover) recibe el puerto y las sesiones.',
+    )
+    parser.add_argument(
+        '--takeover',
+        action='store_true',
+        help='Tomar el puerto y las sesiones del proceso que escucha en --handoff-socket '
+        '(si no hay ninguno, arranca normalmente).',
+    )
+    parser.add_argument(
+        '--snapshot-file',
+        default=None,
+        metavar='RUTA',
+        help='Instantánea de las salas (nombres, contraseñas, miembros) que se carga al arrancar.',
+    )
+    parser.add_argument(
+        '--snapshot-interval',
+        type=float,
+        default=30.0,
+        metavar='SEGUNDOS',
+        help='Cada cuánto se reescribe la instantánea si cambió (0 = sólo al apagar).',
+    )
+    # Uso interno: lo recibe cada worker lanzado por el supervisor.
+    parser.add_argument('--bus', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-index', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    OUTBOUND_QUEUE_LIMIT = args.queue_limit
+    SLOW_CONSUMER_POLICY = args.slow_policy
+    COALESCE_WRITES = not args.no_coalesce
+    BACKLOG = RoomBacklog(args.backlog, int(args.backlog_memory * 1024 * 1024))
+    ADMIN_USERS = set(args.admin)
+    PROFILER = profiler.SamplingProfiler(args.profile_dir, args.profile_interval_ms / 1000.0)
+    PROFILE_SECONDS = args.profile_seconds
+    HEARTBEAT_INTERVAL = args.heartbeat
+    HEARTBEAT_TIMEOUT = args.heartbeat_timeout
+    IDLE_TIMEOUT = args.idle_timeout
+    LOGIN_TIMEOUT = args.login_timeout
+    KEEPALIVE = tuple(args.keepalive)
+    if HEARTBEAT_INTERVAL or IDLE_TIMEOUT or LOGIN_TIMEOUT:
+        HEARTBEATS = HeartbeatMonitor(TimingWheel())
+    for scope in ('user', 'room', 'ip'):
+        rate, burst = getattr(args, f'rate_{scope}')
+        RATE_LIMITS.configure(scope, rate, burst)
+    RATE_POLICY = args.rate_policy
+    RATE_MAX_DELAY = args.rate_max_delay
+    ADMISSION = Admission(args.max_sessions, args.max_handshakes, args.max_per_ip)
+    LISTEN_BACKLOG = args.listen_backlog
+
+    if args.handoff_socket and (args.workers > 1 or args.bus is not None):
+        parser.error('--handoff-socket no se puede combinar con --workers')
+    if args.snapshot_file and (args.workers > 1 or args.bus is not None):
+        parser.error('--snapshot-file no se puede combinar con --workers')
+    if args.takeover and not args.handoff_socket:
+        parser.error('--takeover necesita --handoff-socket')
+    HANDOFF_PATH = args.handoff_socket
+
+    if args.workers > 1 and args.bus is None:
+        run_supervisor(args.workers, args.bus_path, sys.argv[1:] if argv is None else list(argv))
+        return
+
+    LOG_PIPELINE = log_pipeline.install(args.log_queue, args.lifecycle_log)
+    LIFECYCLE_ENABLED = bool(args.lifecycle_log)
+
+    inherited = None
+    if args.takeover:
+        # antes de abrir el log de mensajes y el puerto de métricas: el
+        # proceso anterior los suelta al terminar
+        try:
+            inherited = handoff.take_over(HANDOFF_PATH)
+        except (OSError, ValueError, handoff.HandoffError) as exc:
+            LOGGER.error('No se pudo tomar el traspaso desde %s: %s', HANDOFF_PATH, exc)
+            sys.exit(1)
+        if inherited is None:
+            LOGGER.info('Nadie escucha en %s: arranque normal', HANDOFF_PATH)
+
+    if args.snapshot_file:
+        if inherited is None:
+            # con traspaso las salas llegan con el estado del proceso anterior
+            started = time.monotonic()
+            try:
+                entries = room_snapshot.load(args.snapshot_file)
+            except (OSError, room_snapshot.SnapshotError) as exc:
+                LOGGER.error('Instantánea %s descartada: %s', args.snapshot_file, exc)
+                entries = []
+            protected = restore_rooms(entries)
+            LOGGER.info(
+                'Salas recuperadas de %s: %d (%d con contraseña) en %.1f ms',
+                args.snapshot_file,
+                len(entries),
+                protected,
+                (time.monotonic() - started) * 1000,
+            )
+        ROOM_SNAPSHOTS = room_snapshot.RoomSnapshots(args.snapshot_file, collect_rooms, args.snapshot_interval)
+        ROOM_SNAPSHOTS.start()
+
+    if args.log_dir:
+        log_dir = args.log_dir
+        if args.worker_index is not None:
+            # un log por worker: cada uno numera sus propias secuencias
+            log_dir = os.path.join(log_dir, f'worker-{args.worker_index}')
+        MESSAGE_LOG = MessageLog(
+            log_dir,
+            segment_bytes=int(args.log_segment_mb * 1024 * 1024),
+            retention_bytes=int(args.log_retention_mb * 1024 * 1024),
+            retention_secs=args.log_retention_hours * 3600,
+            commit_interval=args.log_commit_ms / 1000.0,
+        )
+        LOGGER.info('Log de mensajes en %s (desde seq %d)', log_dir, MESSAGE_LOG.next_seq)
+
+    if args.metrics_port:
+        metrics_port = args.metrics_port + (args.worker_index or 0)
+        for attempt in range(50):
+            try:
+                metrics.serve_admin(args.metrics_host, metrics_port)
+                break
+            except OSError:
+                # tras un traspaso el puerto se libera cuando termina el proceso anterior
+                if inherited is None or attempt == 49:
+                    raise
+                time.sleep(0.1)
+        LOGGER.info('Métricas en http://%s:%d/metrics', args.metrics_host, metrics_port)
+
+    if args.queue_report > 0:
+        threading.Thread(target=queue_report_loop, args=(args.queue_report,), daemon=True).start()
+
+    LOGGER.info('Arrancando server_v5 en %s:%s', args.host, args.port)
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    signal.signal(signal.SIGUSR2, _start_profile_signal)
+    if HANDOFF_PATH:
+        signal.signal(signal.SIGUSR1, _interrupt_syscall)
+    try:
+        serve(args, inherited)
+    finally:
+        if ROOM_SNAPSHOTS is not None:
+            ROOM_SNAPSHOTS.close()
+        if MESSAGE_LOG is not None:
+            MESSAGE_LOG.close()
+        if LOG_PIPELINE is not None:
+            LOG_PIPELINE.stop()
+
+
+def serve(args, inherited=None):
+    """``inherited``: (estado, descriptores) recibidos con --takeover; el
+    primer descriptor es el socket de escucha."""
+    global ROOM_BUS, BUS_DEFERRED
+    if inherited is not None:
+        state, fds = inherited
+        s = socket.socket(fileno=fds[0])
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if args.bus is not None:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    with s:
+        configure_keepalive(s)
+        if inherited is None:
+            s.bind((args.host, args.port))
+            s.listen(LISTEN_BACKLOG)
+        if args.engine == 'loop':
+            loop = EventLoopServer(s)
+            if HEARTBEATS is not None:
+                loop.call_later(HEARTBEATS.wheel.tick, loop._heartbeat_tick)
+            if args.bus is not None:
+                BUS_DEFERRED = True
+                ROOM_BUS = RoomBusClient(args.bus, deliver_remote, loop.call_soon_threadsafe, PRESENCE)
+                LOGGER.info('Worker %d conectado al bus %s', os.getpid(), args.bus)
+            if inherited is not None:
+                restore_state(state, fds[1:], loop.adopt)
+            if HANDOFF_PATH:
+                start_handoff_listener(lambda chan: loop.call_soon_threadsafe(loop.hand_off, chan))
+            try:
+                loop.serve_forever()
+            except KeyboardInterrupt:
+                LOGGER.info('Detenido por KeyboardInterrupt')
+        else:
+            writer = SocketWriter()
+            writer.start()
+            if args.bus is not None:
+                ROOM_BUS = RoomBusClient(args.bus, deliver_remote, presence=PRESENCE)
+                LOGGER.info('Worker %d conectado al bus %s', os.getpid(), args.bus)
+            if HEARTBEATS is not None:
+                threading.Thread(target=heartbeat_loop, name='heartbeat', daemon=True).start()
+            if inherited is not None:
+                restore_state(state, fds[1:], adopt_threaded(writer))
+            if HANDOFF_PATH:
+                start_handoff_listener(_request_threaded_handoff(s))
+            accept_loop(s, writer)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,68 @@
+"""Pruebas de OutboundQueue (server_v5): descarte por cola llena con un
+sendmsg en curso."""
+
+import binwire
+import server_v5
+from server_v5 import OutboundQueue
+
+
+def test_overflow_while_sending_keeps_frames_in_flight():
+    queue = OutboundQueue(limit=3, policy='drop_oldest')
+    for frame in (b'uno\n', b'dos\n', b'tres\n'):
+        queue.push(frame)
+    views = queue.peek()
+    assert [bytes(v) for v in views] == [b'uno\n', b'dos\n', b'tres\n']
+    # cola llena y los tres frames en el sendmsg en curso: se descarta el que llega
+    queue.push(b'perdido\n')
+    assert queue.dropped == 1
+    assert queue.consume(len(b'uno\ndos\ntres\n')) == 0
+    assert len(queue) == 0 and queue.offset == 0
+    queue.push(b'alice: hola\n')
+    assert b''.join(bytes(v) for v in queue.peek()) == b'alice: hola\n'
+
+
+def test_overflow_while_sending_drops_oldest_not_in_flight():
+    queue = OutboundQueue(limit=3, policy='drop_oldest')
+    for frame in (b'uno\n', b'dos\n', b'tres\n'):
+        queue.push(frame)
+    queue.sending = True
+    queue.in_flight = 1  # peek entregó sólo el primero
+    queue.push(b'alice: hola\n')
+    assert list(queue.frames) == [b'uno\n', b'tres\n', b'alice: hola\n']
+    queue.consume(2)
+    views = queue.peek()
+    assert b''.join(bytes(v) for v in views) == b'o\ntres\nalice: hola\n'
+    queue.consume(len(b'o\ntres\n'))
+    assert b''.join(bytes(v) for v in queue.peek()) == b'alice: hola\n'
+    queue.consume(len(b'alice: hola\n'))
+    assert len(queue) == 0 and queue.offset == 0
+
+
+def test_partial_send_then_overflow_keeps_bin1_framing():
+    frames = [binwire.encode_text(f'm{i}') for i in range(4)]
+    queue = OutboundQueue(limit=2, policy='drop_oldest')
+    queue.push(frames[0])
+    queue.push(frames[1])
+    queue.peek()
+    queue.push(frames[2])  # todo está en vuelo: se descarta el que llega
+    queue.consume(3)  # primer frame a medias
+    queue.push(frames[3])  # primero a medio enviar: se descarta el segundo
+    out = b''.join(bytes(v) for v in queue.peek())
+    queue.consume(len(out))
+    decoded = binwire.FrameReader().feed_frames(frames[0][:3] + out)
+    assert [body for _, body in decoded] == [b'm0', b'm3']
+    assert len(queue) == 0 and queue.offset == 0
+
+
+def test_clear_during_send_ignores_stale_consume():
+    queue = OutboundQueue(limit=4, policy='drop_oldest')
+    queue.push(b'viejo\n')
+    queue.peek()
+    queue.clear()
+    queue.push(b'nuevo\n')
+    assert queue.consume(6) == 0
+    assert list(queue.frames) == [b'nuevo\n'] and queue.offset == 0
+
+
+def test_default_limit_from_module():
+    assert OutboundQueue().limit == max(2, server_v5.OUTBOUND_QUEUE_LIMIT)
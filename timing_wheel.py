@@ -0,0 +1,72 @@
+"""Rueda de tiempos con hash para vencimientos masivos (sesiones inactivas).
+
+Hay ``slots`` casilleros de ``tick`` segundos cada uno; programar un elemento
+a ``delay`` segundos lo agrega al casillero ``(tick actual + ticks) % slots``
+y cancelarlo lo saca: ambas operaciones son O(1), sin heap ni un temporizador
+por conexión. ``advance`` recorre sólo los casilleros de los ticks que pasaron
+y devuelve lo vencido; un retraso mayor que la vuelta completa queda en su
+casillero hasta la vuelta que le corresponde (se compara el tick absoluto).
+
+Los elementos tienen que admitir el atributo ``wheel_tick`` (el tick en el que
+vencen; None si no están programados) y ser hashables.
+"""
+
+import math
+import threading
+import time
+
+
+class TimingWheel:
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.started = time.monotonic()
+        self.current = 0  # último tick procesado
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, item, delay):
+        """(Re)programa ``item`` para dentro de ``delay`` segundos (mínimo un tick)."""
+        ticks = max(1, math.ceil(delay / self.tick))
+        with self.lock:
+            self._discard(item)
+            item.wheel_tick = self.current + ticks
+            self.slots[item.wheel_tick % len(self.slots)].add(item)
+            self.count += 1
+
+    def cancel(self, item):
+        with self.lock:
+            self._discard(item)
+
+    def _discard(self, item):
+        target = getattr(item, 'wheel_tick', None)
+        if target is None:
+            return
+        slot = self.slots[target % len(self.slots)]
+        if item in slot:
+            slot.discard(item)
+            self.count -= 1
+        item.wheel_tick = None
+
+    def advance(self, now=None):
+        """Procesa los ticks transcurridos hasta ``now`` y devuelve lo vencido."""
+        if now is None:
+            now = time.monotonic()
+        target = int((now - self.started) / self.tick)
+        expired = []
+        with self.lock:
+            while self.current < target:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                if not slot:
+                    continue
+                due = [item for item in slot if item.wheel_tick <= self.current]
+                for item in due:
+                    slot.discard(item)
+                    item.wheel_tick = None
+                self.count -= len(due)
+                expired.extend(due)
+        return expired